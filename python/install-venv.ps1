@@ -19,6 +19,7 @@ python -m venv .\venv
 pip install pyside2
 pip install pygame
 pip install opencv-python
+pip install numpy
 pip install pywin32
 pip install pyyaml
 pip install simplejpeg
@@ -10,49 +10,95 @@ import base64
 import sys
 
 from Frame import Frame
+from cameras import DEFAULT_CAMERAS, camera_number
 from database.DB import DB
+from database.FrameWriter import FrameWriter, FlushPolicy
+from database.FrameReaper import FrameReaper
+from database.ThumbnailWriter import ThumbnailWriter
+from database.Compactor import Compactor
+from database.RetentionWorker import RetentionWorker, RetentionPolicy
 import database.frame_dao as frame_dao
 from function_timer import timer
+from IngestMetrics import CameraMetrics, percentiles
+import frame_bundle
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import tornado.ioloop
 import tornado.web
+import tornado.websocket
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger('tornado.access').disabled = True
 logger = logging.getLogger(__name__)
 
+# Max frames per camera waiting on the ingest executor before the answer is held back
+MAX_PENDING_FRAMES = 90
+# How often a missing frame is checked for its reorder timeout
+REORDER_CHECK_INTERVAL_MS = 100
+
 class ServerData:
    db = None
+   frame_writer = None # type: FrameWriter
+   frame_reaper = None # type: FrameReaper
+   thumbnail_writer = None # type: ThumbnailWriter
+   compactor = None # type: Compactor
+   retention_worker = None # type: RetentionWorker
    flight = 1
+   cameras = DEFAULT_CAMERAS
    request_pictures_from_camera = False
    last_picture_timestamp = 0
 
    # Frames key, timestamps value
    cameras_data = None
-   camera_last_transmission_timestamp = {"cam1": 0, "cam2": 0}
+   camera_last_transmission_timestamp = {}  # type: dict[str, float]
+
+   # One single threaded executor per camera, keeps the frames of a camera in order
+   ingest_executors = {}  # type: dict[str, ThreadPoolExecutor]
+   ingest_pending = {}  # type: dict[str, int]
+
+   # Ingest metrics per camera, only touched on the IOLoop
+   metrics = {}  # type: dict[str, CameraMetrics]
+
+   # Persistent stream per camera, see CameraStreamHandler
+   ioloop = None # type: tornado.ioloop.IOLoop
+   camera_streams = {}  # type: dict[str, CameraStreamHandler]
 
    # logs
-   last_log_message_cam_asking_to_start = {'cam1': 0, 'cam2': 0}
+   last_log_message_cam_asking_to_start = {}  # type: dict[str, float]
 
 class TornadoHandler(tornado.web.RequestHandler):
+   def initialize(self):
+      # Camera to record the request latency on
+      self.__metrics_cam = None
+
    def log_message(self, format, *args):
       pass
 
-   @timer("Http POST", logging.INFO, identifier=None, average=1000)
-   def post(self):
+   def on_finish(self):
+      if self.__metrics_cam is not None:
+         ServerData.metrics[self.__metrics_cam].record_request(self.request.request_time() * 1000)
+
+   def get(self):
+      action = self.get_argument("action", None, True)
+      if (action == "metrics"):
+         self.set_header('Cache-Control', 'no-cache')
+         self.write(get_metrics())
+         return
+      self.set_status(404)
+
+   async def post(self):
       global ServerData
 
       action = self.get_argument("action", None, True)
 
       if (action == "startcamera"):
          id = self.get_argument("cam", None, True)
-         if id != "cam1" and id != "cam2":
-            logger.info("Uploadframe unknown camera id: " + id)
+         if id not in ServerData.cameras:
+            logger.info("Uploadframe unknown camera id: " + str(id))
             return
 
-         if id == "cam1" or id == "cam2":
-            ServerData.camera_last_transmission_timestamp[id] = time.time()
+         ServerData.camera_last_transmission_timestamp[id] = time.time()
 
          if (time.time() -  ServerData.last_log_message_cam_asking_to_start[id] > 10):
             logger.info("Camera " + id + " is online and asking to start")
@@ -66,10 +112,11 @@ class TornadoHandler(tornado.web.RequestHandler):
 
       if (action == "uploadframe"):
          cam = self.get_argument("cam", None, True)
-         if cam != "cam1" and cam != "cam2":
-            logger.info("Uploadframe unknown camera id: " + cam)
+         if cam not in ServerData.cameras:
+            logger.info("Uploadframe unknown camera id: " + str(cam))
             return
 
+         self.__metrics_cam = cam
          ServerData.camera_last_transmission_timestamp[cam] = time.time()
 
          position = int(self.get_argument("position", None, True))
@@ -80,18 +127,44 @@ class TornadoHandler(tornado.web.RequestHandler):
 
          frame = Frame(
             ServerData.flight,
-            1 if cam == 'cam1' else 2,
+            camera_number(cam),
             position,
             timestamp,
             image
          )
-         frame_dao.store(ServerData.db, frame)
+         await submit_frame(cam, frame)
+
+         if (ServerData.request_pictures_from_camera):
+            self.send200("OK-CONTINUE")
+         else:
+            self.send200("OK-STOP")
+
+      if (action == "uploadframes"):
+         cam = self.get_argument("cam", None, True)
+         if cam not in ServerData.cameras:
+            logger.info("Uploadframes unknown camera id: " + str(cam))
+            return
 
-         ''' Clear the image for memory reasons '''
-         frame.set_image(None)
-         if not ServerData.cameras_data.add_frame(frame):
-            logger.critical("Shooting stoped after failed add frame!")
-            stop_shooting()
+         self.__metrics_cam = cam
+         ServerData.camera_last_transmission_timestamp[cam] = time.time()
+
+         try:
+            frames = frame_bundle.unpack(self.request.body)
+         except ValueError as e:
+            logger.error("Uploadframes bad bundle from " + cam + ": " + str(e))
+            self.set_status(400)
+            return
+         ServerData.last_picture_timestamp = time.time()
+
+         for position, timestamp, image in frames:
+            frame = Frame(
+               ServerData.flight,
+               camera_number(cam),
+               position,
+               timestamp,
+               image
+            )
+            await submit_frame(cam, frame)
 
          if (ServerData.request_pictures_from_camera):
             self.send200("OK-CONTINUE")
@@ -104,13 +177,118 @@ class TornadoHandler(tornado.web.RequestHandler):
       payload = msg.encode('ASCII')
       self.write(payload)
 
+''' Persistent channel for one camera, /stream?cam=cam1
+
+   The camera pushes frames as binary messages, every message is a frame bundle
+   (see frame_bundle.py) of one or more frames. The server sends the text
+   messages START and STOP when shooting starts and stops, and the current state
+   when the camera connects.
+'''
+class CameraStreamHandler(tornado.websocket.WebSocketHandler):
+   def open(self):
+      global ServerData
+      self.__cam = self.get_argument("cam", None, True)
+      if self.__cam not in ServerData.cameras:
+         logger.info("Stream unknown camera id: " + str(self.__cam))
+         self.close()
+         return
+
+      if self.__cam in ServerData.camera_streams:
+         logger.warning("Camera " + self.__cam + " opened a new stream, closing the old one")
+         ServerData.camera_streams[self.__cam].close()
+      ServerData.camera_streams[self.__cam] = self
+      ServerData.camera_last_transmission_timestamp[self.__cam] = time.time()
+      logger.info("Camera " + self.__cam + " is online on stream")
+      self.write_message("START" if ServerData.request_pictures_from_camera else "STOP")
+
+   async def on_message(self, message):
+      global ServerData
+      start = time.perf_counter()
+      ServerData.camera_last_transmission_timestamp[self.__cam] = time.time()
+      if not isinstance(message, bytes):
+         return
+
+      try:
+         frames = frame_bundle.unpack(message)
+      except ValueError as e:
+         logger.error("Stream bad bundle from " + self.__cam + ": " + str(e))
+         return
+      ServerData.last_picture_timestamp = time.time()
+
+      for position, timestamp, image in frames:
+         frame = Frame(
+            ServerData.flight,
+            camera_number(self.__cam),
+            position,
+            timestamp,
+            image
+         )
+         await submit_frame(self.__cam, frame)
+      ServerData.metrics[self.__cam].record_request((time.perf_counter() - start) * 1000)
+
+   def on_close(self):
+      global ServerData
+      if ServerData.camera_streams.get(self.__cam) is self:
+         logger.info("Camera " + self.__cam + " closed stream")
+         del ServerData.camera_streams[self.__cam]
+
+async def submit_frame(cam: str, frame: Frame):
+   ''' Hand the frame to the ingest executor of the camera, the answer does not wait for it '''
+   ServerData.metrics[cam].record_frame(frame.get_position(), frame.get_timestamp(), len(frame.get_image()))
+   future = tornado.ioloop.IOLoop.current().run_in_executor(
+      ServerData.ingest_executors[cam], ingest_frame, ServerData.cameras_data, frame)
+   ServerData.ingest_pending[cam] += 1
+
+   def done(future):
+      ServerData.ingest_pending[cam] -= 1
+   future.add_done_callback(done)
+
+   ''' Hold back the answer if the executor is falling behind '''
+   if ServerData.ingest_pending[cam] > MAX_PENDING_FRAMES:
+      await future
+
+@timer("Ingest frame", logging.INFO, identifier=None, average=1000)
+def ingest_frame(cameras_data, frame: Frame):
+   ''' Runs on the ingest executor of the camera '''
+   try:
+      ''' The live buffers get the frame before it is handed to the writer thread '''
+      added = cameras_data.add_frame(frame)
+      ServerData.thumbnail_writer.put(frame.get_flight(), frame.get_camera(), frame.get_position(), frame.get_image())
+      ServerData.frame_writer.put(frame)
+
+      if not added:
+         logger.critical("Shooting stoped after failed add frame!")
+         stop_shooting()
+   except Exception as e:
+      logger.error("Unable to ingest frame " + str(frame.get_position()) + ": " + str(e))
+
+def __send_to_streams(command: str):
+   ''' Runs on the IOLoop '''
+   for stream in list(ServerData.camera_streams.values()):
+      try:
+         stream.write_message(command)
+      except tornado.websocket.WebSocketClosedError:
+         pass
+
+def __check_reorder_timeouts():
+   ''' Runs on the IOLoop, a camera that went silent after a missing frame stops shooting like a gap does '''
+   cameras_data = ServerData.cameras_data
+   if not ServerData.request_pictures_from_camera or cameras_data is None:
+      return
+   if not cameras_data.check_timeouts():
+      logger.critical("Shooting stoped after a missing frame timed out!")
+      stop_shooting()
+
 def __startHTTP():
    asyncio.set_event_loop(asyncio.new_event_loop())
    app = tornado.web.Application([
       (r"/", TornadoHandler),
-   ])
+      (r"/stream", CameraStreamHandler),
+   ], websocket_ping_interval=2)
    app.listen(8000)
-   tornado.ioloop.IOLoop.instance().start()
+   ServerData.ioloop = tornado.ioloop.IOLoop.current()
+   tornado.ioloop.PeriodicCallback(__check_reorder_timeouts, REORDER_CHECK_INTERVAL_MS).start()
+   ServerData.ioloop.start()
 
 def is_shooting():
    global ServerData
@@ -121,44 +299,138 @@ def start_shooting(cameras_data, flight):
    if ServerData.request_pictures_from_camera:
       return False
 
-   if not is_online('cam1') and not is_online('cam2'):
+   if not any(is_online(cam) for cam in ServerData.cameras):
       logger.error("Unable to start shooting because camera is not online")
       return False
 
    try:
       start = time.time()
-      logger.info("Deleting old frames and announcements...")
-      frame_dao.delete_flight(ServerData.db, flight)
-      logger.info("Time to remove pictures: " + format(time.time() - start, ".3f") + "s")
+      ''' Frames from an earlier shoot must be written before the flight is retired '''
+      ServerData.frame_writer.flush(wait=True)
+      ServerData.thumbnail_writer.flush(wait=True)
+      ''' The old frames are deleted in the background '''
+      generation = frame_dao.retire_flight(ServerData.db, flight)
+      ServerData.frame_reaper.wake()
+      logger.info("Time to retire flight " + str(flight) + " to generation " + str(generation) + ": " + format(time.time() - start, ".3f") + "s")
    except Exception as e:
       logger.error(str(e))
       return
 
+   if ServerData.cameras_data is not None and ServerData.cameras_data is not cameras_data:
+      ''' Its maps would keep the retired segments open '''
+      ServerData.cameras_data.close()
+   ServerData.flight = flight
    ServerData.cameras_data = cameras_data
+   ServerData.ioloop.add_callback(__reset_metrics)
    ServerData.request_pictures_from_camera = True
+   ServerData.ioloop.add_callback(__send_to_streams, "START")
    return True
 
 def stop_shooting():
    logger.info("Request to stop shooting")
    global ServerData
    ServerData.request_pictures_from_camera = False
+   ServerData.frame_writer.flush()
+   ServerData.ioloop.add_callback(__send_to_streams, "STOP")
+   try:
+      frame_dao.set_flight_stopped(ServerData.db, ServerData.flight)
+   except Exception as e:
+      logger.error(str(e))
+   ServerData.compactor.wake()
 
-# Both cameras online and not currently requesting pictures
+# All cameras online and not currently requesting pictures
 def is_ready_to_shoot():
    global ServerData
-   if not is_online("cam1"):
-      return False
-   if not is_online("cam2"):
-      return False
+   for cam in ServerData.cameras:
+      if not is_online(cam):
+         return False
    return not ServerData.request_pictures_from_camera
 
-# Have camera been seen for 5 seconds
+# Have camera been seen for 5 seconds or is it connected on a stream
 def is_online(cam):
    global ServerData
-   return time.time() - ServerData.camera_last_transmission_timestamp[cam] < 5
+   return cam in ServerData.camera_streams or time.time() - ServerData.camera_last_transmission_timestamp[cam] < 5
+
+def __on_frames_dropped(frames: int):
+   ''' Runs on the frame writer thread, the frames are shown as stored but have no image '''
+   logger.critical("Shooting stoped after " + str(frames) + " frames could not be stored!")
+   ServerData.ioloop.add_callback(stop_shooting)
+
+def __on_thinned(flight: int):
+   ''' The old generation of flight is deleted once nothing maps its segments '''
+   cameras_data = ServerData.cameras_data
+   if cameras_data is not None and cameras_data.get_flight() == flight:
+      cameras_data.close()
+   ServerData.frame_reaper.wake()
+
+def __reset_metrics():
+   ''' Runs on the IOLoop '''
+   for metrics in ServerData.metrics.values():
+      metrics.reset()
+
+def get_metrics() -> dict:
+   ''' Ingest and storage metrics, must be called on the IOLoop '''
+   global ServerData
+   cameras = {}
+   for cam in ServerData.cameras:
+      cameras[cam] = ServerData.metrics[cam].get()
+      cameras[cam]["online"] = is_online(cam)
+      cameras[cam]["ingest_pending"] = ServerData.ingest_pending[cam]
+      cameras[cam]["storage_write_latency_ms"] = percentiles(ServerData.frame_writer.get_write_latencies(camera_number(cam)))
+      if ServerData.cameras_data is not None:
+         cameras[cam]["reorder"] = ServerData.cameras_data.get_reorder_stats(cam)
+
+   storage = ServerData.frame_writer.get_stats()
+   storage["commit_ms"] = percentiles(ServerData.frame_writer.get_commit_latencies())
+   storage["space"] = ServerData.compactor.get_stats()
+   return {
+      "flight": ServerData.flight,
+      "shooting": is_shooting(),
+      "cameras": cameras,
+      "storage": storage
+   }
+
+def flush_frames(timeout: float = None) -> bool:
+   ''' Wait until the frames ingested so far are in the database '''
+   return ServerData.frame_writer.flush(wait=True, timeout=timeout)
+
+def get_frame_writer_stats():
+   global ServerData
+   return ServerData.frame_writer.get_stats()
 
-def start_server(db: DB):
+def start_server(db: DB, cameras: list = DEFAULT_CAMERAS, flush_policy: FlushPolicy = None, retention_policy: RetentionPolicy = None):
    global ServerData
    ServerData.db = db
+   ServerData.cameras = list(cameras)
+   ServerData.frame_writer = FrameWriter(db, flush_policy, __on_frames_dropped)
+   ServerData.frame_reaper = FrameReaper(db)
+   ServerData.thumbnail_writer = ThumbnailWriter(db)
+   ServerData.compactor = Compactor(db, lambda: not ServerData.request_pictures_from_camera)
+   if retention_policy is not None and retention_policy.enabled:
+      ServerData.retention_worker = RetentionWorker(db, retention_policy,
+         lambda: not ServerData.request_pictures_from_camera, __on_thinned)
+   for cam in ServerData.cameras:
+      ServerData.camera_last_transmission_timestamp[cam] = 0
+      ServerData.last_log_message_cam_asking_to_start[cam] = 0
+      ServerData.ingest_pending[cam] = 0
+      ServerData.metrics[cam] = CameraMetrics()
+      ServerData.ingest_executors[cam] = ThreadPoolExecutor(1, "Ingest-" + cam)
+   logger.info("Cameras: " + ", ".join(ServerData.cameras))
    logger.info("Starting camera server")
    _thread.start_new_thread(__startHTTP, ())
+
+def stop_server():
+   global ServerData
+   logger.info("Stopping camera server")
+   for executor in ServerData.ingest_executors.values():
+      executor.shutdown(wait=True)
+   if ServerData.retention_worker is not None:
+      ServerData.retention_worker.stop()
+   if ServerData.frame_reaper is not None:
+      ServerData.frame_reaper.stop()
+   if ServerData.compactor is not None:
+      ServerData.compactor.stop()
+   if ServerData.thumbnail_writer is not None:
+      ServerData.thumbnail_writer.stop()
+   if ServerData.frame_writer is not None:
+      ServerData.frame_writer.stop()
@@ -1,91 +1,364 @@
 from threading import Lock
 import time
 
+import numpy as np
+
 from database.DB import DB
 import database.frame_dao as frame_dao
+from database.FrameReader import FrameReader
 from Frame import Frame
+from FrameRingBuffer import FrameRingBuffer
+import simplejpeg
+from cameras import DEFAULT_CAMERAS, camera_number, camera_id
 
 from function_timer import timer
 
 import logging
 logger = logging.getLogger(__name__)
 
-class CamerasData:
-   __mutex = Lock()
+class ReorderPolicy:
+   ''' Frames may arrive up to window positions ahead, a missing frame is a gap after timeout_ms '''
+   def __init__(self, window: int = 45, timeout_ms: int = 500):
+      self.window = max(0, window)
+      self.timeout_ms = max(0, timeout_ms)
+
+class CameraSnapshot:
+   '''
+   The frames of one camera released up to one moment. The arrays are shared
+   with the writer, which only writes past frame_count and replaces an array
+   instead of shrinking it, so a snapshot never changes and is read without a
+   lock
+   '''
+   __slots__ = ('frame_count', 'timestamps', 'timestamp_index', 'present')
+
+   def __init__(self, frame_count: int, timestamps, timestamp_index, present: bytearray):
+      self.frame_count = frame_count
+      self.timestamps = timestamps
+      self.timestamp_index = timestamp_index
+      self.present = present
+
+   def has_frame(self, position: int) -> bool:
+      return 0 < position <= self.frame_count and self.present[position >> 3] >> (position & 7) & 1 == 1
+
+   def get_timestamp(self, position: int) -> int:
+      ''' Timestamp of position, None when it is unknown '''
+      if 0 < position <= self.frame_count and self.timestamps[position]:
+         return int(self.timestamps[position])
+      return None
+
+   def get_position_at(self, timestamp: int) -> int:
+      '''
+      First position with a timestamp at or after timestamp, the last position
+      when all are before it and None when there are no frames
+      '''
+      if self.frame_count == 0:
+         return None
+      return min(int(np.searchsorted(self.timestamp_index[1:self.frame_count + 1], timestamp, side='left')) + 1, self.frame_count)
+
+   def get_nearest_position(self, timestamp: int) -> int:
+      ''' Position with the timestamp closest to timestamp, None when there are no frames '''
+      position = self.get_position_at(timestamp)
+      if position is None or position == 1:
+         return position
+      index = self.timestamp_index
+      if abs(int(index[position - 1]) - timestamp) <= abs(int(index[position]) - timestamp):
+         return position - 1
+      return position
+
+class CameraState:
+   '''
+   Frames of one camera as arrays indexed by position, about 16 bytes a
+   frame. Frame objects are only made when asked for, the images are in the
+   live buffer and in storage.
+
+   There is one writer per camera, holding the lock of the camera. It
+   publishes a new snapshot with a single assignment after the arrays are
+   written, readers take the latest snapshot and never wait on the writer
+   '''
+   def __init__(self, live_frames: int, decode_live_frames: bool):
+      self.mutex = Lock()
+      # Written by the writer only, readers use snapshot
+      self.frame_count = 0
+      # Timestamp of every position up to frame_count, index 0 unused and 0 where unknown
+      self.timestamps = np.zeros(1, dtype=np.int64)
+      # Running maximum of timestamps, never decreasing so it can be binary searched
+      self.timestamp_index = np.zeros(1, dtype=np.int64)
+      # One bit per position, set for the frames there are, grown in place
+      self.present = bytearray(1)
 
-   __db = None # type: DB
-   __flight = None # type: int
+      self.snapshot = CameraSnapshot(0, self.timestamps, self.timestamp_index, self.present)
 
-   __frames = {
-      'cam1': {},
-      'cam2': {}
-   }
+      # Reorder buffer, timestamps of the frames that arrived ahead of frame_count + 1
+      self.pending = {} # type: dict[int, int]
+      self.waiting_since = 0
+      self.reordered = 0
+      self.late = 0
+      self.gaps = 0
 
-   __frame_count = {
-      'cam1': 0,
-      'cam2': 0
-   }
+      # The latest frames from ingest, read without a database round trip
+      self.live = FrameRingBuffer(live_frames, decode_live_frames)
 
-   def __init__(self, db: DB, flight: int):
+class CamerasData:
+   def __init__(self, db: DB, flight: int, cameras: list = DEFAULT_CAMERAS, reorder_policy: ReorderPolicy = None,
+         live_frames: int = 450, decode_live_frames: bool = False):
       self.__db = db
       self.__flight = flight
-      self.__frames['cam1'] = {}
-      self.__frames['cam2'] = {}
+      self.__reorder_policy = reorder_policy or ReorderPolicy()
+      self.__cameras = {} # type: dict[str, CameraState]
+      # Zero copy readers of the stored images, created on first use
+      self.__readers = {} # type: dict[str, FrameReader]
+      for cam in cameras:
+         self.__cameras[cam] = CameraState(live_frames, decode_live_frames)
+
+   def __acquire_lock(self, cam: str):
+      logger.debug("Acquire lock " + cam)
+      self.__cameras[cam].mutex.acquire()
+
+   def __release_lock(self, cam: str):
+      logger.debug("Release lock " + cam)
+      self.__cameras[cam].mutex.release()
 
-   def __acquire_lock(self):
-      logger.debug("Acquire lock")
-      self.__mutex.acquire()
+   def get_flight(self) -> int:
+      return self.__flight
 
-   def __release_lock(self):
-      logger.debug("Release lock")
-      self.__mutex.release()
+   def get_cameras(self) -> list:
+      return list(self.__cameras.keys())
 
    def add_frame(self, frame: Frame) -> bool:
+      '''
+      Frames are released in order from 1 to infinity. A frame arriving ahead of
+      the next position waits in the reorder buffer. Returns False when a missing
+      frame is declared a gap
+      '''
       logger.debug("add_frame() position " + str(frame.get_position()))
-      self.__acquire_lock()
-      ''' We require the frames to actually be in order from 1 to infinity '''
-      if frame.get_position() > 1 and not self.__frames['cam' + str(frame.get_camera())][frame.get_position() - 1]:
-         logger.critical("Missing a frame when adding, can't continue!")
-         self.__release_lock()
+      cam = camera_id(frame.get_camera())
+      if cam not in self.__cameras:
+         logger.critical("Frame from unknown camera " + cam)
          return False
 
-      cam = 'cam' + str(frame.get_camera())
+      state = self.__cameras[cam]
       position = frame.get_position()
-      self.__frames[cam][position] = frame
-      self.__frame_count[cam] = position
-      self.__release_lock()
+      if frame.get_image() is not None:
+         state.live.put(position, frame.get_timestamp(), frame.get_image())
+
+      self.__acquire_lock(cam)
+      try:
+         next_position = state.frame_count + 1
+         if position < next_position or position in state.pending:
+            state.late += 1
+            logger.warning("Late or duplicate frame " + str(position) + " on " + cam + ", ignored")
+            return True
+
+         if position == next_position:
+            self.__set_timestamp(state, position, frame.get_timestamp())
+            state.frame_count = position
+            # Release the frames waiting on this one
+            while state.frame_count + 1 in state.pending:
+               self.__set_timestamp(state, state.frame_count + 1, state.pending.pop(state.frame_count + 1))
+               state.frame_count += 1
+            state.snapshot = CameraSnapshot(state.frame_count, state.timestamps, state.timestamp_index, state.present)
+            state.waiting_since = time.monotonic() if state.pending else 0
+            return True
+
+         if position - next_position >= self.__reorder_policy.window:
+            state.gaps += 1
+            logger.critical("Missing frame " + str(next_position) + " on " + cam + " outside reorder window, can't continue!")
+            return False
+
+         state.pending[position] = frame.get_timestamp()
+         state.reordered += 1
+         if not state.waiting_since: state.waiting_since = time.monotonic()
+         return not self.__timed_out(cam, state)
+      finally:
+         self.__release_lock(cam)
+
+   def check_timeouts(self) -> bool:
+      '''
+      Called periodically, a camera that stops sending after a missing frame
+      brings no frame along to check the timeout. Returns False when a missing
+      frame is declared a gap
+      '''
+      for cam, state in self.__cameras.items():
+         self.__acquire_lock(cam)
+         try:
+            if self.__timed_out(cam, state):
+               return False
+         finally:
+            self.__release_lock(cam)
       return True
 
+   def __timed_out(self, cam: str, state: CameraState) -> bool:
+      ''' Called with the lock of the camera '''
+      if not state.pending or (time.monotonic() - state.waiting_since) * 1000 <= self.__reorder_policy.timeout_ms:
+         return False
+      state.gaps += 1
+      logger.critical("Missing frame " + str(state.frame_count + 1) + " on " + cam + " after timeout, can't continue!")
+      return True
+
+   def __set_timestamp(self, state: CameraState, position: int, timestamp: int):
+      '''
+      Called with the lock of the camera for positions in order, the arrays
+      double when full so snapshots never see them shrink
+      '''
+      if position >= len(state.timestamps):
+         size = max(2 * len(state.timestamps), position + 1)
+         state.timestamps = self.__grow(state.timestamps, size)
+         state.timestamp_index = self.__grow(state.timestamp_index, size)
+         state.present.extend(bytes((size >> 3) + 1 - len(state.present)))
+      state.timestamps[position] = timestamp or 0
+      state.timestamp_index[position] = max(state.timestamp_index[position - 1], timestamp or 0)
+      state.present[position >> 3] |= 1 << (position & 7)
+
+   def __grow(self, array, size: int):
+      grown = np.zeros(size, dtype=np.int64)
+      grown[:len(array)] = array
+      return grown
+
+   def get_live_image(self, cam: str, position: int):
+      '''
+      Grayscale image of a frame received while shooting, None when the frame
+      is no longer in memory and has to be read from the database
+      '''
+      state = self.__cameras[cam]
+      return state.live.get_image(position)
+
+   def get_image(self, cam: str, position: int):
+      ''' Grayscale image of a frame, from memory while it is live, otherwise decoded straight from storage '''
+      image = self.get_live_image(cam, position)
+      if image is not None:
+         return image
+
+      reader = self.__readers.get(cam)
+      if reader is None:
+         reader = self.__readers.setdefault(cam, FrameReader(self.__db, self.__flight, camera_number(cam)))
+      jpeg = reader.get_image(position)
+      if jpeg is None:
+         return None
+      return simplejpeg.decode_jpeg(jpeg, colorspace='GRAY')
+
+   def close(self):
+      ''' Release the segment maps of the stored images, once the flight is no longer shown or its frames have moved '''
+      for reader in list(self.__readers.values()):
+         reader.close()
+
+   def get_thumbnail(self, cam: str, position: int):
+      ''' Grayscale thumbnail of a stored frame, scaled down by ThumbnailWriter.FACTOR, None when it has none '''
+      thumbnail = frame_dao.load_thumbnail(self.__db, self.__flight, camera_number(cam), position)
+      if thumbnail is None:
+         return None
+      return simplejpeg.decode_jpeg(thumbnail, colorspace='GRAY')
+
+   def get_reorder_stats(self, cam: str) -> dict:
+      ''' Counters as the writer left them, read without the lock '''
+      state = self.__cameras[cam]
+      return {
+         "reordered": state.reordered,
+         "late": state.late,
+         "pending": len(state.pending),
+         "gaps": state.gaps
+      }
+
+   def get_first_pending(self, cam: str) -> int:
+      ''' Lowest position waiting in the reorder buffer, None when none is '''
+      self.__acquire_lock(cam)
+      try:
+         pending = self.__cameras[cam].pending
+         return min(pending) if pending else None
+      finally:
+         self.__release_lock(cam)
+
+   def get_snapshot(self, cam: str) -> CameraSnapshot:
+      ''' The frames of cam released so far, for several reads that must agree with each other '''
+      return self.__cameras[cam].snapshot
+
    def get_start_timestamp(self):
-      logger.debug("get_start_timestamp()")
-      self.__acquire_lock()
-      frame1_cam1 = self.get_frame('cam1', 1)
-      timestamp_cam1 = frame1_cam1.get_timestamp() if frame1_cam1 is not None else 0
-      frame1_cam2 = self.get_frame('cam2', 1)
-      timestamp_cam2 = frame1_cam2.get_timestamp() if frame1_cam2 is not None else 0
-      self.__release_lock()
-      return max(timestamp_cam1 or 0, timestamp_cam2 or 0)
+      ''' Latest of the timestamps of the first frames of the cameras, 0 when there are none '''
+      start_timestamp = 0
+      for state in self.__cameras.values():
+         start_timestamp = max(start_timestamp, state.snapshot.get_timestamp(1) or 0)
+      return start_timestamp
 
    def get_last_frame(self, cam: str) -> Frame:
-      logger.debug("get_last_frame()")
-      self.__acquire_lock()
-      if self.__frame_count[cam] == 0:
-         self.__release_lock()
+      frame_count = self.__cameras[cam].snapshot.frame_count
+      if frame_count == 0:
          return None
-      self.__release_lock()
-      return self.get_frame(cam, self.__frame_count[cam])
+      return self.get_frame(cam, frame_count)
+
+   def has_frame(self, cam: str, position: int) -> bool:
+      return self.__cameras[cam].snapshot.has_frame(position)
 
    def get_frame(self, cam: str, position: int) -> Frame:
-      if self.__frames[cam].get(position): return self.__frames[cam][position]
-      timestamp = frame_dao.load_timestamp(self.__db, self.__flight, 1 if cam == 'cam1' else 2, position)
-      self.__frames[cam][position] = Frame(self.__flight, cam, position, timestamp, None)
-      return self.__frames[cam][position]
+      ''' A new Frame without image, its timestamp from the database for positions not in memory '''
+      snapshot = self.__cameras[cam].snapshot
+      if snapshot.has_frame(position):
+         timestamp = int(snapshot.timestamps[position])
+      else:
+         timestamp = frame_dao.load_timestamp(self.__db, self.__flight, camera_number(cam), position)
+      return Frame(self.__flight, camera_number(cam), position, timestamp, None)
+
+   def get_timestamp(self, cam: str, position: int) -> int:
+      ''' Timestamp of a frame from the timestamps array, the database is only asked for positions not in it '''
+      timestamp = self.__cameras[cam].snapshot.get_timestamp(position)
+      if timestamp is not None:
+         return timestamp
+      return frame_dao.load_timestamp(self.__db, self.__flight, camera_number(cam), position)
+
+   def get_timestamps(self, cam: str):
+      ''' Timestamps of positions 1 to frame count, index 0 is unused '''
+      snapshot = self.__cameras[cam].snapshot
+      return snapshot.timestamps[:snapshot.frame_count + 1]
+
+   def get_position_at(self, cam: str, timestamp: int) -> int:
+      '''
+      First position of cam with a timestamp at or after timestamp, the last
+      position when all are before it and None when there are no frames
+      '''
+      return self.__cameras[cam].snapshot.get_position_at(timestamp)
+
+   def get_nearest_position(self, cam: str, timestamp: int) -> int:
+      ''' Position of cam with the timestamp closest to timestamp, None when there are no frames '''
+      return self.__cameras[cam].snapshot.get_nearest_position(timestamp)
 
    def get_frame_count(self, cam: str):
-      return self.__frame_count[cam]
+      ''' Last position released in order, read without the lock '''
+      return self.__cameras[cam].snapshot.frame_count
 
-   @timer("Time to load last position")
+   @timer("Time to load flight timestamps")
    def load(self, db: DB, flight):
-      logger.info("Lazy loading flight " + str(flight) + "...")
-      for cam in [1, 2]:
-         self.__frame_count['cam' + str(cam)] = frame_dao.load_frame_count(db, flight, cam)
+      ''' Timestamps of every frame in one query per camera, images are read when shown '''
+      logger.info("Loading flight " + str(flight) + "...")
+      for cam in self.__cameras:
+         self.__load_camera(db, flight, cam)
+
+   def resync(self, cam: str):
+      '''
+      Reload the frames of cam from the database after frames were lost on the
+      way here. Frames waiting in the reorder buffer are released after the
+      stored ones, positions missing in between stay unknown
+      '''
+      logger.warning("Reloading frames of " + cam + " from the database")
+      self.__load_camera(self.__db, self.__flight, cam)
+
+   def __load_camera(self, db: DB, flight: int, cam: str):
+      rows = np.array(frame_dao.load_flight_timestamps(db, flight, camera_number(cam)), dtype=np.int64).reshape(-1, 2)
+      state = self.__cameras[cam]
+      self.__acquire_lock(cam)
+      try:
+         state.frame_count = int(rows[-1, 0]) if len(rows) else 0
+         state.timestamps = np.zeros(state.frame_count + 1, dtype=np.int64)
+         state.timestamps[rows[:, 0]] = rows[:, 1]
+         state.timestamp_index = np.maximum.accumulate(state.timestamps)
+         present = np.zeros(state.frame_count + 1, dtype=bool)
+         present[rows[:, 0]] = True
+         state.present = bytearray(np.packbits(present, bitorder='little').tobytes())
+         for position in sorted(state.pending):
+            timestamp = state.pending.pop(position)
+            if position > state.frame_count:
+               self.__set_timestamp(state, position, timestamp)
+               state.frame_count = position
+         ''' The running maximum goes on over the positions skipped '''
+         state.timestamp_index = np.maximum.accumulate(state.timestamps)
+         state.waiting_since = 0
+         state.snapshot = CameraSnapshot(state.frame_count, state.timestamps, state.timestamp_index, state.present)
+      finally:
+         self.__release_lock(cam)
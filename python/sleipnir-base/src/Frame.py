@@ -1,4 +1,7 @@
 class Frame:
+    ''' One frame of a camera, CamerasData only creates them when asked for '''
+    __slots__ = ('__flight', '__camera', '__position', '__timestamp', '__image')
+
     def __init__ (self, flight: int, camera: int, position: int, timestamp: int, image):
         self.__flight = flight
         self.__camera = camera
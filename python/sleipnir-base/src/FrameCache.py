@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from threading import Lock
+
+class FrameCache:
+   '''
+   Decoded grayscale frames of stored flights, least recently used first,
+   keyed by (flight, camera, position) and bounded to max_bytes of images.
+
+   Shared by the videos of both cameras so stepping, pausing and jumping to
+   an announcement do not read and decode the same frames again. put keeps
+   a copy and get returns a copy, the caller may draw on either. A flight
+   shot again must be invalidated, its frames are new
+   '''
+   def __init__(self, max_bytes: int):
+      self.__max_bytes = max(0, max_bytes)
+      self.__mutex = Lock()
+      self.__images = OrderedDict()
+      self.__bytes = 0
+      self.__hits = 0
+      self.__misses = 0
+      self.__evictions = 0
+
+   def get(self, flight: int, camera: str, position: int):
+      ''' Copy of the cached image, None on a miss '''
+      key = (flight, camera, position)
+      self.__mutex.acquire()
+      try:
+         image = self.__images.get(key)
+         if image is None:
+            self.__misses += 1
+            return None
+         self.__images.move_to_end(key)
+         self.__hits += 1
+      finally:
+         self.__mutex.release()
+      return image.copy()
+
+   def put(self, flight: int, camera: str, position: int, image):
+      if image is None or image.nbytes > self.__max_bytes:
+         return
+      key = (flight, camera, position)
+      image = image.copy()
+      self.__mutex.acquire()
+      try:
+         previous = self.__images.pop(key, None)
+         if previous is not None:
+            self.__bytes -= previous.nbytes
+         self.__images[key] = image
+         self.__bytes += image.nbytes
+         while self.__bytes > self.__max_bytes:
+            self.__bytes -= self.__images.popitem(last=False)[1].nbytes
+            self.__evictions += 1
+      finally:
+         self.__mutex.release()
+
+   def invalidate(self, flight: int):
+      ''' Forget the frames of flight, before it is shot again '''
+      self.__mutex.acquire()
+      try:
+         for key in [key for key in self.__images if key[0] == flight]:
+            self.__bytes -= self.__images.pop(key).nbytes
+      finally:
+         self.__mutex.release()
+
+   def get_stats(self) -> dict:
+      self.__mutex.acquire()
+      try:
+         lookups = self.__hits + self.__misses
+         return {
+            "hits": self.__hits,
+            "misses": self.__misses,
+            "hit_rate": round(self.__hits / lookups, 3) if lookups else 0,
+            "evictions": self.__evictions,
+            "frames": len(self.__images),
+            "bytes": self.__bytes,
+            "max_bytes": self.__max_bytes
+         }
+      finally:
+         self.__mutex.release()
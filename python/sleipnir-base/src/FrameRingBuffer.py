@@ -0,0 +1,49 @@
+import simplejpeg
+
+class RingEntry:
+   __slots__ = ('position', 'timestamp', 'jpeg', 'image')
+
+   def __init__(self, position: int, timestamp: int, jpeg, image):
+      self.position = position
+      self.timestamp = timestamp
+      self.jpeg = jpeg
+      self.image = image
+
+class FrameRingBuffer:
+   '''
+   The last capacity frames of one camera as jpeg bytes, optionally with the
+   decoded grayscale image.
+
+   There is one writer (ingest) and any number of readers. A slot is replaced
+   with a single list assignment so readers never take a lock, a reader just
+   checks that the slot still holds the position it asked for.
+   '''
+   def __init__(self, capacity: int, decode: bool = False):
+      self.__capacity = max(1, capacity)
+      self.__decode = decode
+      self.__slots = [None] * self.__capacity
+
+   def get_capacity(self) -> int:
+      return self.__capacity
+
+   def put(self, position: int, timestamp: int, jpeg):
+      image = simplejpeg.decode_jpeg(jpeg, colorspace='GRAY') if self.__decode else None
+      self.__slots[position % self.__capacity] = RingEntry(position, timestamp, jpeg, image)
+
+   def get(self, position: int) -> RingEntry:
+      entry = self.__slots[position % self.__capacity]
+      if entry is None or entry.position != position:
+         return None
+      return entry
+
+   def get_image(self, position: int):
+      ''' Grayscale image of position, a copy the caller may draw on, None if no longer buffered '''
+      entry = self.get(position)
+      if entry is None:
+         return None
+      if entry.image is None:
+         return simplejpeg.decode_jpeg(entry.jpeg, colorspace='GRAY')
+      return entry.image.copy()
+
+   def clear(self):
+      self.__slots = [None] * self.__capacity
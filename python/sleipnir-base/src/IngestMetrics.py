@@ -0,0 +1,85 @@
+from collections import deque
+import time
+
+def percentiles(samples: list, points=(50, 90, 99)) -> dict:
+   ''' Nearest rank percentiles of samples, empty dict without samples '''
+   if not samples:
+      return {}
+   ordered = sorted(samples)
+   result = {}
+   for point in points:
+      index = min(len(ordered) - 1, max(0, int(round(point / 100 * len(ordered))) - 1))
+      result["p" + str(point)] = round(ordered[index], 3)
+   result["max"] = round(ordered[-1], 3)
+   return result
+
+class CameraMetrics:
+   '''
+   Ingest metrics of one camera
+
+   Only recorded and read on the IOLoop so no locking is needed, recording a
+   frame is a couple of deque appends
+   '''
+   # Seconds of arrivals used for fps and bytes/s
+   WINDOW = 2.0
+   # Latency samples kept for percentiles
+   SAMPLES = 1000
+
+   def __init__(self):
+      self.reset()
+
+   def reset(self):
+      # (arrival time, bytes) for the last WINDOW seconds
+      self.__arrivals = deque()
+      self.__request_latency_ms = deque(maxlen=self.SAMPLES)
+      self.__lag_ms = deque(maxlen=self.SAMPLES)
+      self.__frames = 0
+      self.__bytes = 0
+      self.__last_position = 0
+      self.__last_arrival = 0
+      self.__gaps = 0
+      self.__missing = 0
+      # Smallest arrival - timestamp seen, the clocks of camera and base are not synced
+      self.__clock_offset_ms = None
+
+   def record_frame(self, position: int, timestamp: int, size: int):
+      now = time.time()
+      self.__arrivals.append((now, size))
+      while self.__arrivals[0][0] < now - self.WINDOW:
+         self.__arrivals.popleft()
+
+      self.__frames += 1
+      self.__bytes += size
+      self.__last_arrival = now
+
+      if self.__last_position > 0 and position > self.__last_position + 1:
+         self.__gaps += 1
+         self.__missing += position - self.__last_position - 1
+      if position > self.__last_position:
+         self.__last_position = position
+
+      offset_ms = now * 1000 - timestamp
+      if self.__clock_offset_ms is None or offset_ms < self.__clock_offset_ms:
+         self.__clock_offset_ms = offset_ms
+      self.__lag_ms.append(offset_ms - self.__clock_offset_ms)
+
+   def record_request(self, latency_ms: float):
+      self.__request_latency_ms.append(latency_ms)
+
+   def get(self) -> dict:
+      now = time.time()
+      arrivals = [size for arrival, size in self.__arrivals if arrival >= now - self.WINDOW]
+      return {
+         "fps": round(len(arrivals) / self.WINDOW, 1),
+         "bytes_per_second": int(sum(arrivals) / self.WINDOW),
+         "frames": self.__frames,
+         "bytes": self.__bytes,
+         "last_position": self.__last_position,
+         "seconds_since_last_frame": round(now - self.__last_arrival, 3) if self.__last_arrival else None,
+         "frame_gaps": self.__gaps,
+         "missing_frames": self.__missing,
+         "request_latency_ms": percentiles(list(self.__request_latency_ms)),
+         # Arrival lag relative to the fastest frame, the clock offset is the raw arrival - timestamp of that frame
+         "lag_ms": percentiles(list(self.__lag_ms)),
+         "clock_offset_ms": round(self.__clock_offset_ms, 3) if self.__clock_offset_ms is not None else None
+      }
@@ -0,0 +1,359 @@
+from multiprocessing import shared_memory
+import multiprocessing
+from threading import Thread, Lock, Event
+import struct
+import time
+import sys
+
+import CameraServer
+from Frame import Frame
+from CamerasData import CamerasData, ReorderPolicy
+from cameras import camera_number, camera_id
+from database.DB import DB
+from database.FrameWriter import FlushPolicy
+from database.RetentionWorker import RetentionPolicy
+import database.frame_dao as frame_dao
+
+import logging
+logger = logging.getLogger(__name__)
+
+'''
+Runs the camera server in its own process so ingest does not share a GIL with
+the GUI and the analyzers.
+
+The ingest process publishes every frame it receives to a shared memory ring
+per camera, the GUI process reads the rings and feeds its own CamerasData.
+Start and stop go over a pipe, online and shooting status is published in a
+small shared array.
+'''
+
+class SharedFrameRing:
+   '''
+   Fixed size ring of frames in shared memory, one writer and one reader.
+
+   Every slot holds an entry header and up to slot_size bytes of jpeg. The
+   writer clears the sequence number of a slot before it writes it and sets it
+   last, the reader checks the sequence number before and after it copies the
+   slot, so a slot overwritten while read is detected.
+   '''
+   HEADER = struct.Struct('<Q')
+   ENTRY = struct.Struct('<QIIqI')
+
+   def __init__(self, capacity: int, slot_size: int, name: str = None):
+      self.__capacity = capacity
+      self.__slot_size = slot_size
+      size = self.HEADER.size + capacity * (self.ENTRY.size + slot_size)
+      if name is None:
+         self.__shm = shared_memory.SharedMemory(create=True, size=size)
+      else:
+         self.__shm = shared_memory.SharedMemory(name=name)
+
+   def get_name(self) -> str:
+      return self.__shm.name
+
+   def get_head(self) -> int:
+      ''' Number of frames written '''
+      return self.HEADER.unpack_from(self.__shm.buf, 0)[0]
+
+   def __offset(self, index: int) -> int:
+      return self.HEADER.size + (index % self.__capacity) * (self.ENTRY.size + self.__slot_size)
+
+   def write(self, flight: int, position: int, timestamp: int, jpeg):
+      buf = self.__shm.buf
+      head = self.get_head()
+      offset = self.__offset(head)
+      ''' A jpeg larger than a slot is published without image, the reader gets it from the database '''
+      length = len(jpeg) if jpeg is not None and len(jpeg) <= self.__slot_size else 0
+
+      self.ENTRY.pack_into(buf, offset, 0, 0, 0, 0, 0)
+      if length:
+         buf[offset + self.ENTRY.size:offset + self.ENTRY.size + length] = jpeg
+      self.ENTRY.pack_into(buf, offset, head + 1, flight, position, timestamp, length)
+      self.HEADER.pack_into(buf, 0, head + 1)
+
+   def read(self, index: int) -> tuple:
+      ''' (flight, position, timestamp, jpeg or None) of frame index, None if it has been overwritten '''
+      buf = self.__shm.buf
+      offset = self.__offset(index)
+      seq, flight, position, timestamp, length = self.ENTRY.unpack_from(buf, offset)
+      if seq != index + 1:
+         return None
+      jpeg = bytes(buf[offset + self.ENTRY.size:offset + self.ENTRY.size + length]) if length else None
+      if self.ENTRY.unpack_from(buf, offset)[0] != seq:
+         return None
+      return (flight, position, timestamp, jpeg)
+
+   def get_capacity(self) -> int:
+      return self.__capacity
+
+   def close(self, unlink: bool = False):
+      self.__shm.close()
+      if unlink:
+         self.__shm.unlink()
+
+# Layout of the shared status array
+STATUS_HEARTBEAT = 0
+STATUS_REQUEST_PICTURES = 1
+STATUS_LAST_PICTURE_TIMESTAMP = 2
+STATUS_ONLINE = 3
+
+class PublishingCamerasData(CamerasData):
+   ''' CamerasData of the ingest process, publishes every frame to the shared ring of its camera '''
+   def __init__(self, db: DB, flight: int, cameras: list, reorder_policy: ReorderPolicy, rings: dict):
+      super().__init__(db, flight, cameras, reorder_policy, 1, False)
+      self.__flight = flight
+      self.__rings = rings # type: dict[str, SharedFrameRing]
+
+   def add_frame(self, frame: Frame) -> bool:
+      self.__rings[camera_id(frame.get_camera())].write(
+         self.__flight, frame.get_position(), frame.get_timestamp(), frame.get_image())
+      return super().add_frame(frame)
+
+def __answer_flush(conn):
+   conn.send(CameraServer.flush_frames(IngestProcessProxy.COMMAND_TIMEOUT / 2))
+
+def ingest_process_main(save_path: str, segments: bool, read_cache_mb: int, read_mmap_mb: int, cameras: list, flush_policy: FlushPolicy, retention_policy: RetentionPolicy,
+      reorder_policy: ReorderPolicy, ring_names: dict, ring_capacity: int, slot_size: int, status, conn):
+   ''' Entry point of the ingest process '''
+   logging.basicConfig(
+      stream=sys.stderr,
+      level=logging.INFO,
+      format='%(asctime)s -  %(levelname)s - %(name)s - %(processName)s - %(threadName)s - %(message)s')
+   logging.getLogger('tornado.access').disabled = True
+
+   rings = {}
+   for cam in cameras:
+      rings[cam] = SharedFrameRing(ring_capacity, slot_size, ring_names[cam])
+
+   db = DB(save_path, segments, read_cache_mb, read_mmap_mb)
+   CameraServer.start_server(db, cameras, flush_policy, retention_policy)
+   while CameraServer.ServerData.ioloop is None:
+      time.sleep(0.01)
+
+   running = True
+   while running:
+      ''' Publish status '''
+      status[STATUS_HEARTBEAT] = time.time()
+      status[STATUS_REQUEST_PICTURES] = 1.0 if CameraServer.ServerData.request_pictures_from_camera else 0.0
+      status[STATUS_LAST_PICTURE_TIMESTAMP] = CameraServer.ServerData.last_picture_timestamp
+      for i, cam in enumerate(cameras):
+         status[STATUS_ONLINE + i] = 1.0 if CameraServer.is_online(cam) else 0.0
+
+      if not conn.poll(0.05):
+         continue
+      command = conn.recv()
+      if command[0] == 'start':
+         flight = command[1]
+         cameras_data = PublishingCamerasData(db, flight, cameras, reorder_policy, rings)
+         conn.send(bool(CameraServer.start_shooting(cameras_data, flight)))
+      elif command[0] == 'stop':
+         CameraServer.stop_shooting()
+         conn.send(True)
+      elif command[0] == 'flush':
+         ''' Waiting here would hold back the heartbeat, the answer is sent once the frames are written '''
+         Thread(target=__answer_flush, args=(conn,), name="Flush", daemon=True).start()
+      elif command[0] == 'quit':
+         running = False
+
+   CameraServer.stop_server()
+   db.stop()
+   for ring in rings.values():
+      ring.close()
+   conn.send(True)
+
+class IngestProcessProxy:
+   '''
+   Stands in for the CameraServer module in the GUI process when ingest runs
+   in its own process, with the same functions
+   '''
+   # Seconds to wait for the ingest process to answer a command
+   COMMAND_TIMEOUT = 30
+
+   def __init__(self, save_path: str, reorder_policy: ReorderPolicy, ring_capacity: int, slot_size: int):
+      self.__save_path = save_path
+      self.__reorder_policy = reorder_policy
+      self.__ring_capacity = max(1, ring_capacity)
+      self.__slot_size = slot_size
+      self.__cameras = []
+      self.__rings = {} # type: dict[str, SharedFrameRing]
+      self.__process = None
+      self.__conn = None
+      # Commands come from the GUI and from the ring reader
+      self.__command_mutex = Lock()
+      self.__status = None
+      self.__db = None
+      self.__cameras_data = None # type: CamerasData
+      self.__flight = 0
+      self.__running = False
+      self.__reader = None
+      # Cameras that lost frames, recovered on their own thread while the rings are drained
+      self.__lost = {}
+      self.__lost_event = Event()
+      self.__recovery = None
+
+   def start_server(self, db: DB, cameras: list, flush_policy: FlushPolicy = None, retention_policy: RetentionPolicy = None):
+      ''' The ingest process opens its own connection to the database, db is used to recover lost frames '''
+      self.__db = db
+      self.__cameras = list(cameras)
+      context = multiprocessing.get_context('spawn')
+      for cam in self.__cameras:
+         self.__rings[cam] = SharedFrameRing(self.__ring_capacity, self.__slot_size)
+      self.__status = context.Array('d', STATUS_ONLINE + len(self.__cameras), lock=False)
+      self.__conn, child_conn = context.Pipe()
+
+      logger.info("Starting ingest process")
+      self.__process = context.Process(
+         target=ingest_process_main,
+         name="Ingest",
+         args=(
+            self.__save_path,
+            db.is_storing_segments(),
+            db.get_read_cache_mb(),
+            db.get_read_mmap_mb(),
+            self.__cameras,
+            flush_policy or FlushPolicy(),
+            retention_policy,
+            self.__reorder_policy,
+            dict((cam, ring.get_name()) for cam, ring in self.__rings.items()),
+            self.__ring_capacity,
+            self.__slot_size,
+            self.__status,
+            child_conn),
+         daemon=True)
+      self.__process.start()
+
+      self.__running = True
+      self.__reader = Thread(target=self.__read_rings, name="IngestReader", daemon=True)
+      self.__reader.start()
+      self.__recovery = Thread(target=self.__recover_lost, name="IngestRecovery", daemon=True)
+      self.__recovery.start()
+
+   def stop_server(self):
+      logger.info("Stopping ingest process")
+      self.__running = False
+      if self.__reader is not None:
+         self.__reader.join()
+      if self.__recovery is not None:
+         self.__lost_event.set()
+         self.__recovery.join()
+      if self.__process is not None and self.__process.is_alive():
+         self.__command(('quit',))
+         self.__process.join(5)
+         if self.__process.is_alive():
+            logger.error("Ingest process did not stop, terminating")
+            self.__process.terminate()
+      for ring in self.__rings.values():
+         ring.close(unlink=True)
+
+   def __command(self, command: tuple):
+      if self.__process is None or not self.__process.is_alive():
+         logger.error("Ingest process is not running")
+         return False
+      self.__command_mutex.acquire()
+      try:
+         self.__conn.send(command)
+         if not self.__conn.poll(self.COMMAND_TIMEOUT):
+            logger.error("Ingest process did not answer " + command[0])
+            return False
+         return self.__conn.recv()
+      finally:
+         self.__command_mutex.release()
+
+   def __is_alive(self) -> bool:
+      return self.__status is not None and time.time() - self.__status[STATUS_HEARTBEAT] < 1
+
+   def is_online(self, cam: str) -> bool:
+      return self.__is_alive() and self.__status[STATUS_ONLINE + self.__cameras.index(cam)] == 1.0
+
+   def is_shooting(self) -> bool:
+      return self.__is_alive() and self.__status[STATUS_REQUEST_PICTURES] == 1.0 and \
+         time.time() - self.__status[STATUS_LAST_PICTURE_TIMESTAMP] < 1
+
+   def is_ready_to_shoot(self) -> bool:
+      for cam in self.__cameras:
+         if not self.is_online(cam):
+            return False
+      return self.__status[STATUS_REQUEST_PICTURES] == 0.0
+
+   def start_shooting(self, cameras_data: CamerasData, flight: int) -> bool:
+      ''' Frames are fed to cameras_data as soon as the ingest process gets them '''
+      self.__cameras_data = cameras_data
+      self.__flight = flight
+      return self.__command(('start', flight))
+
+   def stop_shooting(self):
+      logger.info("Request to stop shooting")
+      self.__command(('stop',))
+
+   def __read_rings(self):
+      ''' Feeds the frames published by the ingest process to the current CamerasData '''
+      tails = {}
+      for cam in self.__cameras:
+         tails[cam] = self.__rings[cam].get_head()
+
+      while self.__running:
+         idle = True
+         for cam in self.__cameras:
+            ring = self.__rings[cam]
+            head = ring.get_head()
+            lost = False
+            if head - tails[cam] > ring.get_capacity():
+               logger.error("Reader lagging behind ingest on " + cam + ", lost " + str(head - tails[cam] - ring.get_capacity()) + " frames")
+               tails[cam] = head - ring.get_capacity()
+               lost = True
+
+            while tails[cam] < head:
+               idle = False
+               entry = ring.read(tails[cam])
+               tails[cam] += 1
+               if entry is None:
+                  ''' Overwritten before it was read '''
+                  lost = True
+                  continue
+               flight, position, timestamp, jpeg = entry
+               cameras_data = self.__cameras_data
+               if flight != self.__flight or cameras_data is None:
+                  continue
+               if not cameras_data.add_frame(Frame(flight, camera_number(cam), position, timestamp, jpeg)):
+                  lost = True
+
+            if lost:
+               self.__lost[cam] = True
+               self.__lost_event.set()
+         if idle:
+            time.sleep(0.002)
+
+   def __recover_lost(self):
+      while self.__running:
+         if not self.__lost_event.wait(0.1):
+            continue
+         self.__lost_event.clear()
+         for cam in self.__cameras:
+            if self.__lost.pop(cam, False):
+               self.__recover(cam)
+
+   def __recover(self, cam: str):
+      '''
+      Frames lost from the ring are added without image from the database,
+      once the ingest process has written what it has got. Positions the
+      database does not have either are given up, CamerasData is reloaded so
+      the frames after them are released
+      '''
+      cameras_data = self.__cameras_data
+      if cameras_data is None:
+         return
+      self.__command(('flush',))
+      while True:
+         start = cameras_data.get_frame_count(cam) + 1
+         end = cameras_data.get_first_pending(cam)
+         added = True
+         for frame in frame_dao.load_range(self.__db, self.__flight, camera_number(cam), start, end, images=False):
+            if not cameras_data.add_frame(frame):
+               added = False
+               break
+         if not added or cameras_data.get_frame_count(cam) < start:
+            if end is not None:
+               cameras_data.resync(cam)
+            return
+         if end is None:
+            return
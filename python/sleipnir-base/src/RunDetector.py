@@ -0,0 +1,107 @@
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Max time in ms from the first gate to the second
+MAX_RUN_TIME = 6000
+
+# Speeds at or above this are not announced
+MAX_ANNOUNCED_SPEED = 500
+
+def speed(distance: float, milliseconds: int) -> float:
+   ''' Speed in km/h over distance meters in milliseconds, 0 for no time '''
+   kilometer = float(distance) / 1000
+   hours = float(milliseconds) / 1000 / 60  / 60
+   if (hours > 0):
+      return kilometer / hours
+   return 0
+
+class RunDetector:
+   '''
+   Turns the motions found on cam1 and cam2 into timed runs
+
+   A run RIGHT starts with a motion to the right on cam1 and ends with one on
+   cam2, a run LEFT the other way around. check returns what the motion did
+   to the run, the caller plays sounds and stores announcements.
+   '''
+   # Results of check
+   IGNORED = None
+   RESET = 'reset'
+   STARTED = 'started'
+   COMPLETED = 'completed'
+
+   def __init__(self):
+      self.reset()
+
+   def reset(self):
+      # None / "LEFT" / "RIGHT"
+      self.run_direction = None
+      self.run_frame_number_cam1 = None
+      self.run_frame_number_cam2 = None
+      # 1 if the last completed run was RIGHT, -1 if LEFT
+      self.completed_direction = 0
+      # time to abort run
+      self.run_abort_timestamp = 0
+
+   def check(self, cam: str, motion: dict) -> str:
+      '''
+      RESET when the camera triggered the wrong way and should track again,
+      STARTED when a run started and COMPLETED when it ended, the frame
+      numbers of the run are in run_frame_number_cam1/2 and its direction in
+      completed_direction
+      '''
+      if cam == "cam1" and self.run_direction == None and motion["direction"] == -1:
+         logger.info("Camera 1 triggered the wrong way for start of run, reseting")
+         return self.RESET
+      if cam == "cam2" and self.run_direction == None and motion["direction"] == 1:
+         logger.info("Camera 2 triggered the wrong way for start of run, reseting")
+         return self.RESET
+      if cam == "cam1" and self.run_direction == 'LEFT' and motion["direction"] == 1:
+         logger.info("Camera 1 triggered the wrong way in run, reseting")
+         return self.RESET
+      if cam == "cam2" and self.run_direction == 'RIGHT' and motion["direction"] == -1:
+         logger.info("Camera 2 triggered the wrong way in run, reseting")
+         return self.RESET
+
+      # Check right run
+      if cam == "cam1" and self.run_direction == None and motion["direction"] == 1:
+         self.run_frame_number_cam1 = motion["frame_number"]
+         self.run_frame_number_cam2 = 0
+         self.run_direction = "RIGHT"
+         self.run_abort_timestamp = int(round(time.time() * 1000)) + MAX_RUN_TIME
+         logger.info("Initiating time run from cam 1 -->")
+         return self.STARTED
+
+      if cam == "cam2" and self.run_direction == "RIGHT" and motion["direction"] == 1:
+         self.run_frame_number_cam2 = motion["frame_number"]
+         self.run_direction = None
+         self.completed_direction = 1
+         logger.info("Timed run completed on cam 2 -->")
+         return self.COMPLETED
+
+      # Check left run
+      if cam == "cam2" and self.run_direction == None and motion["direction"] == -1:
+         self.run_frame_number_cam2 = motion["frame_number"]
+         self.run_frame_number_cam1 = 0
+         self.run_direction = "LEFT"
+         self.run_abort_timestamp = int(round(time.time() * 1000)) + MAX_RUN_TIME
+         logger.info("Initiating time run from cam 2 <--")
+         return self.STARTED
+
+      if cam == "cam1" and self.run_direction == "LEFT" and motion["direction"] == -1:
+         self.run_frame_number_cam1 = motion["frame_number"]
+         self.run_direction = None
+         self.completed_direction = -1
+         logger.info("Timed run completed on cam 1 <--")
+         return self.COMPLETED
+
+      return self.IGNORED
+
+   def check_timeout(self) -> bool:
+      ''' Abort a run not completed in time, True if it was aborted '''
+      if self.run_direction is not None and self.run_abort_timestamp < int(round(time.time() * 1000)):
+         logger.info("Aborting run due to timeout")
+         self.run_direction = None
+         return True
+      return False
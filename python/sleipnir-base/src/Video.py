@@ -1,19 +1,24 @@
 from PySide2 import QtCore, QtGui
 import cv2 as cv
 from database.DB import DB
-import database.frame_dao as frame_dao
-import simplejpeg
-import math
+from database.ThumbnailWriter import FACTOR as THUMBNAIL_FACTOR
+from MotionAnalyzer import MotionTracker
+from FrameCache import FrameCache
 
 from function_timer import timer
 
 import logging
 logger = logging.getLogger(__name__)
 
+# The full frame is shown when the slider has not moved for this long
+SLIDER_SETTLE_MS = 150
+
 class Video:
-   def __init__(self, db: DB, cam: str, flight: int, max_dive_angle: float, widgetVideo, buttonPlayForward, buttonPlayBackward, buttonPause, buttonFind, buttonForwardStep, buttonBackStep, slider, buttonCopy, labelTime):
+   def __init__(self, db: DB, cam: str, flight: int, max_dive_angle: float, widgetVideo, buttonPlayForward, buttonPlayBackward, buttonPause, buttonFind, buttonForwardStep, buttonBackStep, slider, buttonCopy, labelTime, frame_cache: FrameCache = None):
 
       self.__db = db
+      # Decoded frames shared with the sibling video, None to decode every time
+      self.__frame_cache = frame_cache
       self.__flight = flight
       self.__max_dive_angle = max_dive_angle
 
@@ -23,10 +28,6 @@ class Video:
       # Find flag
       self.find = False
 
-      # Motion direction
-      self.direction = 0
-      self.currently_tracking = 0
-
       # Currently shooting
       self.shooting = False
 
@@ -60,6 +61,7 @@ class Video:
       self.buttonPause.clicked.connect(self.__onPause)
       self.slider = slider
       self.slider.sliderMoved.connect(self.__onSliderChanged)
+      self.slider.sliderReleased.connect(self.__onSliderSettled)
       self.buttonCopy = buttonCopy
       self.buttonCopy.clicked.connect(self.__onCopy)
       self.labelTime = labelTime
@@ -68,8 +70,13 @@ class Video:
       self.timer = QtCore.QTimer(self.widgetVideo)
       self.timer.timeout.connect(self.__timerplay)
 
-      # Setup worker thread (reason to have this is to utilize multicore)
-      self.analyzer_worker = AnalyzerWorker(self.cam)
+      # Thumbnails are shown while the slider is dragged, the full frame once it settles
+      self.settle_timer = QtCore.QTimer(self.widgetVideo)
+      self.settle_timer.setSingleShot(True)
+      self.settle_timer.timeout.connect(self.__onSliderSettled)
+
+      # Motion tracking on a worker thread (reason to have this is to utilize multicore)
+      self.motion_tracker = MotionTracker(self.cam, self.__max_dive_angle)
 
    # Sibling video is the Video instance of the other camera
    def set_sibling_video(self, sibling_video):
@@ -79,11 +86,9 @@ class Video:
    def reset(self):
       self.current_frame_number = 1
       self.find = False
-      self.direction = 0
 
    # Set this Video instance to shooting, mening realtime view of data
    def set_shooting(self, shooting):
-      self.direction = 0
       self.shooting = shooting
       if (self.shooting):
          self.buttonPlayForward.setEnabled(False)
@@ -97,7 +102,7 @@ class Video:
 
       if (self.shooting == False):
          self.slider.setMinimum(1)
-         self.slider.setMaximum(self.cameras_data.get_last_frame(self.cam).get_position())
+         self.slider.setMaximum(self.cameras_data.get_frame_count(self.cam))
          self.buttonPlayForward.setEnabled(True)
          self.buttonPlayBackward.setEnabled(True)
          self.buttonFind.setEnabled(True)
@@ -118,47 +123,63 @@ class Video:
    # Returns a video frame as a cv image and it's timestamp
    @timer("Time to read jpeg", logging.INFO, identifier='cam', average=1000)
    def __get_frame(self, cam, position):
-      timestamp = self.cameras_data.get_frame(cam, position).get_timestamp()
-      frame = frame_dao.load(self.__db, self.__flight, 1 if self.cam == 'cam1' else 2, position)
-      if frame is None: return
-      image_cv = simplejpeg.decode_jpeg(frame.get_image(), colorspace='GRAY')
+      timestamp = self.cameras_data.get_timestamp(cam, position)
+      ''' Stored frames are cached once decoded, live frames already come from memory '''
+      cache = self.__frame_cache if not self.shooting else None
+      image_cv = cache.get(self.cameras_data.get_flight(), cam, position) if cache is not None else None
+      if image_cv is None:
+         image_cv = self.cameras_data.get_image(cam, position)
+         ''' Retention leaves only the thumbnail of frames away from announcements '''
+         if image_cv is None: return self.__get_thumbnail(cam, position)
+         if cache is not None: cache.put(self.cameras_data.get_flight(), cam, position, image_cv)
 
       return {"frame_number": position, "timestamp": int(timestamp), "image": image_cv }
 
+   # Returns a thumbnail scaled to the frame size and it's timestamp, the full frame when it has no thumbnail
+   def __get_preview(self, cam, position):
+      preview = self.__get_thumbnail(cam, position)
+      if preview is None: return self.__get_frame(cam, position)
+      return preview
+
+   def __get_thumbnail(self, cam, position):
+      thumbnail = self.cameras_data.get_thumbnail(cam, position)
+      if thumbnail is None: return
+      image_cv = cv.resize(thumbnail, None, fx=THUMBNAIL_FACTOR, fy=THUMBNAIL_FACTOR, interpolation=cv.INTER_LINEAR)
+
+      return {"frame_number": position, "timestamp": int(self.cameras_data.get_timestamp(cam, position)), "image": image_cv }
+
    # Set the start timestamp
    def setStartTimestamp(self, start_timestamp):
       self.start_timestamp = start_timestamp
 
    # Copy button, set the timestamp of the sibling video to this on
    def __onCopy(self):
-      timestamp_this = self.cameras_data.get_frame(self.cam, self.current_frame_number).get_timestamp()
-      for i in range(1, self.cameras_data.get_last_frame(self.sibling_video.cam).get_position() + 1):
-         timestamp_sibling = self.cameras_data.get_frame(self.sibling_video.cam, i).get_timestamp()
-         if timestamp_sibling >= timestamp_this:
-            break
-      self.sibling_video.view_frame(i)
-      self.sibling_video.direction = 0
+      timestamp_this = self.cameras_data.get_timestamp(self.cam, self.current_frame_number)
+      position = self.cameras_data.get_position_at(self.sibling_video.cam, timestamp_this or 0)
+      if position is not None:
+         self.sibling_video.view_frame(position)
 
    def __onSliderChanged(self, value):
-      self.direction = 0
       self.current_frame_number = value
-      self.__update(self.__get_frame(self.cam, self.current_frame_number))
+      self.__update(self.__get_preview(self.cam, self.current_frame_number))
       self.timer.stop()
+      self.settle_timer.start(SLIDER_SETTLE_MS)
+
+   def __onSliderSettled(self):
+      self.settle_timer.stop()
+      self.__update(self.__get_frame(self.cam, self.current_frame_number))
 
    def __onPlayForward(self):
-      self.direction = 0
       self.find = False
       self.forward = True
       self.timer.start(11)
 
    def __onPlayBackward(self):
-      self.direction = 0
       self.find = False
       self.forward = False
       self.timer.start(11)
 
    def __onPause(self):
-      self.direction = 0
       self.timer.stop()
       self.__update(self.__get_frame(self.cam, self.current_frame_number))
 
@@ -168,14 +189,12 @@ class Video:
       self.timer.start(0)
 
    def __onForwardStep(self):
-      self.direction = 0
-      if self.current_frame_number < self.cameras_data.get_last_frame(self.cam).get_position():
+      if self.current_frame_number < self.cameras_data.get_frame_count(self.cam):
          self.current_frame_number += 1
       self.timer.stop()
       self.__update(self.__get_frame(self.cam, self.current_frame_number))
 
    def __onBackStep(self):
-      self.direction = 0
       if self.current_frame_number > 1:
          self.current_frame_number -= 1
       self.timer.stop()
@@ -184,14 +203,14 @@ class Video:
    def __timerplay(self):
       if self.forward:
          self.current_frame_number += 1
-         if self.cameras_data.get_last_frame(self.cam) is None or self.current_frame_number > self.cameras_data.get_last_frame(self.cam).get_position():
-            self.current_frame_number = self.cameras_data.get_last_frame(self.cam).get_position()
+         if self.current_frame_number > self.cameras_data.get_frame_count(self.cam):
+            self.current_frame_number = self.cameras_data.get_frame_count(self.cam)
             self.find = False
             self.timer.stop()
             self.__update(self.__get_frame(self.cam, self.current_frame_number))
       else:
          self.current_frame_number -= 1
-         if self.cameras_data.get_last_frame(self.cam) is None or self.current_frame_number < 1:
+         if self.cameras_data.get_frame_count(self.cam) == 0 or self.current_frame_number < 1:
             self.current_frame_number  =1
             self.find = False
             self.timer.stop()
@@ -202,8 +221,8 @@ class Video:
       if not frame:
          return
       if self.forward:
-         self.analyzer_worker.wait()
-         motion = self.__have_motion(frame['image'])
+         self.motion_tracker.wait()
+         motion = self.motion_tracker.have_motion(frame['image'], self.current_frame_number, self.groundlevel)
          if motion is not None and self.find:
             frame['image'] = motion["image"]
             if motion["motion"]:
@@ -220,16 +239,14 @@ class Video:
       self.__update(self.__get_frame(self.cam, self.current_frame_number))
 
    def is_analyzer_running(self) -> bool:
-      return self.analyzer_worker.isRunning()
+      return self.motion_tracker.is_running()
 
    def view_frame_motion_track(self, frame_number, live_preview = True):
-      if self.currently_tracking > 0: self.currently_tracking -= 1
-
       self.current_frame_number = frame_number
       frame = self.__get_frame(self.cam, self.current_frame_number)
       if not frame:
          return
-      motion = self.__have_motion(frame["image"])
+      motion = self.motion_tracker.track(frame["image"], self.current_frame_number, self.groundlevel)
       if (motion is None):
          return None
 
@@ -237,38 +254,7 @@ class Video:
       # Only show every 3 frame
       if live_preview and self.current_frame_number % 3 == 0:
          self.__update(frame)
-      if self.currently_tracking == 0 and motion["motion"]:
-         self.currently_tracking = 90 * 6
-         return { 
-            "frame_number": motion["frame_number"], 
-            "direction": self.direction / (1 if self.direction == 0 else abs(self.direction)) }
-      return None
-
-   # Find if an image have motion
-   def __have_motion(self, image_cv):
-      if (image_cv is None):
-         logger.error("Image lost on camera " + self.cam + " image_cv == None")
-         return None
-
-      if self.analyzer_worker.isRunning():
-         logger.error("Analyzer still running on camera " + self.cam)
-         return None
- 
-      msg = self.analyzer_worker.get_analyzer_done_message()
-
-      image = msg.get_image()
-      self.direction = msg.get_direction()
-      found_motion = msg.have_motion()
-      found_motion_position = msg.get_position()
-
-      msg = AnalyzerDoMessage(image_cv, self.current_frame_number, self.groundlevel, self.__max_dive_angle)
-      self.analyzer_worker.do_processing(msg)
-
-      return { 
-         "motion": found_motion, 
-         "image": image, 
-         "frame_number": found_motion_position
-         }
+      return motion["run"]
 
    def __update(self, frame):
       if not frame:
@@ -294,211 +280,3 @@ class Video:
 
    def __format_time(self, ms):
       return "%02d:%02d:%03d" % (int(ms / 1000) / 60, int(ms / 1000) % 60, ms % 1000)
-
-class AnalyzerDoMessage:
-   __image = None
-   __position = 0
-   __ground_level = 0
-   __max_dive_angle = 0
-
-   def __init__(self, image, position, ground_level, max_dive_angle):
-      self.__image = image
-      self.__position = position
-      self.__ground_level = ground_level
-      self.__max_dive_angle = max_dive_angle
-   def get_image(self):
-      return self.__image
-   def get_position(self):
-      return self.__position
-   def get_ground_level(self):
-      return self.__ground_level
-   def get_max_dive_angle(self):
-      return self.__max_dive_angle
-
-class AnalyzerDoneMessage:
-   __image = None
-   __direction = 0
-   __position = -1
-
-   def __init__(self, image, direction, position):
-      self.__image = image
-      self.__direction = direction
-      self.__position = position
-
-   def get_image(self):
-      return self.__image
-   def get_direction(self):
-      return self.__direction
-   def get_position(self):
-      return self.__position
-   def have_motion(self):
-      return self.__position != -1
-
-''' Worker thread doing the actual analyzing '''
-class AnalyzerWorker(QtCore.QThread):
-   def __init__(self, cam: str):
-      # "cam1" or "cam2"
-      self.__cam = cam
-
-      # Comparision for motion tracking
-      self.__comparison_image_cv = None
-
-      # Motion boxes for all frames
-      self.__motion_boxes = {}
-
-      # Last frame analyzed
-      self.__last_position = 0
-
-      self.__analyzer_do_message = None
-      # Message to transfer back to main program
-      self.__analyzer_done_message = AnalyzerDoneMessage(None, 0, -1)
-
-      QtCore.QThread.__init__(self)
-      self.setObjectName("Analyzer-" + self.__cam + "-QThread")
-
-   def get_analyzer_done_message(self):
-      return self.__analyzer_done_message
-
-   def do_processing(self, analyzer_do_message: AnalyzerDoMessage):
-      self.__analyzer_do_message = analyzer_do_message
-      self.start()
-
-   def run(self):
-      self.analyze(self.__cam)
-    
-   @timer("Time to analyze", logging.INFO, identifier='cam', average=1000)
-   def analyze(self, cam):
-      position = self.__analyzer_do_message.get_position()
-
-      # We do not want to analyze the same frame twice
-      if position == self.__last_position:
-         return
-
-      # Check to see if we are lagging behind
-      if self.__last_position + 1 != position:
-         logger.warning("Missed frame on camera " + cam + ": " + str(position))
-      self.__last_position = position
-
-      __image_gray_cv = self.__analyzer_do_message.get_image()
-      image_blur_cv = cv.GaussianBlur(__image_gray_cv, (13, 13), 0)
-
-      direction = 0
-      if self.__comparison_image_cv is not None:
-
-         frame_delta = cv.absdiff(self.__comparison_image_cv, image_blur_cv)
-         threshold = cv.threshold(frame_delta, 2, 255, cv.THRESH_BINARY)[1]
-         threshold = cv.dilate(threshold, None, iterations=3)
-         (self.__motion_boxes[position], _) = cv.findContours(threshold.copy(), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
-
-         for c in self.__motion_boxes[position]:
-            (x, y, w, h) = cv.boundingRect(c)
-
-            # No tracking below ground level
-            if y + h > self.__analyzer_do_message.get_ground_level(): continue
-
-            if cv.contourArea(c) < 135 or cv.contourArea(c) > 10000: continue
-
-            found_center_line = True if x < 160 and x + w > 160 else False
-            cv.rectangle(__image_gray_cv, (x - 2, y - 2), (x + w + 4, y + h + 4), (0, 0, 0), 2)
-
-            direction = 0
-            if found_center_line and position > 4:
-               # Check previous motion boxes
-               last_box = Rect()
-               test_frames = 10
-               while True:
-                  if (test_frames > 10):
-                     logger.info("Need to test frames further back(" + str(test_frames)+ ") on frame: " + str(position))
-                  direction = self.__check_overlap_previous(x, y, w, h, x, w, position - 1, test_frames, last_box)
-
-                  # The 0.0000001 will remove a division by zero if x - last_box.x is 0
-                  dive_angle = math.atan(abs(y - last_box.y) / (abs(x - last_box.x) + 0.0000001) ) * 180 / math.pi
-                  if  dive_angle > self.__analyzer_do_message.get_max_dive_angle():
-                     logger.debug("Max dive angle of " + str(self.__analyzer_do_message.get_max_dive_angle()) + "° exceeded on position " + str(position) + " (" +  "{:.2f}".format(dive_angle)+ "°)")
-                     direction = 0
-
-
-                  # Definitely no hit
-                  if direction == 0: break
-
-                  # If the moving object is not passed about half the screen, test more further back, to raise confidence
-                  if last_box.x + (last_box.w / 2) > 80 and last_box.x + (last_box.w / 2) < 240 and test_frames < 30:
-                     test_frames += 10
-                     continue
-
-                  # We have a registered hit!
-                  break
-               if direction != 0: break
-
-      self.__comparison_image_cv = image_blur_cv
-      if direction != 0:
-         logger.info("Motion found: area: " + str(cv.contourArea(c)))
-
-      self.__analyzer_done_message = AnalyzerDoneMessage(
-         __image_gray_cv, 
-         direction,
-         position if direction != 0 else -1)
-
-   def __check_overlap_previous(self, x, y, w, h, x1, w1, position, iterations, rect):
-#      print "check overlap: " + str(frame_number) + " iteration: " + str(iterations)
-      if not position in self.__motion_boxes:
-         return 0
-      for c2 in self.__motion_boxes[position]:
-         (x2, y2, w2, h2) = cv.boundingRect(c2)
-         rect.x = x2
-         rect.y = y2
-         rect.w = w2
-         rect.h = h2
-
-         if cv.contourArea(c2) < 15 or cv.contourArea(c2) > 10000: continue
-
-         if x == x2 and y == y2 and w == w2 and h == h2 :
-            continue
-
-         # Sanity on size
-         if w < 5 or h < 5 or w > 100 or h > 100:
-            continue
-
-         # the sizes of the boxes can't be too far off
-         d1 = float(w * h)
-         d2 = float(w2 * h2)
-         diff = min(d1, d2) / max(d1, d2)
-         if diff < 0.3:
-            continue
- #        print "size diff: " + str(diff)
- 
-         if (self.__overlap_box(x, y, w, h, x2, y2, w2, h2) == 0):
-            continue
-
-         # if iterations is zero or object is coming to close to the side
-         if iterations == 0 or x2 == 0 or x2 + w2 >= 320:
-            if x1 + w1 < x2 + w2:
-               return -1
-            else:
-               return 1
-         return self.__check_overlap_previous(x2, y2, w2, h2, x1, w1, position - 1, iterations -1, rect)
-      return 0
-
-   # Return 0 on non overlap
-   def __overlap_box(self, x, y, w, h, x2, y2, w2, h2):
-      if (x + w < x2):    # c is left of c2
-         return 0
-      if (x > x2 + w2):   # c is right of c2
-         return 0
-      if (y + h < y2):    # c is above c2
-         return 0
-      if (y > y2 + h2):   # c is below c2                        
-         return 0
-
-      # Find direction from first frame
-      if x + w < x2 + w2:
-         return -1
-      else:
-         return 1   
-   
-class Rect:
-   x = 0
-   y = 0
-   w = 0
-   h = 0
-
@@ -0,0 +1,37 @@
+import re
+
+'''
+Camera ids are "cam" followed by the camera number stored in the database.
+
+cam1 and cam2 are the start and end gates shown in the GUI, further cameras
+are intermediate split gates.
+'''
+DEFAULT_CAMERAS = ['cam1', 'cam2']
+
+__re_camera_id = re.compile(r'^cam([1-9][0-9]*)$')
+
+def is_camera_id(cam) -> bool:
+    return isinstance(cam, str) and __re_camera_id.match(cam) is not None
+
+def camera_number(cam: str) -> int:
+    match = __re_camera_id.match(cam)
+    if match is None:
+        raise ValueError("Invalid camera id: " + str(cam))
+    return int(match.group(1))
+
+def camera_id(number: int) -> str:
+    if number < 1:
+        raise ValueError("Invalid camera number: " + str(number))
+    return 'cam' + str(number)
+
+def check_cameras(cameras: list) -> list:
+    ''' Validate a configured list of camera ids, the gate cameras cam1 and cam2 are required '''
+    for cam in cameras:
+        if not is_camera_id(cam):
+            raise ValueError("Invalid camera id: " + str(cam))
+    if len(set(cameras)) != len(cameras):
+        raise ValueError("Duplicate camera id in " + str(cameras))
+    for cam in DEFAULT_CAMERAS:
+        if cam not in cameras:
+            raise ValueError("Camera " + cam + " is required")
+    return list(cameras)
@@ -0,0 +1,156 @@
+from threading import Thread, Event
+import time
+
+import sqlite3
+
+from database.DB import DB
+
+import logging
+logger = logging.getLogger(__name__)
+
+def space_stats(db: DB) -> dict:
+    ''' Size of sleipnir.db and how much of it is free pages '''
+    cur = db.get_read_conn().cursor()
+    try:
+        page_size = cur.execute('PRAGMA page_size').fetchone()[0]
+        page_count = cur.execute('PRAGMA page_count').fetchone()[0]
+        free_pages = cur.execute('PRAGMA freelist_count').fetchone()[0]
+        auto_vacuum = cur.execute('PRAGMA auto_vacuum').fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+    return {
+        "size_bytes": page_size * page_count,
+        "free_bytes": page_size * free_pages,
+        "fragmentation": free_pages / page_count if page_count else 0,
+        "incremental": auto_vacuum == 2
+    }
+
+def page_scatter(db: DB, table: str) -> float:
+    '''
+    Share of the leaf pages of table not following the page before them in key
+    order, 0 when the pages of a flight are read sequentially. Reads every page
+    of the table, None when SQLite is built without dbstat
+    '''
+    cur = db.get_read_conn().cursor()
+    try:
+        pages = [row[0] for row in cur.execute(
+            "SELECT pageno FROM dbstat WHERE name=? AND pagetype='leaf' ORDER BY path", [table])]
+    except sqlite3.OperationalError as e:
+        logger.warning("Unable to read page layout of " + table + ": " + str(e))
+        return None
+    finally:
+        cur.close()
+    if len(pages) < 2:
+        return 0
+    return sum(1 for previous, page in zip(pages, pages[1:]) if page != previous + 1) / (len(pages) - 1)
+
+def reclaim(db: DB, pages: int) -> int:
+    ''' Return up to pages free pages to the file system, returns the bytes reclaimed '''
+    db.acquire_write_lock()
+    cur = db.get_conn().cursor()
+    try:
+        page_size = cur.execute('PRAGMA page_size').fetchone()[0]
+        before = cur.execute('PRAGMA page_count').fetchone()[0]
+        ''' execute stops after the first page, executescript runs the pragma to the end '''
+        cur.executescript('PRAGMA incremental_vacuum(' + str(int(pages)) + ')')
+        return (before - cur.execute('PRAGMA page_count').fetchone()[0]) * page_size
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+        db.release_write_lock()
+
+def compact(db: DB):
+    '''
+    Rebuild sleipnir.db so the pages of every flight are stored together and
+    free pages are returned, and switch it to incremental vacuum. Takes the
+    write lock for as long as copying the database takes, never while shooting
+    '''
+    db.acquire_write_lock()
+    cur = db.get_conn().cursor()
+    try:
+        cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cur.execute('VACUUM')
+        cur.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+        db.release_write_lock()
+
+class Compactor:
+    '''
+    Background thread returning the free pages left by reaped flights to the
+    file system while not shooting
+
+    Pages are reclaimed pages_per_step at a time with a pause in between and
+    only while is_idle() is true, so a shoot starting halfway is not held
+    back. Databases created before incremental vacuum need one compact first,
+    see tools/compact_db.py
+    '''
+    # Seconds between checks for free pages when not woken up
+    INTERVAL = 60
+
+    def __init__(self, db: DB, is_idle, pages_per_step: int = 256, pause_ms: int = 50):
+        self.__db = db
+        self.__is_idle = is_idle
+        self.__pages_per_step = max(1, pages_per_step)
+        self.__pause_ms = max(0, pause_ms)
+        self.__stats = {}
+        self.__reclaimed = 0
+        self.__warned = False
+        self.__wake = Event()
+        self.__running = True
+        self.__thread = Thread(target=self.__run, name="Compactor", daemon=True)
+        self.__thread.start()
+
+    def wake(self):
+        ''' Reclaim now, after shooting has stopped '''
+        self.__wake.set()
+
+    def get_stats(self) -> dict:
+        ''' Space stats from the last check, and bytes reclaimed since start '''
+        return dict(self.__stats)
+
+    def stop(self):
+        logger.info("Stopping compactor")
+        self.__running = False
+        self.__wake.set()
+        self.__thread.join()
+
+    def __run(self):
+        while self.__running:
+            try:
+                self.__reclaim()
+            except Exception as e:
+                logger.error("Unable to reclaim free pages: " + str(e))
+            self.__wake.wait(self.INTERVAL)
+            self.__wake.clear()
+
+    def __reclaim(self):
+        stats = space_stats(self.__db)
+        self.__stats = dict(stats, reclaimed_bytes=self.__reclaimed)
+        if not stats["incremental"]:
+            if not self.__warned:
+                logger.warning("Free pages of the database are not reclaimed until it has been compacted once")
+                self.__warned = True
+            return
+
+        start = time.time()
+        total = 0
+        while self.__running and stats["free_bytes"] > total and self.__is_idle():
+            reclaimed = reclaim(self.__db, self.__pages_per_step)
+            if reclaimed == 0: break
+            total += reclaimed
+            self.__reclaimed += reclaimed
+            time.sleep(self.__pause_ms / 1000)
+
+        if total:
+            self.__stats = dict(space_stats(self.__db), reclaimed_bytes=self.__reclaimed)
+            logger.info("Reclaimed " + format(total / 1024 / 1024, ".1f") + " MB in " + format(time.time() - start, ".3f") + "s, "
+                + format(stats["fragmentation"] * 100, ".1f") + "% of the database was free")
@@ -1,39 +1,77 @@
-from threading import Lock
+from threading import Lock, local, current_thread
 import time
 import os
 
 import sqlite3
 from sqlite3.dbapi2 import OperationalError, connect
 
+from database.SegmentStore import SegmentStore
+
 import logging
 logger = logging.getLogger(__name__)
 
 class DB():
     __write_lock = Lock()
 
-    def __init__(self, save_path):
-        self.__db_version = 1
+    def __init__(self, save_path, segments: bool = False, read_cache_mb: int = 16, read_mmap_mb: int = 256):
+        self.__db_version = 6
+        ''' Upgrades keeping the flight data, from version: function '''
+        self.__upgrades = {
+            1: self.__upgrade_to_2,
+            2: self.__upgrade_to_3,
+            3: self.__upgrade_to_4,
+            4: self.__upgrade_to_5,
+            5: self.__upgrade_to_6
+        }
         logger.info("Opening database" + os.path.join(save_path, 'sleipnir.db'))
-        self.__conn = sqlite3.connect(os.path.join(save_path, 'sleipnir.db'), check_same_thread = False)
+        self.__path = os.path.join(save_path, 'sleipnir.db')
+        self.__conn = sqlite3.connect(self.__path, check_same_thread = False)
 
-        ''' Disable auto vacuum '''
+        ''' Free pages are reclaimed by the Compactor when not shooting, only takes effect on a new or compacted database '''
         cur = self.__conn.cursor()
-        cur.execute('PRAGMA auto_vacuum = NONE')
+        cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
         cur.execute('PRAGMA JOURNAL_MODE = WAL')
         cur.execute('PRAGMA SYNCHRONOUS = NORMAL')
         self.__conn.commit()
         cur.close()
         self.__check_database()
 
+        ''' Frames stored in segment files are readable whatever the storage mode is '''
+        self.__segments = segments
+        self.__segment_store = SegmentStore(os.path.join(save_path, 'segments'))
+        logger.info("Storing images in " + ("segment files" if segments else "the database"))
+
+        ''' Read connections per thread, closed once their thread has ended and all of them by stop '''
+        self.__read_cache_mb = read_cache_mb
+        self.__read_mmap_mb = read_mmap_mb
+        self.__readers = local()
+        self.__read_conns = {} # type: dict[Thread, sqlite3.Connection]
+        self.__read_conns_mutex = Lock()
+
     def acquire_write_lock(self):
         self.__write_lock.acquire()
 
     def release_write_lock(self):
         self.__write_lock.release()
 
+    def is_storing_segments(self) -> bool:
+        return self.__segments
+
+    def get_read_cache_mb(self) -> int:
+        return self.__read_cache_mb
+
+    def get_read_mmap_mb(self) -> int:
+        return self.__read_mmap_mb
+
+    def get_segment_store(self) -> SegmentStore:
+        return self.__segment_store
+
     def __check_database(self):
         current_version = self.__current_database_version()
         logger.info("Current version of DB: " + str(current_version))
+        while current_version in self.__upgrades:
+            self.__upgrades[current_version]()
+            current_version = self.__current_database_version()
         if current_version is None or current_version != self.__db_version:
             logger.warning("Upgrading DB to version " + str(self.__db_version) + ", this will remove all flight data")
             self.__create_tables()
@@ -63,24 +101,29 @@ class DB():
             cur.execute('DROP TABLE IF EXISTS version')
             cur.execute('DROP INDEX IF EXISTS frame_position_idx')
             cur.execute('DROP INDEX IF EXISTS frame_flight_idx')
+            cur.execute('DROP INDEX IF EXISTS frame_generation_idx')
             cur.execute('DROP TABLE IF EXISTS frame')
+            cur.execute('DROP TABLE IF EXISTS frame_meta')
+            cur.execute('DROP TABLE IF EXISTS frame_image')
+            cur.execute('DROP INDEX IF EXISTS frame_thumbnail_idx')
+            cur.execute('DROP TABLE IF EXISTS frame_thumbnail')
+            cur.execute('DROP TABLE IF EXISTS flight')
             cur.execute('DROP TABLE IF EXISTS announcement')
 
-            ''' CREATE image table '''
+            ''' CREATE frame tables '''
+            self.__create_frame_tables(cur)
+            self.__create_thumbnail_table(cur)
+
+            ''' CREATE flight table, frames of older generations than this are retired '''
             cur.execute('''
-                CREATE TABLE frame (
-                    id INTEGER PRIMARY KEY,
-                    flight INTEGER,
-                    camera INTEGER,
-                    position INTEGER,
-                    timestamp INTEGER,
-                    image BLOB
+                CREATE TABLE flight (
+                    flight INTEGER PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    pinned INTEGER NOT NULL DEFAULT 0,
+                    thinned INTEGER NOT NULL DEFAULT 0,
+                    stopped_at REAL
                 )
             ''')
-            ''' Index needed for retrieval of image '''
-            cur.execute('CREATE INDEX frame_position_idx ON frame (position, flight, camera)')
-            ''' Index needed for deleting flight '''
-            cur.execute('CREATE INDEX frame_flight_idx ON frame (flight)')
 
             ''' CREATE announcement table '''
             cur.execute('''
@@ -112,9 +155,194 @@ class DB():
             cur.close()
             self.release_write_lock()
 
+    def __create_frame_tables(self, cur):
+        '''
+        Frame metadata clustered on (flight, generation, camera, position) so
+        lookups, MAX(position) and timestamp scans of a camera are range reads
+        of the key that never touch image pages. The image is either in
+        frame_image or at segment_offset in a segment file
+        '''
+        cur.execute('''
+            CREATE TABLE frame_meta (
+                flight INTEGER NOT NULL,
+                generation INTEGER NOT NULL,
+                camera INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                image_id INTEGER,
+                segment INTEGER,
+                segment_offset INTEGER,
+                segment_length INTEGER,
+                PRIMARY KEY (flight, generation, camera, position)
+            ) WITHOUT ROWID
+        ''')
+        cur.execute('''
+            CREATE TABLE frame_image (
+                id INTEGER PRIMARY KEY,
+                image BLOB
+            )
+        ''')
+
+    def __create_thumbnail_table(self, cur):
+        ''' Small jpeg of a frame for scrubbing, keyed like frame_meta '''
+        cur.execute('''
+            CREATE TABLE frame_thumbnail (
+                id INTEGER PRIMARY KEY,
+                flight INTEGER NOT NULL,
+                generation INTEGER NOT NULL,
+                camera INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                thumbnail BLOB
+            )
+        ''')
+        cur.execute('CREATE UNIQUE INDEX frame_thumbnail_idx ON frame_thumbnail (flight, generation, camera, position)')
+
+    def __upgrade_to_2(self):
+        logger.warning("Upgrading DB to version 2, adding segment files")
+        self.acquire_write_lock()
+        cur = self.__conn.cursor()
+        try:
+            cur.execute('ALTER TABLE frame ADD COLUMN segment INTEGER')
+            cur.execute('ALTER TABLE frame ADD COLUMN segment_offset INTEGER')
+            cur.execute('ALTER TABLE frame ADD COLUMN segment_length INTEGER')
+            cur.execute('UPDATE version SET version = 2')
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            self.__conn.rollback()
+            raise e
+        finally:
+            cur.close()
+            self.release_write_lock()
+
+    def __upgrade_to_3(self):
+        logger.warning("Upgrading DB to version 3, adding flight generations")
+        self.acquire_write_lock()
+        cur = self.__conn.cursor()
+        try:
+            cur.execute('ALTER TABLE frame ADD COLUMN generation INTEGER NOT NULL DEFAULT 0')
+            cur.execute('DROP INDEX IF EXISTS frame_flight_idx')
+            cur.execute('CREATE INDEX frame_generation_idx ON frame (flight, generation)')
+            cur.execute('''
+                CREATE TABLE flight (
+                    flight INTEGER PRIMARY KEY,
+                    generation INTEGER NOT NULL
+                )
+            ''')
+            cur.execute('UPDATE version SET version = 3')
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            self.__conn.rollback()
+            raise e
+        finally:
+            cur.close()
+            self.release_write_lock()
+
+    def __upgrade_to_4(self):
+        logger.warning("Upgrading DB to version 4, moving frames to frame_meta and frame_image, this may take a while")
+        start = time.time()
+        self.acquire_write_lock()
+        cur = self.__conn.cursor()
+        try:
+            cur.execute('BEGIN')
+            self.__create_frame_tables(cur)
+            cur.execute('INSERT INTO frame_image (id, image) SELECT id, image FROM frame WHERE image IS NOT NULL')
+            cur.execute('''
+                INSERT OR IGNORE INTO frame_meta
+                    (flight, generation, camera, position, timestamp, image_id, segment, segment_offset, segment_length)
+                SELECT flight, generation, camera, position, timestamp, CASE WHEN image IS NULL THEN NULL ELSE id END,
+                    segment, segment_offset, segment_length
+                FROM frame ORDER BY id
+            ''')
+            cur.execute('DELETE FROM frame_image WHERE id NOT IN (SELECT image_id FROM frame_meta WHERE image_id IS NOT NULL)')
+            cur.execute('DROP INDEX IF EXISTS frame_position_idx')
+            cur.execute('DROP INDEX IF EXISTS frame_generation_idx')
+            cur.execute('DROP TABLE frame')
+            cur.execute('UPDATE version SET version = 4')
+            self.__conn.commit()
+            logger.info("Upgraded DB to version 4 in " + format(time.time() - start, ".1f") + "s")
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            self.__conn.rollback()
+            raise e
+        finally:
+            cur.close()
+            self.release_write_lock()
+
+    def __upgrade_to_5(self):
+        logger.warning("Upgrading DB to version 5, adding thumbnails")
+        self.acquire_write_lock()
+        cur = self.__conn.cursor()
+        try:
+            self.__create_thumbnail_table(cur)
+            cur.execute('UPDATE version SET version = 5')
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            self.__conn.rollback()
+            raise e
+        finally:
+            cur.close()
+            self.release_write_lock()
+
+    def __upgrade_to_6(self):
+        ''' Flights shot before count as stopped now, so retention thins them like new ones '''
+        logger.warning("Upgrading DB to version 6, adding retention of flights")
+        self.acquire_write_lock()
+        cur = self.__conn.cursor()
+        try:
+            cur.execute('ALTER TABLE flight ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0')
+            cur.execute('ALTER TABLE flight ADD COLUMN thinned INTEGER NOT NULL DEFAULT 0')
+            cur.execute('ALTER TABLE flight ADD COLUMN stopped_at REAL')
+            cur.execute('INSERT OR IGNORE INTO flight (flight, generation) SELECT DISTINCT flight, 0 FROM frame_meta')
+            cur.execute('UPDATE flight SET stopped_at = ?', [time.time()])
+            cur.execute('UPDATE version SET version = 6')
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            self.__conn.rollback()
+            raise e
+        finally:
+            cur.close()
+            self.release_write_lock()
+
     def get_conn(self):
+        ''' The connection for writing, and for reads inside a write transaction '''
         return self.__conn
 
+    def get_read_conn(self):
+        '''
+        Read-only connection of the calling thread. With WAL readers do not
+        wait for the writer or each other, they see what has been committed
+        '''
+        conn = getattr(self.__readers, 'conn', None)
+        if conn is None:
+            conn = self.__open_read_conn()
+            self.__readers.conn = conn
+        return conn
+
+    def __open_read_conn(self):
+        ''' check_same_thread is off only so stop can close it '''
+        conn = sqlite3.connect(self.__path, check_same_thread = False)
+        cur = conn.cursor()
+        cur.execute('PRAGMA query_only = ON')
+        cur.execute('PRAGMA cache_size = ' + str(-int(self.__read_cache_mb) * 1024))
+        cur.execute('PRAGMA mmap_size = ' + str(int(self.__read_mmap_mb) * 1024 * 1024))
+        cur.close()
+        self.__read_conns_mutex.acquire()
+        for thread in [thread for thread in self.__read_conns if not thread.is_alive()]:
+            self.__read_conns.pop(thread).close()
+        self.__read_conns[current_thread()] = conn
+        self.__read_conns_mutex.release()
+        return conn
+
     def stop(self):
         logger.info("Closing database")
+        self.__segment_store.close()
+        self.__read_conns_mutex.acquire()
+        for conn in self.__read_conns.values():
+            conn.close()
+        self.__read_conns = {}
+        self.__read_conns_mutex.release()
         self.__conn.close()
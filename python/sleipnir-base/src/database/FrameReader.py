@@ -0,0 +1,219 @@
+from threading import Lock
+from itertools import islice
+import mmap
+import sqlite3
+import time
+
+from database.DB import DB
+from database.frame_dao import CURRENT_GENERATION
+import database.frame_dao as frame_dao
+
+import logging
+logger = logging.getLogger(__name__)
+
+class FrameReader:
+    '''
+    Reads the jpeg images of one camera of a stored flight without copying
+
+    Segment files are memory mapped and get_image returns a memoryview of the
+    jpeg in the map, ready for the decoder. Where the frames are is read from
+    the database once, and again for positions appended since. Images stored
+    in the database itself are returned as bytes, read PREFETCH_FRAMES at a
+    time with frame_dao.load_range while positions are walked one by one,
+    forward or back, like playback and find do.
+
+    Any number of threads may read while ingest appends, a segment that has
+    grown past its map is mapped again. A map stays alive as long as a
+    memoryview of it is used.
+
+    The flight generation is checked every GENERATION_CHECK_INTERVAL seconds,
+    when a new shoot or retention has moved the frames the maps of the old
+    generation are closed, so its segments can be deleted. close releases
+    every map of a reader no longer used.
+    '''
+    # Seconds between checks whether the frames moved to another generation
+    GENERATION_CHECK_INTERVAL = 1
+    # Images in the database read in one query when walking positions in order
+    PREFETCH_FRAMES = 90
+
+    def __init__(self, db: DB, flight: int, camera: int):
+        self.__db = db
+        self.__flight = flight
+        self.__camera = camera
+        self.__mutex = Lock()
+        # position: (generation, segment, offset, length), segment None for images in the database
+        self.__locations = {}
+        self.__last_position = 0
+        # segment: mmap
+        self.__maps = {}
+        self.__generation = None
+        self.__next_check = 0
+        # position: image read ahead from the database, None for a frame without image
+        self.__prefetched = {}
+        self.__last_loaded = 0
+
+    def get_image(self, position: int):
+        ''' memoryview of the jpeg of position, None if it is not stored '''
+        if time.monotonic() >= self.__next_check:
+            self.__mutex.acquire()
+            try:
+                self.__check_generation()
+            finally:
+                self.__mutex.release()
+        return self.__get_image(position, True)
+
+    def close(self):
+        ''' Release the maps, a reader used again maps its segments again '''
+        self.__mutex.acquire()
+        try:
+            self.__reset()
+            self.__generation = None
+            self.__next_check = 0
+        finally:
+            self.__mutex.release()
+
+    def __get_image(self, position: int, reload: bool):
+        location = self.__locations.get(position)
+        if location is None:
+            self.__mutex.acquire()
+            try:
+                self.__load_locations()
+                if position not in self.__locations and position < self.__last_position:
+                    ''' Batches may commit a frame after a later one was loaded '''
+                    self.__load_locations(position)
+            finally:
+                self.__mutex.release()
+            location = self.__locations.get(position)
+            if location is None:
+                return None
+
+        generation, segment, offset, length = location
+        if segment is None:
+            return self.__load_image(position)
+
+        segment_map = self.__maps.get(segment)
+        if segment_map is None or offset + length > len(segment_map):
+            self.__mutex.acquire()
+            try:
+                segment_map = self.__map(generation, segment, offset + length)
+                if segment_map is None and reload:
+                    ''' Retention may have moved the frames to a new generation '''
+                    self.__locations = {}
+                    self.__last_position = 0
+                    self.__load_locations()
+            finally:
+                self.__mutex.release()
+            if segment_map is None:
+                return self.__get_image(position, False) if reload else None
+        try:
+            return memoryview(segment_map)[offset:offset + length]
+        except ValueError:
+            ''' Closed by close or a new generation meanwhile '''
+            return self.__get_image(position, False) if reload else None
+
+    def __check_generation(self):
+        ''' Forget the locations and maps of an earlier generation, called with the mutex held '''
+        self.__next_check = time.monotonic() + self.GENERATION_CHECK_INTERVAL
+        cur = self.__db.get_read_conn().cursor()
+        try:
+            row = cur.execute('SELECT generation FROM flight WHERE flight=?', [self.__flight]).fetchone()
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            raise e
+        finally:
+            cur.close()
+        generation = row[0] if row is not None else 0
+        if generation != self.__generation:
+            if self.__generation is not None:
+                logger.debug("Frames of flight " + str(self.__flight) + " moved to generation " + str(generation))
+            self.__reset()
+            self.__generation = generation
+
+    def __reset(self):
+        ''' Called with the mutex held '''
+        for segment_map in self.__maps.values():
+            try:
+                segment_map.close()
+            except BufferError:
+                ''' Still shown or decoded, closed once the last memoryview is gone '''
+                pass
+        self.__maps = {}
+        self.__locations = {}
+        self.__last_position = 0
+        self.__prefetched = {}
+
+    def __load_locations(self, position: int = None):
+        ''' Locations of the positions after the last one loaded, or of position only. Called with the mutex held '''
+        cur = self.__db.get_read_conn().cursor()
+        try:
+            rows = cur.execute(
+                '''SELECT position, generation, segment, segment_offset, segment_length FROM frame_meta
+                   WHERE flight=? AND generation=''' + CURRENT_GENERATION + ''' AND camera=? AND ''' +
+                   ('position>?' if position is None else 'position=?'),
+                [self.__flight,
+                self.__flight,
+                self.__camera,
+                self.__last_position if position is None else position]).fetchall()
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            raise e
+        finally:
+            cur.close()
+
+        for position, generation, segment, offset, length in rows:
+            self.__locations[position] = (generation, segment, offset, length)
+            if position > self.__last_position: self.__last_position = position
+
+    def __map(self, generation: int, segment: int, size: int) -> mmap.mmap:
+        ''' Map of segment covering size bytes, the last map is kept for readers already using it '''
+        segment_map = self.__maps.get(segment)
+        if segment_map is not None and size <= len(segment_map):
+            return segment_map
+        path = self.__db.get_segment_store().get_segment_path(self.__flight, generation, self.__camera, segment)
+        try:
+            with open(path, 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            logger.error("Unable to map segment " + path + ": " + str(e))
+            return None
+        if size > len(segment_map):
+            return None
+        self.__maps[segment] = segment_map
+        return segment_map
+
+    def __load_image(self, position: int) -> bytes:
+        prefetched = self.__prefetched
+        step = position - self.__last_loaded
+        self.__last_loaded = position
+        if position in prefetched:
+            return prefetched[position]
+        if step == 1:
+            frames = frame_dao.load_range(self.__db, self.__flight, self.__camera, position,
+                fetch_size=self.PREFETCH_FRAMES)
+        elif step == -1:
+            frames = frame_dao.load_range(self.__db, self.__flight, self.__camera, max(1, position - self.PREFETCH_FRAMES + 1),
+                position + 1, fetch_size=self.PREFETCH_FRAMES, reverse=True)
+        else:
+            return self.__load_one_image(position)
+        ''' islice stops before the iterator queries the next fetch '''
+        prefetched = {frame.get_position(): frame.get_image() for frame in islice(frames, self.PREFETCH_FRAMES)}
+        self.__prefetched = prefetched
+        return prefetched.get(position)
+
+    def __load_one_image(self, position: int) -> bytes:
+        cur = self.__db.get_read_conn().cursor()
+        try:
+            row = cur.execute(
+                '''SELECT frame_image.image FROM frame_meta JOIN frame_image ON frame_image.id = frame_meta.image_id
+                   WHERE frame_meta.flight=? AND frame_meta.generation=''' + CURRENT_GENERATION + '''
+                       AND frame_meta.camera=? AND frame_meta.position=?''',
+                [self.__flight,
+                self.__flight,
+                self.__camera,
+                position]).fetchone()
+            return row[0] if row is not None else None
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            raise e
+        finally:
+            cur.close()
@@ -0,0 +1,62 @@
+from threading import Thread, Event
+import time
+
+from database.DB import DB
+import database.frame_dao as frame_dao
+
+import logging
+logger = logging.getLogger(__name__)
+
+class FrameReaper:
+    '''
+    Background thread deleting the frames of retired flight generations
+
+    Frames are deleted chunk_size at a time with a pause in between, so the
+    write lock is never held long enough to hold back the frame writer.
+    Segment files of a retired generation are removed once its frames are gone.
+    '''
+    # Seconds between checks for retired frames when not woken up
+    INTERVAL = 60
+
+    def __init__(self, db: DB, chunk_size: int = 500, pause_ms: int = 20):
+        self.__db = db
+        self.__chunk_size = max(1, chunk_size)
+        self.__pause_ms = max(0, pause_ms)
+        self.__wake = Event()
+        self.__running = True
+        self.__thread = Thread(target=self.__run, name="FrameReaper", daemon=True)
+        self.__thread.start()
+
+    def wake(self):
+        ''' Start reaping now, after a flight has been retired '''
+        self.__wake.set()
+
+    def stop(self):
+        logger.info("Stopping frame reaper")
+        self.__running = False
+        self.__wake.set()
+        self.__thread.join()
+
+    def __run(self):
+        while self.__running:
+            try:
+                self.__reap()
+            except Exception as e:
+                logger.error("Unable to reap retired frames: " + str(e))
+            self.__wake.wait(self.INTERVAL)
+            self.__wake.clear()
+
+    def __reap(self):
+        start = time.time()
+        total = 0
+        while self.__running:
+            deleted = frame_dao.reap(self.__db, self.__chunk_size)
+            total += deleted
+            if deleted < self.__chunk_size: break
+            time.sleep(self.__pause_ms / 1000)
+
+        if not self.__running: return
+        for flight, generation in frame_dao.load_generations(self.__db):
+            self.__db.get_segment_store().delete_retired(flight, generation)
+        if total:
+            logger.info("Reaped " + str(total) + " retired frames in " + format(time.time() - start, ".3f") + "s")
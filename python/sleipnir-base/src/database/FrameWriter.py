@@ -0,0 +1,172 @@
+from threading import Thread, Lock, Event
+from collections import deque
+import queue
+import time
+
+from database.DB import DB
+import database.frame_dao as frame_dao
+from Frame import Frame
+
+from function_timer import timer
+
+import logging
+logger = logging.getLogger(__name__)
+
+class FlushPolicy:
+    ''' A batch is committed when it holds max_frames frames or when the oldest frame has waited max_delay_ms '''
+    def __init__(self, max_frames: int = 45, max_delay_ms: int = 250, queue_size: int = 1000):
+        self.max_frames = max(1, max_frames)
+        self.max_delay_ms = max(0, max_delay_ms)
+        self.queue_size = max(1, queue_size)
+
+class FrameWriter:
+    '''
+    Background thread writing frames to the database in batches, one
+    transaction per batch. A batch that cannot be written is tried again
+    WRITE_ATTEMPTS times, then it is dropped and on_dropped(frames) is called
+    '''
+    __STOP = object()
+    WRITE_ATTEMPTS = 3
+    # Seconds to wait before the first retry, doubled for every further one
+    RETRY_DELAY = 0.1
+
+    def __init__(self, db: DB, policy: FlushPolicy = None, on_dropped=None):
+        self.__db = db
+        self.__policy = policy or FlushPolicy()
+        self.__on_dropped = on_dropped
+        self.__queue = queue.Queue(self.__policy.queue_size)
+
+        # Statistics
+        self.__stats_mutex = Lock()
+        self.__frames_written = 0
+        self.__frames_dropped = 0
+        self.__batches_written = 0
+        self.__last_batch_size = 0
+        self.__max_batch_size = 0
+        self.__max_queue_depth = 0
+        self.__last_commit_ms = 0.0
+        # Recent commit times and per camera times from put to commit, in ms
+        self.__commit_ms = deque(maxlen=100)
+        self.__write_latency_ms = {} # type: dict[int, deque]
+
+        self.__thread = Thread(target=self.__run, name="FrameWriter", daemon=True)
+        self.__thread.start()
+        logger.info("Frame writer started, batch " + str(self.__policy.max_frames) + " frames or " +
+            str(self.__policy.max_delay_ms) + "ms, queue size " + str(self.__policy.queue_size))
+
+    def put(self, frame: Frame):
+        ''' Queue a frame for writing, blocks when the queue is full '''
+        if self.__queue.full():
+            logger.warning("Frame writer queue is full, storage is lagging behind")
+        self.__queue.put((frame, time.perf_counter()))
+        depth = self.__queue.qsize()
+        if depth > self.__max_queue_depth: self.__max_queue_depth = depth
+
+    def flush(self, wait: bool = False, timeout: float = None) -> bool:
+        ''' Commit everything queued so far, optionally wait until it is written '''
+        done = Event()
+        self.__queue.put(done)
+        if not wait: return True
+        return done.wait(timeout)
+
+    def stop(self):
+        logger.info("Stopping frame writer")
+        self.__queue.put(self.__STOP)
+        self.__thread.join()
+
+    def get_queue_depth(self) -> int:
+        return self.__queue.qsize()
+
+    def get_stats(self) -> dict:
+        self.__stats_mutex.acquire()
+        stats = {
+            "queue_depth": self.__queue.qsize(),
+            "max_queue_depth": self.__max_queue_depth,
+            "frames_written": self.__frames_written,
+            "frames_dropped": self.__frames_dropped,
+            "batches_written": self.__batches_written,
+            "last_batch_size": self.__last_batch_size,
+            "max_batch_size": self.__max_batch_size,
+            "average_batch_size": self.__frames_written / self.__batches_written if self.__batches_written else 0,
+            "last_commit_ms": self.__last_commit_ms
+        }
+        self.__stats_mutex.release()
+        return stats
+
+    def get_commit_latencies(self) -> list:
+        ''' Recent times in ms to commit a batch '''
+        self.__stats_mutex.acquire()
+        latencies = list(self.__commit_ms)
+        self.__stats_mutex.release()
+        return latencies
+
+    def get_write_latencies(self, camera: int) -> list:
+        ''' Recent times in ms from a frame of the camera was queued until it was committed '''
+        self.__stats_mutex.acquire()
+        latencies = list(self.__write_latency_ms.get(camera, []))
+        self.__stats_mutex.release()
+        return latencies
+
+    def __run(self):
+        batch = []
+        deadline = 0
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                item = self.__queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self.__STOP:
+                self.__write(batch)
+                return
+
+            if isinstance(item, Event):
+                self.__write(batch)
+                batch = []
+                item.set()
+                continue
+
+            if item is not None:
+                if not batch: deadline = time.monotonic() + self.__policy.max_delay_ms / 1000
+                batch.append(item)
+
+            if len(batch) >= self.__policy.max_frames or (batch and time.monotonic() >= deadline):
+                self.__write(batch)
+                batch = []
+
+    @timer("Time to write frame batch", logging.INFO, identifier=None, average=100)
+    def __write(self, batch: list):
+        if not batch: return
+        start = time.perf_counter()
+        for attempt in range(self.WRITE_ATTEMPTS):
+            try:
+                frame_dao.store_many(self.__db, [frame for frame, _ in batch])
+                break
+            except Exception as e:
+                logger.error("Unable to write " + str(len(batch)) + " frames, attempt " + str(attempt + 1) + ": " + str(e))
+                if attempt + 1 < self.WRITE_ATTEMPTS:
+                    time.sleep(self.RETRY_DELAY * 2 ** attempt)
+        else:
+            logger.critical("Dropped " + str(len(batch)) + " frames that could not be written")
+            self.__stats_mutex.acquire()
+            self.__frames_dropped += len(batch)
+            self.__stats_mutex.release()
+            if self.__on_dropped is not None:
+                self.__on_dropped(len(batch))
+            return
+
+        ''' The frames are shared with the live buffers, the batch is dropped instead of clearing their images '''
+        now = time.perf_counter()
+        self.__stats_mutex.acquire()
+        for frame, queued in batch:
+            if frame.get_camera() not in self.__write_latency_ms:
+                self.__write_latency_ms[frame.get_camera()] = deque(maxlen=1000)
+            self.__write_latency_ms[frame.get_camera()].append((now - queued) * 1000)
+        self.__frames_written += len(batch)
+        self.__batches_written += 1
+        self.__last_batch_size = len(batch)
+        self.__max_batch_size = max(self.__max_batch_size, len(batch))
+        self.__last_commit_ms = (now - start) * 1000
+        self.__commit_ms.append(self.__last_commit_ms)
+        self.__stats_mutex.release()
@@ -0,0 +1,135 @@
+from threading import Thread, Event
+import bisect
+import time
+
+from database.DB import DB
+import database.frame_dao as frame_dao
+import database.announcement_dao as announcement_dao
+
+import logging
+logger = logging.getLogger(__name__)
+
+class RetentionPolicy:
+    '''
+    Once a flight has been stopped for after_minutes, only the frames within
+    window_seconds of an announcement keep their image at full rate. Of the
+    other frames every keep_every-th keeps its image, none when keep_every is
+    0. Timestamps and thumbnails of every frame are kept
+    '''
+    def __init__(self, enabled: bool = False, window_seconds: float = 10, keep_every: int = 10, after_minutes: float = 10):
+        self.enabled = enabled
+        self.window_ms = max(0, int(window_seconds * 1000))
+        self.keep_every = max(0, keep_every)
+        self.after_minutes = max(0, after_minutes)
+
+def event_windows(db: DB, flight: int, window_ms: int) -> list:
+    '''
+    Sorted, non overlapping (start, end) timestamps within window_ms of the
+    announcements of flight, from the first to the last gate
+    '''
+    windows = []
+    for announcement in announcement_dao.fetch(db, flight).get_announcements():
+        timestamps = [timestamp for timestamp in [
+            frame_dao.load_timestamp(db, flight, 1, announcement.get_cam1_position()),
+            frame_dao.load_timestamp(db, flight, 2, announcement.get_cam2_position())] if timestamp is not None]
+        if timestamps:
+            windows.append((min(timestamps) - window_ms, max(timestamps) + window_ms))
+
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class RetentionWorker:
+    '''
+    Background thread thinning stopped flights according to a RetentionPolicy
+
+    The frames of a flight are copied to a new generation, the images of
+    frames outside the windows are left behind, and the old generation is
+    reaped like a retired one, segment files included. Frames are copied
+    chunk_size at a time and only while is_idle() is true. A flight shot
+    again meanwhile is left alone, pinned flights are never thinned.
+    on_thinned(flight) is called after a flight has been thinned
+    '''
+    # Seconds between checks for flights to thin
+    INTERVAL = 60
+
+    def __init__(self, db: DB, policy: RetentionPolicy, is_idle, on_thinned=None, chunk_size: int = 200, pause_ms: int = 20):
+        self.__db = db
+        self.__policy = policy
+        self.__is_idle = is_idle
+        self.__on_thinned = on_thinned
+        self.__chunk_size = max(1, chunk_size)
+        self.__pause_ms = max(0, pause_ms)
+        self.__wake = Event()
+        self.__running = True
+        self.__thread = Thread(target=self.__run, name="RetentionWorker", daemon=True)
+        self.__thread.start()
+        logger.info("Retention keeps " + format(self.__policy.window_ms / 1000, "g") + "s around announcements and " +
+            ("every " + str(self.__policy.keep_every) + ". frame" if self.__policy.keep_every else "no frames") + " elsewhere, " +
+            format(self.__policy.after_minutes, "g") + " minutes after a flight")
+
+    def wake(self):
+        self.__wake.set()
+
+    def stop(self):
+        logger.info("Stopping retention worker")
+        self.__running = False
+        self.__wake.set()
+        self.__thread.join()
+
+    def __run(self):
+        while self.__running:
+            try:
+                for flight, generation in frame_dao.load_retention_candidates(
+                        self.__db, time.time() - self.__policy.after_minutes * 60):
+                    if not self.__running: break
+                    self.__thin(flight, generation)
+            except Exception as e:
+                logger.error("Unable to thin flights: " + str(e))
+            self.__wake.wait(self.INTERVAL)
+            self.__wake.clear()
+
+    def __wait_idle(self) -> bool:
+        while self.__running and not self.__is_idle():
+            self.__wake.wait(1)
+            self.__wake.clear()
+        return self.__running
+
+    def __thin(self, flight: int, generation: int):
+        start = time.time()
+        windows = event_windows(self.__db, flight, self.__policy.window_ms)
+        starts = [window[0] for window in windows]
+        keep_every = self.__policy.keep_every
+        frames, kept = 0, 0
+
+        def keep(position: int, timestamp: int) -> bool:
+            nonlocal frames, kept
+            frames += 1
+            i = bisect.bisect_right(starts, timestamp) - 1
+            if (i >= 0 and timestamp <= windows[i][1]) or (keep_every and (position - 1) % keep_every == 0):
+                kept += 1
+                return True
+            return False
+
+        target = frame_dao.load_next_generation(self.__db, flight)
+        for camera in frame_dao.load_cameras(self.__db, flight):
+            position = 1
+            while True:
+                if not self.__wait_idle(): return
+                last = frame_dao.thin_frames(self.__db, flight, generation, target, camera, position, self.__chunk_size, keep)
+                if last is None:
+                    logger.info("Flight " + str(flight) + " was shot again while it was thinned")
+                    return
+                if last == 0: break
+                position = last + 1
+                time.sleep(self.__pause_ms / 1000)
+
+        if not self.__running or not frame_dao.finish_thin(self.__db, flight, generation, target): return
+        logger.info("Thinned flight " + str(flight) + " in " + format(time.time() - start, ".1f") + "s, kept the images of " +
+            str(kept) + " of " + str(frames) + " frames in " + str(len(windows)) + " windows")
+        if self.__on_thinned is not None:
+            self.__on_thinned(flight)
@@ -0,0 +1,156 @@
+from threading import Lock
+from collections import OrderedDict
+import shutil
+import time
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+class SegmentStore:
+    '''
+    Jpeg payloads in append-only segment files, one directory per flight
+    generation and one open segment per camera:
+
+        <path>/flight-<flight>/cam<camera>-<segment>.seg             generation 0
+        <path>/flight-<flight>.<generation>/cam<camera>-<segment>.seg
+
+    The database keeps (segment, offset, length) of every frame. Segment
+    numbers are unique over time, so a file is never reused after its flight
+    has been deleted, even by a process holding it open.
+    '''
+    # A new segment is started when the open one grows past this
+    MAX_SEGMENT_SIZE = 256 * 1024 * 1024
+    # Segment files kept open for reading
+    MAX_READERS = 32
+
+    def __init__(self, path: str):
+        self.__path = path
+        # Open segment per (flight, generation, camera): [segment, file, size]
+        self.__writers = {}
+        self.__last_segment = 0
+        # Read handles per (flight, generation, camera, segment), least recently used first:
+        # [file, lock for seek and read, readers using it, closed once unused]
+        self.__readers = OrderedDict()
+        self.__readers_mutex = Lock()
+
+    def __generation_path(self, flight: int, generation: int) -> str:
+        return os.path.join(self.__path, 'flight-' + str(flight) + ('.' + str(generation) if generation else ''))
+
+    def get_segment_path(self, flight: int, generation: int, camera: int, segment: int) -> str:
+        return os.path.join(self.__generation_path(flight, generation), 'cam' + str(camera) + '-' + str(segment) + '.seg')
+
+    def __new_segment(self) -> int:
+        segment = max(time.time_ns() // 1000, self.__last_segment + 1)
+        self.__last_segment = segment
+        return segment
+
+    def append(self, flight: int, generation: int, camera: int, image) -> tuple:
+        ''' Append image to the open segment of the camera, returns (segment, offset, length). Called with the database write lock held '''
+        writer = self.__writers.get((flight, generation, camera))
+        if writer is None or writer[2] >= self.MAX_SEGMENT_SIZE:
+            if writer is not None: writer[1].close()
+            os.makedirs(self.__generation_path(flight, generation), exist_ok=True)
+            segment = self.__new_segment()
+            writer = [segment, open(self.get_segment_path(flight, generation, camera, segment), 'ab'), 0]
+            self.__writers[(flight, generation, camera)] = writer
+
+        offset = writer[2]
+        length = writer[1].write(image)
+        writer[2] += length
+        return (writer[0], offset, length)
+
+    def flush(self):
+        ''' Flush appended images to the files, before the rows pointing at them are committed '''
+        for writer in self.__writers.values():
+            writer[1].flush()
+
+    def read(self, flight: int, generation: int, camera: int, segment: int, offset: int, length: int) -> bytes:
+        ''' Only looking up the handle is serialised, reads of different threads run at the same time '''
+        key = (flight, generation, camera, segment)
+        self.__readers_mutex.acquire()
+        try:
+            reader = self.__readers.get(key)
+            if reader is None:
+                reader = [open(self.get_segment_path(flight, generation, camera, segment), 'rb'), Lock(), 0, False]
+                self.__readers[key] = reader
+                if len(self.__readers) > self.MAX_READERS:
+                    self.__release(self.__readers.popitem(last=False)[1])
+            else:
+                self.__readers.move_to_end(key)
+            reader[2] += 1
+        except OSError as e:
+            logger.error("Unable to read segment " + str(segment) + " of camera " + str(camera) + ": " + str(e))
+            return None
+        finally:
+            self.__readers_mutex.release()
+
+        try:
+            if hasattr(os, 'pread'):
+                return os.pread(reader[0].fileno(), length, offset)
+            ''' No pread on Windows '''
+            reader[1].acquire()
+            try:
+                reader[0].seek(offset)
+                return reader[0].read(length)
+            finally:
+                reader[1].release()
+        except OSError as e:
+            logger.error("Unable to read segment " + str(segment) + " of camera " + str(camera) + ": " + str(e))
+            return None
+        finally:
+            self.__readers_mutex.acquire()
+            reader[2] -= 1
+            if reader[3] and reader[2] == 0:
+                reader[0].close()
+            self.__readers_mutex.release()
+
+    def __release(self, reader: list):
+        ''' Close a handle no longer kept, once the last read using it is done. Called with the readers mutex held '''
+        reader[3] = True
+        if reader[2] == 0:
+            reader[0].close()
+
+    def retire(self, flight: int, generation: int):
+        ''' Close the segments of generations of flight before generation, called with the database write lock held '''
+        for key in [key for key in self.__writers if key[0] == flight and key[1] < generation]:
+            self.__writers.pop(key)[1].close()
+        self.__close_readers(flight, generation)
+
+    def seal(self, flight: int, generation: int):
+        ''' Close the segments of generation of flight, nothing more is appended to it. Called with the database write lock held '''
+        for key in [key for key in self.__writers if key[0] == flight and key[1] == generation]:
+            self.__writers.pop(key)[1].close()
+
+    def __close_readers(self, flight: int, generation: int):
+        self.__readers_mutex.acquire()
+        for key in [key for key in self.__readers if key[0] == flight and key[1] < generation]:
+            self.__release(self.__readers.pop(key))
+        self.__readers_mutex.release()
+
+    def delete_retired(self, flight: int, generation: int):
+        ''' Remove the segments of generations of flight before generation, retire has closed them for writing '''
+        self.__close_readers(flight, generation)
+        try:
+            names = os.listdir(self.__path)
+        except FileNotFoundError:
+            return
+        for retired in range(0, generation):
+            name = os.path.basename(self.__generation_path(flight, retired))
+            if name in names:
+                logger.debug("Deleting segments of flight " + str(flight) + " generation " + str(retired))
+                shutil.rmtree(os.path.join(self.__path, name), onerror=self.__delete_error)
+
+    def __delete_error(self, function, path, exc_info):
+        if not os.path.exists(path): return
+        logger.warning("Unable to remove segment " + path + ": " + str(exc_info[1]))
+
+    def close(self):
+        for writer in self.__writers.values():
+            writer[1].close()
+        self.__writers = {}
+        self.__readers_mutex.acquire()
+        for reader in self.__readers.values():
+            self.__release(reader)
+        self.__readers = OrderedDict()
+        self.__readers_mutex.release()
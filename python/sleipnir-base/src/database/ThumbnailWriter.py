@@ -0,0 +1,100 @@
+from threading import Thread, Event
+import queue
+import time
+
+import simplejpeg
+
+from database.DB import DB
+import database.frame_dao as frame_dao
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Thumbnails are 1/FACTOR of the frame in both directions
+FACTOR = 4
+
+def make_thumbnail(jpeg, quality: int = 70) -> bytes:
+    ''' Grayscale jpeg at 1/FACTOR size, scaled down by the jpeg decoder instead of decoding the full frame '''
+    height, width = simplejpeg.decode_jpeg_header(jpeg)[0:2]
+    image = simplejpeg.decode_jpeg(jpeg, colorspace='GRAY',
+        min_height=-(-height // FACTOR), min_width=-(-width // FACTOR))
+    return simplejpeg.encode_jpeg(image, quality=quality, colorspace='GRAY')
+
+class ThumbnailWriter:
+    '''
+    Background thread making a thumbnail of every ingested frame and storing
+    it next to the frame, for scrubbing through a flight without decoding
+    full frames
+
+    Ingest is never held back, frames are skipped when the queue is full and
+    are shown full size instead
+    '''
+    __STOP = object()
+
+    def __init__(self, db: DB, batch_size: int = 90, max_delay_ms: int = 500, queue_size: int = 1000):
+        self.__db = db
+        self.__batch_size = max(1, batch_size)
+        self.__max_delay_ms = max(0, max_delay_ms)
+        self.__queue = queue.Queue(max(1, queue_size))
+        self.__skipped = 0
+        self.__thread = Thread(target=self.__run, name="ThumbnailWriter", daemon=True)
+        self.__thread.start()
+
+    def put(self, flight: int, camera: int, position: int, jpeg):
+        try:
+            self.__queue.put_nowait((flight, camera, position, jpeg))
+        except queue.Full:
+            self.__skipped += 1
+            if self.__skipped % 100 == 1:
+                logger.warning("Thumbnail queue is full, " + str(self.__skipped) + " frames without thumbnail")
+
+    def flush(self, wait: bool = False, timeout: float = None) -> bool:
+        ''' Store everything queued so far, optionally wait until it is stored '''
+        done = Event()
+        self.__queue.put(done)
+        if not wait: return True
+        return done.wait(timeout)
+
+    def stop(self):
+        logger.info("Stopping thumbnail writer")
+        self.__queue.put(self.__STOP)
+        self.__thread.join()
+
+    def __run(self):
+        batch = []
+        deadline = 0
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                item = self.__queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self.__STOP:
+                self.__write(batch)
+                return
+
+            if isinstance(item, Event):
+                self.__write(batch)
+                batch = []
+                item.set()
+                continue
+
+            if item is not None:
+                flight, camera, position, jpeg = item
+                try:
+                    if not batch: deadline = time.monotonic() + self.__max_delay_ms / 1000
+                    batch.append((flight, camera, position, make_thumbnail(jpeg)))
+                except ValueError as e:
+                    logger.warning("Unable to make thumbnail of frame " + str(position) + ": " + str(e))
+
+            if len(batch) >= self.__batch_size or (batch and time.monotonic() >= deadline):
+                self.__write(batch)
+                batch = []
+
+    def __write(self, batch: list):
+        if not batch: return
+        try:
+            frame_dao.store_thumbnails(self.__db, batch)
+        except Exception as e:
+            logger.error("Unable to write " + str(len(batch)) + " thumbnails: " + str(e))
@@ -34,7 +34,7 @@ def store(db: DB, flight_number: int, announcements: Announcements):
         db.release_write_lock()
  
 def fetch(db: DB, flight: int):
-    cur = db.get_conn().cursor()
+    cur = db.get_read_conn().cursor()
     announcements = Announcements()
     try:
         for row in cur.execute(
@@ -0,0 +1,237 @@
+from collections import OrderedDict
+import struct
+import mmap
+
+import numpy as np
+
+from Announcements import Announcements, Announcement
+from database.DB import DB
+import database.frame_dao as frame_dao
+import database.announcement_dao as announcement_dao
+from Frame import Frame
+
+import logging
+logger = logging.getLogger(__name__)
+
+'''
+Single file archive of one flight, all little endian
+
+    header        8 bytes magic, uint32 version, uint32 flight
+    jpegs         the images and thumbnails of all cameras, concatenated
+    index         uint32 cameras, per camera uint32 camera, uint32 frames
+                  followed by the frames in position order
+                      uint32 position, int64 timestamp, uint64 offset, uint32 length,
+                      uint64 thumbnail offset, uint32 thumbnail length
+                  a length of 0 for a frame without image or thumbnail,
+                  version 1 archives have neither thumbnail field
+    announcements uint32 count, per announcement
+                      uint32 cam1_position, uint32 cam2_position, int64 duration, int32 speed, int32 direction
+    footer        uint64 offset of index, 8 bytes magic
+
+The index is written after the jpegs, so a flight is exported in one pass
+'''
+MAGIC = b'SLPFLT\r\n'
+VERSION = 2
+HEADER = struct.Struct('<8sII')
+CAMERA = struct.Struct('<II')
+COUNT = struct.Struct('<I')
+ANNOUNCEMENT = struct.Struct('<IIqii')
+FOOTER = struct.Struct('<Q8s')
+INDEX_V1 = np.dtype([('position', '<u4'), ('timestamp', '<i8'), ('offset', '<u8'), ('length', '<u4')])
+INDEX = np.dtype(INDEX_V1.descr + [('thumbnail_offset', '<u8'), ('thumbnail_length', '<u4')])
+
+# Frames read from the database per query and written per import transaction
+BATCH_SIZE = 450
+# Write buffer of the archive file
+BUFFER_SIZE = 4 * 1024 * 1024
+
+def export_flight(db: DB, flight: int, path: str) -> int:
+    ''' Write flight to an archive at path, returns the number of frames '''
+    cameras = OrderedDict()
+    with open(path, 'wb', buffering=BUFFER_SIZE) as f:
+        f.write(HEADER.pack(MAGIC, VERSION, flight))
+        offset = HEADER.size
+        for camera in frame_dao.load_cameras(db, flight):
+            index = []
+            thumbnails = frame_dao.load_thumbnail_range(db, flight, camera, 1, BATCH_SIZE)
+            thumbnail = next(thumbnails, None)
+            for frame in frame_dao.load_range(db, flight, camera, 1, fetch_size=BATCH_SIZE):
+                ''' Frames thinned by retention keep their timestamp and thumbnail '''
+                image_offset, length = offset, 0
+                if frame.get_image() is not None:
+                    length = f.write(frame.get_image())
+                    offset += length
+
+                while thumbnail is not None and thumbnail[0] < frame.get_position():
+                    thumbnail = next(thumbnails, None)
+                thumbnail_offset, thumbnail_length = offset, 0
+                if thumbnail is not None and thumbnail[0] == frame.get_position():
+                    thumbnail_length = f.write(thumbnail[1])
+                    offset += thumbnail_length
+
+                index.append((frame.get_position(), frame.get_timestamp(), image_offset, length, thumbnail_offset, thumbnail_length))
+            cameras[camera] = np.array(index, dtype=INDEX)
+
+        index_offset = offset
+        f.write(COUNT.pack(len(cameras)))
+        for camera, index in cameras.items():
+            f.write(CAMERA.pack(camera, len(index)))
+            f.write(index.tobytes())
+
+        announcements = announcement_dao.fetch(db, flight).get_announcements()
+        f.write(COUNT.pack(len(announcements)))
+        for announcement in announcements:
+            f.write(ANNOUNCEMENT.pack(
+                announcement.get_cam1_position(),
+                announcement.get_cam2_position(),
+                announcement.get_duration(),
+                announcement.get_speed(),
+                announcement.get_direction()))
+        f.write(FOOTER.pack(index_offset, MAGIC))
+    return sum(len(index) for index in cameras.values())
+
+def import_flight(db: DB, path: str, flight: int = None) -> int:
+    '''
+    Store the flight of the archive at path as flight, the flight of the
+    archive when None. Frames already stored for flight are retired first.
+    Returns the flight
+    '''
+    archive = FlightArchive(path)
+    try:
+        if flight is None:
+            flight = archive.get_flight()
+        frame_dao.retire_flight(db, flight)
+        for camera in archive.get_cameras():
+            batch = []
+            for frame in archive.frames(camera):
+                batch.append(Frame(flight, camera, frame.get_position(), frame.get_timestamp(), frame.get_image()))
+                if len(batch) == BATCH_SIZE:
+                    frame_dao.store_many(db, batch)
+                    batch = []
+            if batch:
+                frame_dao.store_many(db, batch)
+
+            batch = []
+            for position, thumbnail in archive.thumbnails(camera):
+                batch.append((flight, camera, position, thumbnail))
+                if len(batch) == BATCH_SIZE:
+                    frame_dao.store_thumbnails(db, batch)
+                    batch = []
+            if batch:
+                frame_dao.store_thumbnails(db, batch)
+        announcement_dao.store(db, flight, archive.get_announcements())
+        return flight
+    finally:
+        archive.close()
+
+class FlightArchive:
+    '''
+    Reads a flight archive without importing it
+
+    The file is memory mapped, images are memoryviews of the map and stay
+    valid until close. Positions are found in the index by binary search
+    '''
+    def __init__(self, path: str):
+        self.__file = open(path, 'rb')
+        try:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.__file.close()
+            raise ValueError("Empty flight archive " + path)
+        try:
+            self.__read_index()
+        except (ValueError, struct.error) as e:
+            self.close()
+            raise ValueError("Invalid flight archive " + path + ": " + str(e))
+
+    def __read_index(self):
+        magic, version, self.__flight = HEADER.unpack_from(self.__map, 0)
+        index_offset, footer_magic = FOOTER.unpack_from(self.__map, len(self.__map) - FOOTER.size)
+        if magic != MAGIC or footer_magic != MAGIC:
+            raise ValueError("not a flight archive")
+        if version not in (1, VERSION):
+            raise ValueError("unsupported version " + str(version))
+        dtype = INDEX if version == VERSION else INDEX_V1
+
+        offset = index_offset
+        count, = COUNT.unpack_from(self.__map, offset)
+        offset += COUNT.size
+        # camera: index of its frames
+        self.__index = OrderedDict()
+        for i in range(count):
+            camera, frames = CAMERA.unpack_from(self.__map, offset)
+            offset += CAMERA.size
+            self.__index[camera] = np.frombuffer(self.__map, dtype=dtype, count=frames, offset=offset)
+            offset += frames * dtype.itemsize
+
+        count, = COUNT.unpack_from(self.__map, offset)
+        offset += COUNT.size
+        self.__announcements = Announcements()
+        for i in range(count):
+            self.__announcements.append(Announcement(*ANNOUNCEMENT.unpack_from(self.__map, offset)))
+            offset += ANNOUNCEMENT.size
+
+    def get_flight(self) -> int:
+        return self.__flight
+
+    def get_cameras(self) -> list:
+        return list(self.__index.keys())
+
+    def get_frame_count(self, camera: int) -> int:
+        index = self.__index.get(camera)
+        if index is None or len(index) == 0: return 0
+        return int(index['position'][-1])
+
+    def get_announcements(self) -> Announcements:
+        return self.__announcements
+
+    def get_timestamps(self, camera: int):
+        ''' (positions, timestamps) of camera as arrays '''
+        index = self.__index[camera]
+        return index['position'], index['timestamp']
+
+    def load(self, camera: int, position: int) -> Frame:
+        index = self.__index.get(camera)
+        if index is None: return None
+        i = int(np.searchsorted(index['position'], position))
+        if i == len(index) or index['position'][i] != position: return None
+        return self.__frame(camera, index[i])
+
+    def frames(self, camera: int, start: int = 1):
+        ''' Frames of camera from position start in position order, without image where it was not kept '''
+        index = self.__index.get(camera)
+        if index is None: return
+        for entry in index[int(np.searchsorted(index['position'], start)):]:
+            yield self.__frame(camera, entry)
+
+    def load_thumbnail(self, camera: int, position: int):
+        ''' memoryview of the thumbnail of position, None if it has none '''
+        index = self.__index.get(camera)
+        if index is None or 'thumbnail_length' not in index.dtype.names: return None
+        i = int(np.searchsorted(index['position'], position))
+        if i == len(index) or index['position'][i] != position: return None
+        return self.__slice(index[i]['thumbnail_offset'], index[i]['thumbnail_length'])
+
+    def thumbnails(self, camera: int):
+        ''' (position, thumbnail) of the frames of camera with a thumbnail, in position order '''
+        index = self.__index.get(camera)
+        if index is None or 'thumbnail_length' not in index.dtype.names: return
+        for entry in index[index['thumbnail_length'] > 0]:
+            yield int(entry['position']), self.__slice(entry['thumbnail_offset'], entry['thumbnail_length'])
+
+    def __frame(self, camera: int, entry) -> Frame:
+        image = self.__slice(entry['offset'], entry['length'])
+        return Frame(self.__flight, camera, int(entry['position']), int(entry['timestamp']), image)
+
+    def __slice(self, offset, length):
+        if length == 0: return None
+        return memoryview(self.__map)[int(offset):int(offset) + int(length)]
+
+    def close(self):
+        ''' Memoryviews of images still in use keep the map open until they are released '''
+        self.__index = OrderedDict()
+        try:
+            self.__map.close()
+        except BufferError:
+            logger.debug("Flight archive still in use, the map is closed when its images are released")
+        self.__file.close()
@@ -1,4 +1,5 @@
 import sqlite3
+import time
 from sqlite3.dbapi2 import OperationalError
 
 from database.DB import DB
@@ -7,67 +8,425 @@ from Frame import Frame
 import logging
 logger = logging.getLogger(__name__)
 
+''' Current generation of a flight, bound to the flight. Frames of older generations are retired '''
+CURRENT_GENERATION = 'IFNULL((SELECT generation FROM flight WHERE flight.flight=?), 0)'
+
+def __store(cur, db: DB, frame: Frame, generation: int):
+    ''' The image goes to a segment file when the database stores segments, otherwise to frame_image '''
+    image_id, segment, offset, length = None, None, None, None
+    if frame.get_image() is not None:
+        if db.is_storing_segments():
+            segment, offset, length = db.get_segment_store().append(
+                frame.get_flight(), generation, frame.get_camera(), frame.get_image())
+        else:
+            image_id = cur.execute('INSERT INTO frame_image (image) VALUES (?)', [frame.get_image()]).lastrowid
+
+    cur.execute('''INSERT OR IGNORE INTO frame_meta
+        (flight, generation, camera, position, timestamp, image_id, segment, segment_offset, segment_length)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+        int(frame.get_flight()),
+        generation,
+        int(frame.get_camera()),
+        int(frame.get_position()),
+        int(frame.get_timestamp()),
+        image_id,
+        segment,
+        offset,
+        length
+        ])
+    if cur.rowcount == 0:
+        logger.warning("Duplicate frame " + str(frame.get_position()) + " on camera " + str(frame.get_camera()) + ", not stored")
+        if image_id is not None:
+            cur.execute('DELETE FROM frame_image WHERE id=?', [image_id])
+
 def store(db: DB, frame: Frame):
+    store_many(db, [frame])
+
+def store_many(db: DB, frames: list):
+    ''' Store several frames in one transaction '''
     db.acquire_write_lock()
     cur = db.get_conn().cursor()
     try:
-        cur.execute('''INSERT INTO frame
-            (flight, camera, position, timestamp, image)
-            VALUES (?, ?, ?, ?, ?)
-            ''',[
-            str(frame.get_flight()),
-            str(frame.get_camera()),
-            str(frame.get_position()),
-            str(frame.get_timestamp()),
-            frame.get_image()
-            ])
+        generations = {}
+        for frame in frames:
+            if frame.get_flight() not in generations:
+                generations[frame.get_flight()] = cur.execute(
+                    'SELECT ' + CURRENT_GENERATION, [int(frame.get_flight())]).fetchone()[0]
+            __store(cur, db, frame, generations[frame.get_flight()])
+        db.get_segment_store().flush()
         db.get_conn().commit()
-    except OperationalError as e:
+    except (OperationalError, OSError) as e:
         logger.error(str(e))
+        db.get_conn().rollback()
         raise e
     finally:
         cur.close()
         db.release_write_lock()
 
 def load(db: DB, flight: int, cam: int, position: int) -> Frame:
-    cur = db.get_conn().cursor()
+    cur = db.get_read_conn().cursor()
     try:
         row = cur.execute(
-            '''SELECT timestamp, image FROM frame WHERE position=? AND flight=? and camera=?''',
-            [str(position),
-            str(flight),
-            str(cam)]).fetchone()
+            '''SELECT frame_meta.timestamp, frame_image.image, frame_meta.segment, frame_meta.segment_offset,
+                   frame_meta.segment_length, frame_meta.generation
+               FROM frame_meta LEFT JOIN frame_image ON frame_image.id = frame_meta.image_id
+               WHERE frame_meta.flight=? AND frame_meta.generation=''' + CURRENT_GENERATION + '''
+                   AND frame_meta.camera=? AND frame_meta.position=?''',
+            [int(flight),
+            int(flight),
+            int(cam),
+            int(position)]).fetchone()
         if row is None: return None
-        return Frame(flight, cam, position, row[0], row[1])
+        image = row[1]
+        if image is None and row[2] is not None:
+            image = db.get_segment_store().read(flight, row[5], cam, row[2], row[3], row[4])
+        return Frame(flight, cam, position, row[0], image)
     except sqlite3.Error as e:
         logger.error(str(e))
         raise e
     finally:
         cur.close()
 
-def delete_flight(db: DB, flight: int):
+def store_thumbnails(db: DB, thumbnails: list):
+    ''' Store (flight, camera, position, thumbnail) in one transaction, for the current generation of the flight '''
     db.acquire_write_lock()
     cur = db.get_conn().cursor()
     try:
-        logger.debug("Deleting frames for flight " + str(flight))
-        cur.execute('DELETE FROM frame WHERE flight=?', [str(flight)])
+        cur.executemany('''INSERT OR REPLACE INTO frame_thumbnail (flight, generation, camera, position, thumbnail)
+            VALUES (?, ''' + CURRENT_GENERATION + ''', ?, ?, ?)''',
+            [[int(flight), int(flight), int(camera), int(position), thumbnail]
+                for flight, camera, position, thumbnail in thumbnails])
+        db.get_conn().commit()
+    except OperationalError as e:
+        logger.error(str(e))
+        db.get_conn().rollback()
+        raise e
+    finally:
+        cur.close()
+        db.release_write_lock()
+
+def load_thumbnail(db: DB, flight: int, camera: int, position: int) -> bytes:
+    cur = db.get_read_conn().cursor()
+    try:
+        row = cur.execute(
+            '''SELECT thumbnail FROM frame_thumbnail
+               WHERE flight=? AND generation=''' + CURRENT_GENERATION + ''' AND camera=? AND position=?''',
+            [int(flight),
+            int(flight),
+            int(camera),
+            int(position)]).fetchone()
+        return row[0] if row is not None else None
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+
+def load_thumbnail_range(db: DB, flight: int, camera: int, start: int = 1, fetch_size: int = 90):
+    ''' (position, thumbnail) of the frames of camera with a thumbnail from position start in position order, fetch_size per query '''
+    fetch_size = max(1, int(fetch_size))
+    lower = int(start)
+    while True:
+        cur = db.get_read_conn().cursor()
+        try:
+            rows = cur.execute(
+                '''SELECT position, thumbnail FROM frame_thumbnail
+                   WHERE flight=? AND generation=''' + CURRENT_GENERATION + ''' AND camera=? AND position>=?
+                   ORDER BY position LIMIT ?''',
+                [int(flight),
+                int(flight),
+                int(camera),
+                lower,
+                fetch_size]).fetchall()
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            raise e
+        finally:
+            cur.close()
+
+        for row in rows:
+            yield row
+        if len(rows) < fetch_size:
+            return
+        lower = rows[-1][0] + 1
+
+def load_range(db: DB, flight: int, camera: int, start: int, end: int = None, fetch_size: int = 90,
+        reverse: bool = False, images: bool = True):
+    '''
+    Frames of positions start up to, not including, end (None for the last
+    frame) in position order, or the other way round when reverse. One query
+    reads fetch_size frames and the read transaction ends after each, so an
+    iterator can be kept while frames are stored. Frames have no image
+    when images is False
+    '''
+    fetch_size = max(1, int(fetch_size))
+    lower = int(start)
+    upper = int(end) if end is not None else None
+    if images:
+        columns = '''frame_meta.position, frame_meta.timestamp, frame_image.image, frame_meta.segment,
+            frame_meta.segment_offset, frame_meta.segment_length, frame_meta.generation
+            FROM frame_meta LEFT JOIN frame_image ON frame_image.id = frame_meta.image_id'''
+    else:
+        columns = 'frame_meta.position, frame_meta.timestamp FROM frame_meta'
+    order = 'DESC' if reverse else 'ASC'
+    while True:
+        cur = db.get_read_conn().cursor()
+        try:
+            rows = cur.execute(
+                '''SELECT ''' + columns + '''
+                   WHERE frame_meta.flight=? AND frame_meta.generation=''' + CURRENT_GENERATION + '''
+                       AND frame_meta.camera=? AND frame_meta.position>=?''' +
+                   (' AND frame_meta.position<?' if upper is not None else '') + '''
+                   ORDER BY frame_meta.position ''' + order + ''' LIMIT ?''',
+                [int(flight),
+                int(flight),
+                int(camera),
+                lower] +
+                ([upper] if upper is not None else []) +
+                [fetch_size]).fetchall()
+        except sqlite3.Error as e:
+            logger.error(str(e))
+            raise e
+        finally:
+            cur.close()
+
+        for row in rows:
+            image = None
+            if images:
+                image = row[2]
+                if image is None and row[3] is not None:
+                    image = db.get_segment_store().read(flight, row[6], camera, row[3], row[4], row[5])
+            yield Frame(flight, camera, row[0], row[1], image)
+
+        if len(rows) < fetch_size:
+            return
+        if reverse:
+            upper = rows[-1][0]
+        else:
+            lower = rows[-1][0] + 1
+
+def retire_flight(db: DB, flight: int) -> int:
+    '''
+    Start a new generation of flight, its frames are no longer loaded and are
+    deleted in the background by reap. Returns the new generation
+    '''
+    db.acquire_write_lock()
+    cur = db.get_conn().cursor()
+    try:
+        logger.debug("Retiring frames for flight " + str(flight))
+        ''' Generations left behind by an unfinished thin are skipped, so they are reaped too '''
+        cur.execute('''INSERT INTO flight (flight, generation) VALUES (?, 1)
+            ON CONFLICT (flight) DO UPDATE SET
+                generation = MAX(generation, IFNULL((SELECT MAX(generation) FROM frame_meta WHERE flight=?), 0)) + 1,
+                pinned = 0, thinned = 0, stopped_at = NULL''', [int(flight), int(flight)])
+        generation = cur.execute('SELECT generation FROM flight WHERE flight=?', [int(flight)]).fetchone()[0]
         logger.debug("Deleting announcements for flight " + str(flight))
-        cur.execute('DELETE FROM announcement WHERE flight=?', [str(flight)])
+        cur.execute('DELETE FROM announcement WHERE flight=?', [int(flight)])
         db.get_conn().commit()
+        db.get_segment_store().retire(flight, generation)
+        return generation
     except OperationalError as e:
         logger.error(str(e))
+        db.get_conn().rollback()
         raise e
     finally:
         cur.close()
         db.release_write_lock()
 
-def load_flight_timestamps(db: DB, flight: int, camera: int):
+def set_flight_stopped(db: DB, flight: int):
+    ''' Shooting of flight has stopped, retention may thin it from now on '''
+    __update_flight(db, flight, 'stopped_at', time.time())
+
+def pin_flight(db: DB, flight: int, pinned: bool = True):
+    ''' A pinned flight is kept at full frame rate by retention '''
+    __update_flight(db, flight, 'pinned', 1 if pinned else 0)
+
+def __update_flight(db: DB, flight: int, column: str, value):
+    db.acquire_write_lock()
+    cur = db.get_conn().cursor()
+    try:
+        cur.execute('''INSERT INTO flight (flight, generation, ''' + column + ''') VALUES (?, 0, ?)
+            ON CONFLICT (flight) DO UPDATE SET ''' + column + ''' = excluded.''' + column, [int(flight), value])
+        db.get_conn().commit()
+    except OperationalError as e:
+        logger.error(str(e))
+        db.get_conn().rollback()
+        raise e
+    finally:
+        cur.close()
+        db.release_write_lock()
+
+def is_flight_pinned(db: DB, flight: int) -> bool:
+    cur = db.get_read_conn().cursor()
+    try:
+        row = cur.execute('SELECT pinned FROM flight WHERE flight=?', [int(flight)]).fetchone()
+        return row is not None and row[0] == 1
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+
+def load_retention_candidates(db: DB, stopped_before: float) -> list:
+    ''' (flight, generation) of the flights stopped before stopped_before that are neither pinned nor thinned yet '''
+    cur = db.get_read_conn().cursor()
+    try:
+        return cur.execute('''SELECT flight, generation FROM flight
+            WHERE pinned=0 AND thinned=0 AND stopped_at IS NOT NULL AND stopped_at<? ORDER BY stopped_at''',
+            [stopped_before]).fetchall()
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+
+def load_next_generation(db: DB, flight: int) -> int:
+    ''' A generation of flight no frames have been stored in '''
+    cur = db.get_read_conn().cursor()
+    try:
+        return cur.execute('''SELECT MAX(IFNULL((SELECT MAX(generation) FROM frame_meta WHERE flight=?), 0),
+            ''' + CURRENT_GENERATION + ''') + 1''', [int(flight), int(flight)]).fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+
+def thin_frames(db: DB, flight: int, generation: int, target: int, camera: int, start: int, count: int, keep) -> int:
+    '''
+    Copy up to count frames of camera from position start in generation to
+    generation target, in one short transaction. Metadata and thumbnails of
+    every frame are copied, the image only when keep(position, timestamp).
+    Returns the last position copied, 0 when there are no more frames and
+    None when flight has been retired meanwhile
+    '''
+    db.acquire_write_lock()
     cur = db.get_conn().cursor()
+    try:
+        current = cur.execute('SELECT ' + CURRENT_GENERATION, [int(flight)]).fetchone()[0]
+        if current != generation: return None
+        rows = cur.execute('''SELECT frame_meta.position, frame_meta.timestamp, frame_meta.image_id, frame_meta.segment,
+                frame_meta.segment_offset, frame_meta.segment_length
+            FROM frame_meta WHERE flight=? AND generation=? AND camera=? AND position>=? ORDER BY position LIMIT ?''',
+            [int(flight), generation, int(camera), int(start), int(count)]).fetchall()
+        if not rows: return 0
+
+        segments = db.get_segment_store()
+        for position, timestamp, image_id, segment, offset, length in rows:
+            new_image_id, new_segment, new_offset, new_length = None, None, None, None
+            if keep(position, timestamp):
+                if image_id is not None:
+                    new_image_id = cur.execute(
+                        'INSERT INTO frame_image (image) SELECT image FROM frame_image WHERE id=?', [image_id]).lastrowid
+                elif segment is not None:
+                    image = segments.read(flight, generation, camera, segment, offset, length)
+                    if image is not None:
+                        new_segment, new_offset, new_length = segments.append(flight, target, camera, image)
+            cur.execute('''INSERT OR IGNORE INTO frame_meta
+                (flight, generation, camera, position, timestamp, image_id, segment, segment_offset, segment_length)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                [int(flight), target, int(camera), position, timestamp, new_image_id, new_segment, new_offset, new_length])
+        cur.execute('''INSERT OR REPLACE INTO frame_thumbnail (flight, generation, camera, position, thumbnail)
+            SELECT flight, ?, camera, position, thumbnail FROM frame_thumbnail
+            WHERE flight=? AND generation=? AND camera=? AND position>=? AND position<=?''',
+            [target, int(flight), generation, int(camera), rows[0][0], rows[-1][0]])
+        segments.flush()
+        db.get_conn().commit()
+        return rows[-1][0]
+    except (OperationalError, OSError) as e:
+        logger.error(str(e))
+        db.get_conn().rollback()
+        raise e
+    finally:
+        cur.close()
+        db.release_write_lock()
+
+def finish_thin(db: DB, flight: int, generation: int, target: int) -> bool:
+    '''
+    Make generation target, filled by thin_frames, the current generation of
+    flight. The frames of generation are then reaped. False when flight has
+    been retired meanwhile
+    '''
+    db.acquire_write_lock()
+    cur = db.get_conn().cursor()
+    try:
+        cur.execute('UPDATE flight SET generation=?, thinned=1 WHERE flight=? AND generation=?',
+            [target, int(flight), generation])
+        if cur.rowcount == 0:
+            db.get_conn().rollback()
+            return False
+        db.get_conn().commit()
+        db.get_segment_store().seal(flight, target)
+        db.get_segment_store().retire(flight, target)
+        return True
+    except OperationalError as e:
+        logger.error(str(e))
+        db.get_conn().rollback()
+        raise e
+    finally:
+        cur.close()
+        db.release_write_lock()
+
+def reap(db: DB, chunk_size: int) -> int:
+    ''' Delete up to chunk_size frames of retired generations in one short transaction, returns the number deleted '''
+    db.acquire_write_lock()
+    cur = db.get_conn().cursor()
+    try:
+        rows = cur.execute('''SELECT frame_meta.flight, frame_meta.generation, frame_meta.camera, frame_meta.position, frame_meta.image_id
+            FROM flight CROSS JOIN frame_meta ON frame_meta.flight = flight.flight AND frame_meta.generation < flight.generation
+            LIMIT ?''', [chunk_size]).fetchall()
+        cur.executemany('DELETE FROM frame_image WHERE id=?', [[row[4]] for row in rows if row[4] is not None])
+        cur.executemany('DELETE FROM frame_meta WHERE flight=? AND generation=? AND camera=? AND position=?',
+            [row[0:4] for row in rows])
+        cur.executemany('DELETE FROM frame_thumbnail WHERE flight=? AND generation=? AND camera=? AND position=?',
+            [row[0:4] for row in rows])
+        db.get_conn().commit()
+        return len(rows)
+    except OperationalError as e:
+        logger.error(str(e))
+        db.get_conn().rollback()
+        raise e
+    finally:
+        cur.close()
+        db.release_write_lock()
+
+def load_generations(db: DB) -> list:
+    ''' (flight, current generation) of the flights that have been retired '''
+    cur = db.get_read_conn().cursor()
+    try:
+        return cur.execute('SELECT flight, generation FROM flight').fetchall()
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+
+def load_flight_timestamps(db: DB, flight: int, camera: int):
+    ''' (position, timestamp) of all frames of the camera, ordered by position '''
+    cur = db.get_read_conn().cursor()
     try:
         return cur.execute(
-            '''SELECT position, timestamp FROM frame WHERE flight=? AND camera=?''',
-            [str(flight),
-            str(camera)]).fetchall()
+            '''SELECT position, timestamp FROM frame_meta
+               WHERE flight=? AND generation=''' + CURRENT_GENERATION + ''' AND camera=? ORDER BY position''',
+            [int(flight),
+            int(flight),
+            int(camera)]).fetchall()
+    except sqlite3.Error as e:
+        logger.error(str(e))
+        raise e
+    finally:
+        cur.close()
+
+def load_cameras(db: DB, flight: int) -> list:
+    ''' Numbers of the cameras with frames in flight '''
+    cur = db.get_read_conn().cursor()
+    try:
+        return [row[0] for row in cur.execute(
+            '''SELECT DISTINCT camera FROM frame_meta
+               WHERE flight=? AND generation=''' + CURRENT_GENERATION + ''' ORDER BY camera''',
+            [int(flight),
+            int(flight)])]
     except sqlite3.Error as e:
         logger.error(str(e))
         raise e
@@ -75,13 +434,15 @@ def load_flight_timestamps(db: DB, flight: int, camera: int):
         cur.close()
 
 def load_frame_count(db: DB, flight: int, camera: int) -> int:
-    cur = db.get_conn().cursor()
+    cur = db.get_read_conn().cursor()
     try:
         rs = cur.execute(
-            '''SELECT position FROM frame WHERE flight=? AND camera=? ORDER BY id DESC LIMIT 1''',
-            [str(flight),
-            str(camera)]).fetchone()
-        if rs is None: return None
+            '''SELECT MAX(position) FROM frame_meta
+               WHERE flight=? AND generation=''' + CURRENT_GENERATION + ''' AND camera=?''',
+            [int(flight),
+            int(flight),
+            int(camera)]).fetchone()
+        if rs is None or rs[0] is None: return None
         return int(rs[0])
     except sqlite3.Error as e:
         logger.error(str(e))
@@ -90,13 +451,15 @@ def load_frame_count(db: DB, flight: int, camera: int) -> int:
         cur.close()
 
 def load_timestamp(db: DB, flight: int, cam: int, position: int) -> int:
-    cur = db.get_conn().cursor()
+    cur = db.get_read_conn().cursor()
     try:
         row = cur.execute(
-            '''SELECT timestamp FROM frame WHERE position=? AND flight=? and camera=?''',
-            [str(position),
-            str(flight),
-            str(cam)]).fetchone()
+            '''SELECT timestamp FROM frame_meta
+               WHERE flight=? AND generation=''' + CURRENT_GENERATION + ''' AND camera=? AND position=?''',
+            [int(flight),
+            int(flight),
+            int(cam),
+            int(position)]).fetchone()
         if row is None: return None
         return int(row[0])
     except sqlite3.Error as e:
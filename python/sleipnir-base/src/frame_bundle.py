@@ -0,0 +1,36 @@
+import struct
+
+'''
+Binary bundle of several frames from one camera, used by the uploadframes action
+
+Every frame in the bundle is a header followed by the jpeg, all little endian
+   uint32  position
+   int64   timestamp
+   uint32  length of jpeg
+   bytes   jpeg
+'''
+HEADER = struct.Struct('<IqI')
+
+def pack(frames) -> bytes:
+    ''' frames is an iterable of (position, timestamp, image) '''
+    parts = []
+    for position, timestamp, image in frames:
+        parts.append(HEADER.pack(position, timestamp, len(image)))
+        parts.append(image)
+    return b''.join(parts)
+
+def unpack(data) -> list:
+    ''' Returns a list of (position, timestamp, image), the images are memoryviews into data '''
+    view = memoryview(data)
+    frames = []
+    offset = 0
+    while offset < len(view):
+        if offset + HEADER.size > len(view):
+            raise ValueError("Truncated frame header at offset " + str(offset))
+        position, timestamp, length = HEADER.unpack_from(view, offset)
+        offset += HEADER.size
+        if offset + length > len(view):
+            raise ValueError("Truncated frame " + str(position) + " at offset " + str(offset))
+        frames.append((position, timestamp, view[offset:offset + length]))
+        offset += length
+    return frames
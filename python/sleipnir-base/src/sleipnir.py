@@ -1,19 +1,26 @@
 import PySide2
 from PySide2 import QtCore, QtGui
-from PySide2.QtWidgets import QApplication, QMainWindow, QMessageBox
+from PySide2.QtWidgets import QApplication, QMainWindow, QMessageBox, QMenu
 
 import time
 
 from SleipnirWindow import SleipnirWindow
 import CameraServer
+from IngestProcess import IngestProcessProxy
 from Video import Video
-from CamerasData import CamerasData
+from FrameCache import FrameCache
+from CamerasData import CamerasData, ReorderPolicy
 import CameraServer
 from Configuration import Configuration
 from database.DB import DB
+from database.FrameWriter import FlushPolicy
+from database.RetentionWorker import RetentionPolicy
 from Announcements import Announcements, Announcement
 import database.announcement_dao as announcement_dao
+import database.frame_dao as frame_dao
 from Frame import Frame
+from RunDetector import RunDetector, MAX_ANNOUNCED_SPEED, speed
+from cameras import DEFAULT_CAMERAS, check_cameras
 
 from Sound import Sound
 from function_timer import timer
@@ -34,20 +41,32 @@ class WindowMain(QMainWindow):
          logger.error("Unable to open configuration file: " + str(e))
          exit(1)
 
-      self.__db = DB(self.configuration.get_or_throw('save_path'))
+      self.__db = DB(
+         self.configuration.get_or_throw('save_path'),
+         bool(self.configuration.get('storage.segments', False)),
+         int(self.configuration.get('storage.read_cache_mb', 16)),
+         int(self.configuration.get('storage.read_mmap_mb', 256)))
       self.__max_dive_angle = float(self.configuration.get('max_dive_angle', 10.0))
       logger.info("Max dive angle is set at " + str(self.__max_dive_angle) + "°")
+      try:
+         self.__cameras = check_cameras(self.configuration.get('cameras', DEFAULT_CAMERAS))
+      except ValueError as e:
+         logger.error("Invalid cameras in configuration file: " + str(e))
+         exit(1)
+
+      self.__reorder_policy = ReorderPolicy(
+         int(self.configuration.get('reorder.window', 45)),
+         int(self.configuration.get('reorder.timeout_ms', 500)))
+      self.__live_frames = int(float(self.configuration.get('live_buffer.seconds', 5)) * 90)
+      self.__decode_live_frames = bool(self.configuration.get('live_buffer.decode', False))
+      self.__frame_cache = FrameCache(int(float(self.configuration.get('frame_cache.size_mb', 64)) * 1024 * 1024))
 
       # Data for the cameras
       self.__flight = 1
-      self.cameras_data = CamerasData(self.__db, self.__flight)
+      self.cameras_data = self.__create_cameras_data()
 
-      # none / "Left" / "Right"
-      self.run_direction = None
-      self.run_frame_number_cam1 = None
-      self.run_frame_number_cam2 = None
-      # time to abort run
-      self.run_abort_timestamp = 0 
+      # Timed runs from the motions found
+      self.__run_detector = RunDetector()
 
       # Currently shooting
       self.__shooting = False
@@ -87,8 +106,12 @@ class WindowMain(QMainWindow):
 
       self.ui.verticalSlider_groundlevel.sliderMoved.connect(self.__on_groundlevel_changed)
 
-      for radio_buttons_flight in self.ui.radio_buttons_flights:
+      for i, radio_buttons_flight in enumerate(self.ui.radio_buttons_flights):
          radio_buttons_flight.clicked.connect(self.__flight_number_clicked)
+         # Right click pins the flight, retention keeps it whole
+         radio_buttons_flight.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+         radio_buttons_flight.customContextMenuRequested.connect(
+            lambda point, flight=i + 1: self.__flight_context_menu(flight, point))
 
       # Init the videos
       self.videos[0] = Video(
@@ -105,7 +128,8 @@ class WindowMain(QMainWindow):
          self.ui.pushbutton_video1_backstep,
          self.ui.slider_video1,
          self.ui.pushbutton_video1_copy,
-         self.ui.label_time_video1)
+         self.ui.label_time_video1,
+         self.__frame_cache)
       self.videos[1] = Video(
          self.__db,
          "cam2",
@@ -120,7 +144,8 @@ class WindowMain(QMainWindow):
          self.ui.pushbutton_video2_backstep, 
          self.ui.slider_video2,
          self.ui.pushbutton_video2_copy,
-         self.ui.label_time_video2)
+         self.ui.label_time_video2,
+         self.__frame_cache)
       self.videos[0].set_sibling_video(self.videos[1])
       self.videos[1].set_sibling_video(self.videos[0])
 
@@ -148,17 +173,42 @@ class WindowMain(QMainWindow):
       self.show()
       self.raise_()
 
-      # Start camera server
-      CameraServer.start_server(self.__db)
+      # Start camera server, in this process or in an ingest process of its own
+      if self.configuration.get('ingest_process.enabled', False):
+         self.__camera_server = IngestProcessProxy(
+            self.configuration.get_or_throw('save_path'),
+            self.__reorder_policy,
+            self.__live_frames,
+            int(self.configuration.get('ingest_process.slot_size', 131072)))
+      else:
+         self.__camera_server = CameraServer
+      self.__camera_server.start_server(self.__db, self.__cameras, FlushPolicy(
+         int(self.configuration.get('frame_writer.batch_size', 45)),
+         int(self.configuration.get('frame_writer.flush_interval_ms', 250)),
+         int(self.configuration.get('frame_writer.queue_size', 1000))), RetentionPolicy(
+         bool(self.configuration.get('retention.enabled', False)),
+         float(self.configuration.get('retention.window_seconds', 10)),
+         int(self.configuration.get('retention.keep_every', 10)),
+         float(self.configuration.get('retention.after_minutes', 10))))
 
       # Run Gui
       self.timer = QtCore.QTimer(self)
       self.timer.timeout.connect(self.__timerGui)
       self.timer.start(20)
 
+   def __create_cameras_data(self) -> CamerasData:
+      return CamerasData(self.__db, self.__flight, self.__cameras, self.__reorder_policy,
+         self.__live_frames, self.__decode_live_frames)
+
+   def __replace_cameras_data(self):
+      ''' The segment maps of the flight shown so far are released '''
+      self.cameras_data.close()
+      self.cameras_data = self.__create_cameras_data()
+
    def load_flight(self, flight):
+      logger.info("Frame cache " + str(self.__frame_cache.get_stats()))
       self.__flight = flight
-      self.cameras_data = CamerasData(self.__db, self.__flight)
+      self.__replace_cameras_data()
       self.ui.radio_buttons_flights[self.__flight - 1].setChecked(True)
 
       self.cameras_data.load(self.__db, self.__flight)
@@ -171,9 +221,9 @@ class WindowMain(QMainWindow):
       self.videos[0].set_flight(self.__flight)
       self.videos[1].set_flight(self.__flight)
       self.videos[0].slider.setMinimum(1)
-      self.videos[0].slider.setMaximum(0 if not self.cameras_data.get_last_frame("cam1") else (self.cameras_data.get_last_frame("cam1").get_position() or 0))
+      self.videos[0].slider.setMaximum(self.cameras_data.get_frame_count("cam1"))
       self.videos[1].slider.setMinimum(1)
-      self.videos[1].slider.setMaximum(0 if not self.cameras_data.get_last_frame("cam2") else (self.cameras_data.get_last_frame("cam2").get_position() or 0))
+      self.videos[1].slider.setMaximum(self.cameras_data.get_frame_count("cam2"))
       self.videos[0].setStartTimestamp(self.cameras_data.get_start_timestamp())
       self.videos[1].setStartTimestamp(self.cameras_data.get_start_timestamp())
       self.videos[0].comparison_image_cv = None
@@ -189,6 +239,16 @@ class WindowMain(QMainWindow):
       self.__flight = i + 1
       self.load_flight(i + 1)
 
+   def __flight_context_menu(self, flight, point):
+      pinned = frame_dao.is_flight_pinned(self.__db, flight)
+      menu = QMenu(self)
+      action = menu.addAction("Keep whole flight")
+      action.setCheckable(True)
+      action.setChecked(pinned)
+      if menu.exec_(self.ui.radio_buttons_flights[flight - 1].mapToGlobal(point)) is action:
+         frame_dao.pin_flight(self.__db, flight, not pinned)
+         logger.info(("Unpinned" if pinned else "Pinned") + " flight " + str(flight))
+
    def __on_distance_changed(self, value):
       try:
          value = int(value)
@@ -220,28 +280,28 @@ class WindowMain(QMainWindow):
 
    @timer("Time to run gui", logging.INFO, None, average=1000)
    def __timerGui(self):
-      online = CameraServer.is_online("cam1") and CameraServer.is_online("cam2")
+      online = all(self.__camera_server.is_online(cam) for cam in self.__cameras)
 
-      if CameraServer.is_online("cam1"):
+      if self.__camera_server.is_online("cam1"):
          self.ui.label_video1_online.setText("Cam1: Online")
          if not self.aligning_cam2 and not self.__shooting:
            self.ui.pushButton_video1_align.setEnabled(True)
-      if CameraServer.is_online("cam2"):
+      if self.__camera_server.is_online("cam2"):
          self.ui.label_video2_online.setText("Cam2: Online")
          if not self.aligning_cam1 and not self.__shooting:
             self.ui.pushButton_video2_align.setEnabled(True)
 
-      if not  CameraServer.is_online("cam1"):
+      if not  self.__camera_server.is_online("cam1"):
          self.ui.label_video1_online.setText("Cam1: Offline")
          self.ui.pushButton_video1_align.setEnabled(False)
-      if not CameraServer.is_online("cam2"):
+      if not self.__camera_server.is_online("cam2"):
          self.ui.label_video2_online.setText("Cam2: Offline")
          self.ui.pushButton_video2_align.setEnabled(False)
 
       if (self.__shooting and not online):
          # Camera lost?
          self.__shooting = False
-         CameraServer.stop_shooting()
+         self.__camera_server.stop_shooting()
 
       if not online:
          self.ui.pushbutton_start.setEnabled(False)
@@ -257,7 +317,7 @@ class WindowMain(QMainWindow):
          if self.aligning_cam1:
             logger.info("Stop aligning camera 1")
             self.ui.pushButton_video1_align.setEnabled(False)
-            if not CameraServer.is_shooting():
+            if not self.__camera_server.is_shooting():
                self.aligning_cam1 = False
                self.ui.pushButton_video1_align.setEnabled(True)
                self.stop_camera_wait = False
@@ -266,7 +326,7 @@ class WindowMain(QMainWindow):
          elif self.aligning_cam2:
             logger.info("Stop aligning camera 2")
             self.ui.pushButton_video2_align.setEnabled(False)
-            if not CameraServer.is_shooting():
+            if not self.__camera_server.is_shooting():
                self.aligning_cam2 = False
                self.ui.pushButton_video2_align.setEnabled(True)
                self.stop_camera_wait = False
@@ -275,7 +335,7 @@ class WindowMain(QMainWindow):
          else:
             self.ui.pushbutton_stop.setText("Waiting...")
             self.ui.pushbutton_stop.setEnabled(False)
-            if not CameraServer.is_shooting():
+            if not self.__camera_server.is_shooting():
                self.stop_camera_wait = False
                self.__shooting = False
                self.ui.pushbutton_stop.setText("Stop cameras")
@@ -288,16 +348,16 @@ class WindowMain(QMainWindow):
                self.enable_all_gui_elements(True)
 
       # Update the video view
-      if CameraServer.is_shooting():
+      if self.__camera_server.is_shooting():
          if self.aligning_cam1:
             ''' Align cam 1 '''
-            frame_number = self.cameras_data.get_last_frame("cam1").get_position()
+            frame_number = self.cameras_data.get_frame_count("cam1")
             if frame_number > 0:
                self.videos[0].view_frame(frame_number)
 
          elif self.aligning_cam2:
             ''' Align cam 2 '''
-            frame_number = self.cameras_data.get_last_frame("cam2").get_position()
+            frame_number = self.cameras_data.get_frame_count("cam2")
             if frame_number > 0:
                self.videos[1].view_frame(frame_number)
 
@@ -309,9 +369,9 @@ class WindowMain(QMainWindow):
                   video = self.videos[i]
                   video.setStartTimestamp(self.cameras_data.get_start_timestamp())
                   if not video.is_analyzer_running():
-                     last_frame = self.cameras_data.get_last_frame(cam)
-                     if last_frame is not None:
-                        frame_to_motion_check = self.get_frame_allow_lag(cam, last_frame.get_position())
+                     last_position = self.cameras_data.get_frame_count(cam)
+                     if last_position > 0:
+                        frame_to_motion_check = self.get_frame_allow_lag(cam, last_position)
                         if frame_to_motion_check is not None:
                            motion = video.view_frame_motion_track(
                               frame_to_motion_check.get_position(),
@@ -329,14 +389,11 @@ class WindowMain(QMainWindow):
                   cam = 'cam' + str(i+1)
                   self.videos[i].setStartTimestamp(self.cameras_data.get_start_timestamp())
                   if self.ui.checkBox_live.isChecked():
-                     last_frame = self.cameras_data.get_last_frame(cam)
-                     if last_frame is not None:
-                        self.videos[i].view_frame(last_frame.get_position())
-
-         if self.run_direction is not None and self.run_abort_timestamp < int(round(time.time() * 1000)):
-            # Abort run
-            logger.info("Aborting run due to timeout")
-            self.run_direction = None
+                     last_position = self.cameras_data.get_frame_count(cam)
+                     if last_position > 0:
+                        self.videos[i].view_frame(last_position)
+
+         if self.__run_detector.check_timeout():
             self.__sound.play_error()
 
          if self.run_tell_speed != 0 and self.run_tell_speed_timestamp < int(round(time.time() * 1000)):
@@ -375,17 +432,11 @@ class WindowMain(QMainWindow):
       """
       Set speed from camera frame numbers
       """
-      cam1_timestamp = self.cameras_data.get_frame('cam1', cam1_frame_number).get_timestamp()
-      cam2_timestamp = self.cameras_data.get_frame('cam2', cam2_frame_number).get_timestamp()
+      cam1_timestamp = self.cameras_data.get_timestamp('cam1', cam1_frame_number)
+      cam2_timestamp = self.cameras_data.get_timestamp('cam2', cam2_frame_number)
       milliseconds = abs((cam1_timestamp or 0)- (cam2_timestamp or 0))
 
-      kilometer = float(self.distance) / 1000
-      hours = float(milliseconds) / 1000 / 60  / 60
-
-      if (hours > 0):
-         kmh = kilometer / hours
-      else:
-         kmh = 0
+      kmh = speed(self.distance, milliseconds)
       if (kmh > 999 or kmh  < 10):
          speed_text = "Out of range"
          time_text = "Out of range"
@@ -403,14 +454,15 @@ class WindowMain(QMainWindow):
       """
       if (self.aligning_cam1):
          self.stop_camera_wait = True
-         CameraServer.stop_shooting()         
+         self.__camera_server.stop_shooting()         
       else:
          self.__flight = 1
          self.aligning_cam1 = True
          self.videos[0].set_shooting(True)
-         self.cameras_data = CamerasData(self.__db, self.__flight)
+         self.__replace_cameras_data()
          self.videos[0].cameras_data = self.cameras_data
-         CameraServer.start_shooting(self.cameras_data, 1)
+         self.__frame_cache.invalidate(1)
+         self.__camera_server.start_shooting(self.cameras_data, 1)
          self.enable_all_gui_elements(False)
          self.ui.pushButton_video1_align.setText("Stop")
 
@@ -420,20 +472,21 @@ class WindowMain(QMainWindow):
       """
       if (self.aligning_cam2):
          self.stop_camera_wait = True
-         CameraServer.stop_shooting()         
+         self.__camera_server.stop_shooting()         
       else:
          self.__flight = 1
          self.aligning_cam2 = True
          self.videos[1].set_shooting(True)
-         self.cameras_data = CamerasData(self.__db, self.__flight)
+         self.__replace_cameras_data()
          self.videos[1].cameras_data = self.cameras_data
-         CameraServer.start_shooting(self.cameras_data, 1)
+         self.__frame_cache.invalidate(1)
+         self.__camera_server.start_shooting(self.cameras_data, 1)
          self.enable_all_gui_elements(False)
          self.ui.pushButton_video2_align.setText("Stop")
 
    def startCameras(self):
       logger.info("Starting Cameras")
-      if not CameraServer.is_ready_to_shoot():
+      if not self.__camera_server.is_ready_to_shoot():
          return False
 
       for i in range(0,20):
@@ -457,17 +510,17 @@ class WindowMain(QMainWindow):
       self.videos[1].reset()
       self.videos[0].set_shooting(True)
       self.videos[1].set_shooting(True)
-      self.cameras_data = CamerasData(self.__db, self.__flight)
+      self.__replace_cameras_data()
       self.videos[0].cameras_data = self.cameras_data
       self.videos[1].cameras_data = self.cameras_data
-      CameraServer.ServerData.flight = self.__flight
-      CameraServer.start_shooting(self.cameras_data, self.__flight)
+      self.__frame_cache.invalidate(self.__flight)
+      self.__camera_server.start_shooting(self.cameras_data, self.__flight)
 
 
    def stopCameras(self):
       logger.info("Stoping Cameras")
       self.stop_camera_wait = True
-      CameraServer.stop_shooting()
+      self.__camera_server.stop_shooting()
       self.__save_announcements()
 
    def enable_all_gui_elements(self, enabled):
@@ -507,79 +560,35 @@ class WindowMain(QMainWindow):
       """
       Checking the motion tracking
       """
-      if cam == "cam1" and self.run_direction == None and motion["direction"] == -1:
-         # Camera 1 triggered LEFT run without being on a timed run. Reset the camera
-         self.videos[0].currently_tracking = 0
-         logger.info("Camera 1 triggered the wrong way for start of run, reseting")
-      if cam == "cam2" and self.run_direction == None and motion["direction"] == 1:
-         # Camera 1 triggered RIGHT run without being on a timed run. Reset the camera
-         self.videos[1].currently_tracking = 0
-         logger.info("Camera 2 triggered the wrong way for start of run, reseting")
-      if cam == "cam1" and self.run_direction == 'LEFT' and motion["direction"] == 1:
-         # Camera 1 triggered LEFT run without being on a timed run. Reset the camera
-         self.videos[0].currently_tracking = 0
-         logger.info("Camera 1 triggered the wrong way in run, reseting")
-      if cam == "cam2" and self.run_direction == 'RIGHT' and motion["direction"] == -1:
-         # Camera 1 triggered RIGHT run without being on a timed run. Reset the camera
-         self.videos[1].currently_tracking = 0
-         logger.info("Camera 2 triggered the wrong way in run, reseting")
-
-      # Check right run
-      if cam == "cam1" and self.run_direction == None and motion["direction"] == 1:
-         # Starting run from cam 1
-         self.run_frame_number_cam1 = motion["frame_number"]
-         self.run_frame_number_cam2 = 0
-         self.run_direction = "RIGHT"
-         # Max 6 second run
-         self.run_abort_timestamp = int(round(time.time() * 1000)) + 6000
-         self.__sound.play_gate_1()
-         logger.info("Initiating time run from cam 1 -->")
-
-      if cam == "cam2" and self.run_direction == "RIGHT" and motion["direction"] == 1:
-         # Ending run on Cam 2
-         self.run_frame_number_cam2 = motion["frame_number"]
-         self.run_direction = None
-         kmh = self.set_speed(self.run_frame_number_cam1, self.run_frame_number_cam2)
-         logger.info("Timed run completed on cam 2 -->")
-         self.__sound.play_gate_2()
-         if (kmh < 500):
-            self.run_tell_speed_timestamp = int(round(time.time() * 1000)) + 1000
-            self.run_tell_speed = kmh
-            logger.info("Adding announcement --> " + str(kmh) + " km/h")
-            self.add_announcement(self.run_frame_number_cam1, self.run_frame_number_cam2, kmh, 1)
-         else:
-            logger.warning("Do not add announcement over 500 km/h")
-      
+      result = self.__run_detector.check(cam, motion)
+      if result == RunDetector.RESET:
+         self.videos[0 if cam == "cam1" else 1].motion_tracker.reset_tracking()
 
-      # Check left run
-      if cam == "cam2" and self.run_direction == None and motion["direction"] == -1:
-         # Starting run from cam 2
-         self.run_frame_number_cam2 = motion["frame_number"]
-         self.run_frame_number_cam1 = 0
-         self.run_direction = "LEFT"
-         # Max 6 second run
-         self.run_abort_timestamp = int(round(time.time() * 1000)) + 6000
+      elif result == RunDetector.STARTED:
          self.__sound.play_gate_1()
-         logger.info("Initiating time run from cam 2 <--")
 
-      if cam == "cam1" and self.run_direction == "LEFT" and motion["direction"] == -1:
-         # Ending run on Cam 1
-         self.run_frame_number_cam1 = motion["frame_number"]
-         self.run_direction = None
-         kmh = self.set_speed(self.run_frame_number_cam1, self.run_frame_number_cam2)
+      elif result == RunDetector.COMPLETED:
+         cam1_frame_number = self.__run_detector.run_frame_number_cam1
+         cam2_frame_number = self.__run_detector.run_frame_number_cam2
+         direction = self.__run_detector.completed_direction
+         if self.cameras_data.get_timestamp("cam1", cam1_frame_number) is None or \
+               self.cameras_data.get_timestamp("cam2", cam2_frame_number) is None:
+            ''' A frame of the run has not arrived yet, e.g. waits in the reorder buffer '''
+            logger.warning("Timestamps of the run not available, no announcement")
+            return
+         kmh = self.set_speed(cam1_frame_number, cam2_frame_number)
          self.__sound.play_gate_2()
-         logger.info("Timed run completed on cam 2 <--")
-         if (kmh < 500):
+         if (kmh < MAX_ANNOUNCED_SPEED):
             self.run_tell_speed_timestamp = int(round(time.time() * 1000)) + 1000
             self.run_tell_speed = kmh
-            self.add_announcement(self.run_frame_number_cam1, self.run_frame_number_cam2, kmh, -1)
-            logger.info("Adding announcement <-- " + str(kmh) + " km/h")
+            logger.info("Adding announcement " + ("-->" if direction == 1 else "<--") + " " + str(kmh) + " km/h")
+            self.add_announcement(cam1_frame_number, cam2_frame_number, kmh, direction)
          else:
-            logger.warning("Do not add announcement over 500 km/h")
+            logger.warning("Do not add announcement over " + str(MAX_ANNOUNCED_SPEED) + " km/h")
 
    def add_announcement(self, cam1_frame_number, cam2_frame_number, speed, direction):
-      cam1_timestamp = self.cameras_data.get_frame("cam1", cam1_frame_number).get_timestamp()
-      cam2_timestamp = self.cameras_data.get_frame("cam2", cam2_frame_number).get_timestamp()
+      cam1_timestamp = self.cameras_data.get_timestamp("cam1", cam1_frame_number)
+      cam2_timestamp = self.cameras_data.get_timestamp("cam2", cam2_frame_number)
       milliseconds = abs(cam1_timestamp - cam2_timestamp)
 
       self.announcements.append(Announcement(
@@ -617,6 +626,7 @@ class WindowMain(QMainWindow):
 
    def __del__(self):
       logger.debug("Mainwindow destructor called")
+      self.__camera_server.stop_server()
       self.__db.stop()
 
 
@@ -0,0 +1,409 @@
+'''
+Headless base station, ingest, motion tracking, run detection and
+announcements without Qt or pygame.
+
+Run without arguments to start the engine, it is controlled through a local
+HTTP API (see ControlHandler), which the other commands use:
+
+   sleipnir_headless.py status
+   sleipnir_headless.py start FLIGHT
+   sleipnir_headless.py stop
+   sleipnir_headless.py announcements [FLIGHT]
+   sleipnir_headless.py pin FLIGHT
+   sleipnir_headless.py unpin FLIGHT
+'''
+from threading import Thread, Lock
+import urllib.request
+import urllib.error
+import asyncio
+import json
+import time
+import sys
+
+import tornado.ioloop
+import tornado.web
+
+import CameraServer
+from IngestProcess import IngestProcessProxy
+from CamerasData import CamerasData, ReorderPolicy
+from Configuration import Configuration
+from database.DB import DB
+from database.FrameWriter import FlushPolicy
+from database.RetentionWorker import RetentionPolicy
+from Announcements import Announcements, Announcement
+import database.announcement_dao as announcement_dao
+import database.frame_dao as frame_dao
+from Frame import Frame
+from MotionAnalyzer import MotionTracker
+from RunDetector import RunDetector, MAX_ANNOUNCED_SPEED, speed
+from cameras import DEFAULT_CAMERAS, check_cameras
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Flights selectable, same as the GUI
+FLIGHTS = 20
+
+class Engine:
+   ''' Everything WindowMain does while shooting, driven by run() instead of a Qt timer '''
+   def __init__(self, configuration: Configuration):
+      self.__db = DB(
+         configuration.get_or_throw('save_path'),
+         bool(configuration.get('storage.segments', False)),
+         int(configuration.get('storage.read_cache_mb', 16)),
+         int(configuration.get('storage.read_mmap_mb', 256)))
+      self.__max_dive_angle = float(configuration.get('max_dive_angle', 10.0))
+      self.__cameras = check_cameras(configuration.get('cameras', DEFAULT_CAMERAS))
+      self.__reorder_policy = ReorderPolicy(
+         int(configuration.get('reorder.window', 45)),
+         int(configuration.get('reorder.timeout_ms', 500)))
+      self.__live_frames = int(float(configuration.get('live_buffer.seconds', 5)) * 90)
+      self.__decode_live_frames = bool(configuration.get('live_buffer.decode', False))
+      self.__distance = float(configuration.get('headless.distance', 100))
+      self.__groundlevel = int(configuration.get('headless.groundlevel', 400))
+
+      # Sound is optional, pygame is only loaded when it is enabled
+      self.__sound = None
+      if configuration.get('headless.sound', False):
+         from Sound import Sound
+         self.__sound = Sound()
+
+      # Held by the control API and by run() while they touch the state below
+      self.__mutex = Lock()
+      self.__flight = 1
+      self.__shooting = False
+      self.__stop_camera_wait = False
+      self.__cameras_data = None # type: CamerasData
+      self.__trackers = {} # type: dict[str, MotionTracker]
+      self.__run_detector = RunDetector()
+      self.__announcements = Announcements()
+      self.__last_served_frame = {}
+      self.__run_tell_speed = 0
+      self.__run_tell_speed_timestamp = 0
+
+      if configuration.get('ingest_process.enabled', False):
+         self.__camera_server = IngestProcessProxy(
+            configuration.get_or_throw('save_path'),
+            self.__reorder_policy,
+            self.__live_frames,
+            int(configuration.get('ingest_process.slot_size', 131072)))
+      else:
+         self.__camera_server = CameraServer
+      self.__camera_server.start_server(self.__db, self.__cameras, FlushPolicy(
+         int(configuration.get('frame_writer.batch_size', 45)),
+         int(configuration.get('frame_writer.flush_interval_ms', 250)),
+         int(configuration.get('frame_writer.queue_size', 1000))), RetentionPolicy(
+         bool(configuration.get('retention.enabled', False)),
+         float(configuration.get('retention.window_seconds', 10)),
+         int(configuration.get('retention.keep_every', 10)),
+         float(configuration.get('retention.after_minutes', 10))))
+
+   def start(self, flight: int) -> bool:
+      ''' Start shooting flight, False if the cameras are not ready '''
+      self.__mutex.acquire()
+      try:
+         if self.__shooting or not self.__camera_server.is_ready_to_shoot():
+            return False
+         logger.info("Starting Cameras on flight " + str(flight))
+         self.__flight = flight
+         self.__announcements.clear()
+         self.__run_detector.reset()
+         self.__stop_trackers()
+         for cam in ('cam1', 'cam2'):
+            self.__trackers[cam] = MotionTracker(cam, self.__max_dive_angle)
+            self.__last_served_frame[cam] = 0
+         if self.__cameras_data is not None:
+            self.__cameras_data.close()
+         self.__cameras_data = CamerasData(self.__db, self.__flight, self.__cameras, self.__reorder_policy,
+            self.__live_frames, self.__decode_live_frames)
+         if not self.__camera_server.start_shooting(self.__cameras_data, self.__flight):
+            return False
+         self.__shooting = True
+         self.__stop_camera_wait = False
+         return True
+      finally:
+         self.__mutex.release()
+
+   def stop(self) -> bool:
+      ''' Stop shooting and store the announcements, False if not shooting '''
+      self.__mutex.acquire()
+      try:
+         if not self.__shooting or self.__stop_camera_wait:
+            return False
+         logger.info("Stoping Cameras")
+         self.__stop_camera_wait = True
+         self.__camera_server.stop_shooting()
+         self.__save_announcements()
+         return True
+      finally:
+         self.__mutex.release()
+
+   def get_status(self) -> dict:
+      self.__mutex.acquire()
+      try:
+         positions = {}
+         for cam in self.__cameras:
+            positions[cam] = self.__cameras_data.get_frame_count(cam) if self.__cameras_data else 0
+         return {
+            "flight": self.__flight,
+            "shooting": self.__shooting,
+            "online": dict((cam, self.__camera_server.is_online(cam)) for cam in self.__cameras),
+            "last_position": positions,
+            "run_direction": self.__run_detector.run_direction,
+            "announcements": self.__announcements_to_list(self.__announcements)
+         }
+      finally:
+         self.__mutex.release()
+
+   def get_announcements(self, flight: int) -> list:
+      ''' Stored announcements of flight, the current ones while it is shooting '''
+      self.__mutex.acquire()
+      try:
+         if self.__shooting and flight == self.__flight:
+            return self.__announcements_to_list(self.__announcements)
+         return self.__announcements_to_list(announcement_dao.fetch(self.__db, flight))
+      finally:
+         self.__mutex.release()
+
+   def pin(self, flight: int, pinned: bool) -> bool:
+      ''' A pinned flight is kept whole by retention '''
+      frame_dao.pin_flight(self.__db, flight, pinned)
+      return frame_dao.is_flight_pinned(self.__db, flight)
+
+   def run(self):
+      ''' Track motion, 10ms between the rounds like the GUI timer while shooting '''
+      while True:
+         self.__mutex.acquire()
+         try:
+            self.__step()
+         finally:
+            self.__mutex.release()
+         time.sleep(0.01)
+
+   def close(self):
+      if self.__shooting:
+         self.stop()
+      self.__stop_trackers()
+      self.__camera_server.stop_server()
+      self.__db.stop()
+
+   def __step(self):
+      online = all(self.__camera_server.is_online(cam) for cam in self.__cameras)
+      if self.__shooting and not self.__stop_camera_wait and not online:
+         # Camera lost?
+         logger.error("Camera lost, stopping")
+         self.__stop_camera_wait = True
+         self.__camera_server.stop_shooting()
+         self.__save_announcements()
+
+      if self.__stop_camera_wait:
+         if not self.__camera_server.is_shooting():
+            self.__stop_camera_wait = False
+            self.__shooting = False
+         return
+
+      if not self.__shooting or not self.__camera_server.is_shooting():
+         return
+
+      for cam in ('cam1', 'cam2'):
+         tracker = self.__trackers[cam]
+         if tracker.is_running():
+            continue
+         last_position = self.__cameras_data.get_frame_count(cam)
+         if last_position == 0:
+            continue
+         frame = self.__get_frame_allow_lag(cam, last_position)
+         if frame is None:
+            continue
+         image = self.__cameras_data.get_image(cam, frame.get_position())
+         if image is None:
+            continue
+         motion = tracker.track(image, frame.get_position(), self.__groundlevel)
+         if motion is not None and motion["run"] is not None:
+            self.__check_run(cam, motion["run"])
+
+      if self.__run_detector.check_timeout():
+         self.__play('play_error')
+
+      if self.__run_tell_speed != 0 and self.__run_tell_speed_timestamp < int(round(time.time() * 1000)):
+         self.__play('play_number', self.__run_tell_speed)
+         self.__run_tell_speed = 0
+
+   def __get_frame_allow_lag(self, cam: str, position: int) -> Frame:
+      ''' Same as WindowMain.get_frame_allow_lag, jumps ahead when more than 30 frames behind '''
+      if position == 0: return None
+      if self.__last_served_frame[cam] > position: self.__last_served_frame[cam] = 0
+      if self.__last_served_frame[cam] < position - 30:
+         self.__last_served_frame[cam] = position
+         logger.warning("Lag detected when motion tracking " + cam + ": " + str(position))
+      else:
+         self.__last_served_frame[cam] = min(self.__last_served_frame[cam] + 1, position)
+      return self.__cameras_data.get_frame(cam, self.__last_served_frame[cam])
+
+   def __check_run(self, cam: str, motion: dict):
+      result = self.__run_detector.check(cam, motion)
+      if result == RunDetector.RESET:
+         self.__trackers[cam].reset_tracking()
+
+      elif result == RunDetector.STARTED:
+         self.__play('play_gate_1')
+
+      elif result == RunDetector.COMPLETED:
+         cam1_frame_number = self.__run_detector.run_frame_number_cam1
+         cam2_frame_number = self.__run_detector.run_frame_number_cam2
+         direction = self.__run_detector.completed_direction
+         cam1_timestamp = self.__cameras_data.get_timestamp("cam1", cam1_frame_number)
+         cam2_timestamp = self.__cameras_data.get_timestamp("cam2", cam2_frame_number)
+         if cam1_timestamp is None or cam2_timestamp is None:
+            ''' A frame of the run has not arrived yet, e.g. waits in the reorder buffer '''
+            logger.warning("Timestamps of the run not available, no announcement")
+            return
+         milliseconds = abs(cam1_timestamp - cam2_timestamp)
+         kmh = int(speed(self.__distance, milliseconds))
+         self.__play('play_gate_2')
+         if (kmh < MAX_ANNOUNCED_SPEED):
+            self.__run_tell_speed_timestamp = int(round(time.time() * 1000)) + 1000
+            self.__run_tell_speed = kmh
+            logger.info("Adding announcement " + ("-->" if direction == 1 else "<--") + " " + str(kmh) + " km/h")
+            self.__announcements.append(Announcement(cam1_frame_number, cam2_frame_number, milliseconds, kmh, direction))
+         else:
+            logger.warning("Do not add announcement over " + str(MAX_ANNOUNCED_SPEED) + " km/h")
+
+   def __play(self, sound: str, *args):
+      if self.__sound is not None:
+         getattr(self.__sound, sound)(*args)
+
+   def __stop_trackers(self):
+      for tracker in self.__trackers.values():
+         tracker.stop()
+      self.__trackers = {}
+
+   def __save_announcements(self):
+      logger.info("Saving announcements")
+      announcement_dao.store(self.__db, self.__flight, self.__announcements)
+
+   def __announcements_to_list(self, announcements: Announcements) -> list:
+      return [{
+         "cam1_position": announcement.get_cam1_position(),
+         "cam2_position": announcement.get_cam2_position(),
+         "duration": announcement.get_duration(),
+         "speed": announcement.get_speed(),
+         "direction": announcement.get_direction()
+      } for announcement in announcements.get_announcements()]
+
+class ControlHandler(tornado.web.RequestHandler):
+   '''
+   GET  /?action=status
+   GET  /?action=announcements&flight=N
+   POST /?action=start&flight=N
+   POST /?action=stop
+   POST /?action=pin&flight=N
+   POST /?action=unpin&flight=N
+   '''
+   def initialize(self, engine: Engine):
+      self.__engine = engine
+
+   def get(self):
+      action = self.get_argument("action", "status", True)
+      if action == "status":
+         self.__send(self.__engine.get_status())
+      elif action == "announcements":
+         flight = self.__get_flight()
+         if flight is not None:
+            self.__send(self.__engine.get_announcements(flight))
+      else:
+         self.set_status(400)
+
+   def post(self):
+      action = self.get_argument("action", None, True)
+      if action == "start":
+         flight = self.__get_flight()
+         if flight is not None:
+            self.__send({"started": self.__engine.start(flight)})
+      elif action == "stop":
+         self.__send({"stopped": self.__engine.stop()})
+      elif action in ("pin", "unpin"):
+         flight = self.__get_flight()
+         if flight is not None:
+            self.__send({"pinned": self.__engine.pin(flight, action == "pin")})
+      else:
+         self.set_status(400)
+
+   def __get_flight(self) -> int:
+      try:
+         flight = int(self.get_argument("flight", None, True))
+      except (TypeError, ValueError):
+         flight = 0
+      if flight < 1 or flight > FLIGHTS:
+         self.set_status(400)
+         self.write("flight must be 1 - " + str(FLIGHTS))
+         return None
+      return flight
+
+   def __send(self, data):
+      self.set_header("Content-Type", "application/json")
+      self.write(json.dumps(data))
+
+def start_control_server(engine: Engine, port: int):
+   ''' Control API on localhost only, in its own thread '''
+   def run():
+      asyncio.set_event_loop(asyncio.new_event_loop())
+      app = tornado.web.Application([(r"/", ControlHandler, dict(engine=engine))])
+      app.listen(port, address="127.0.0.1")
+      logger.info("Control API on http://127.0.0.1:" + str(port) + "/")
+      tornado.ioloop.IOLoop.current().start()
+   Thread(target=run, name="Control", daemon=True).start()
+
+def command(port: int, args: list) -> int:
+   ''' Send a command to a running engine and print the answer '''
+   url = "http://127.0.0.1:" + str(port) + "/?action=" + args[0]
+   if len(args) > 1:
+      url += "&flight=" + args[1]
+   data = b'' if args[0] in ('start', 'stop', 'pin', 'unpin') else None
+   try:
+      with urllib.request.urlopen(url, data=data, timeout=60) as response:
+         print(json.dumps(json.loads(response.read()), indent=2))
+   except urllib.error.HTTPError as e:
+      print("Error: " + e.read().decode('utf-8', 'replace'))
+      return 1
+   except urllib.error.URLError as e:
+      print("Unable to reach sleipnir headless on port " + str(port) + ": " + str(e.reason))
+      return 1
+   return 0
+
+def usage():
+   print(__doc__)
+   exit(1)
+
+if __name__ == '__main__':
+   logging.basicConfig(
+      stream=sys.stderr,
+      level=logging.INFO,
+      format='%(asctime)s -  %(levelname)s - %(name)s - %(threadName)s - %(message)s')
+   logging.getLogger('tornado.access').disabled = True
+
+   try:
+      configuration = Configuration("sleipnir.yml")
+   except IOError as e:
+      logger.error("Unable to open configuration file: " + str(e))
+      exit(1)
+   port = int(configuration.get('headless.control_port', 8001))
+
+   args = sys.argv[1:]
+   if args:
+      if args[0] not in ('status', 'start', 'stop', 'announcements', 'pin', 'unpin') or \
+            (args[0] in ('start', 'pin', 'unpin') and len(args) != 2):
+         usage()
+      exit(command(port, args))
+
+   try:
+      engine = Engine(configuration)
+   except ValueError as e:
+      logger.error("Invalid configuration: " + str(e))
+      exit(1)
+   start_control_server(engine, port)
+   try:
+      engine.run()
+   except KeyboardInterrupt:
+      logger.info("Shutting down")
+   engine.close()
@@ -0,0 +1,104 @@
+'''
+Benchmark of CamerasData with ingest writing and the GUI reading at the same time
+
+Usage: python tools/benchmark_cameras_data.py [SECONDS] [FPS] [READ_HZ]
+
+Runs two phases of SECONDS seconds each (default 10):
+
+paced     one writer thread per camera adding FPS frames a second (default 90,
+          180 frames a second for two cameras) and one reader doing what the
+          GUI does every tick READ_HZ times a second (default 100)
+flat out  the same threads without pauses, to show whether they hold each
+          other back
+
+Latencies of add_frame and of a GUI tick are printed as percentiles in ms
+'''
+import threading
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from database.DB import DB
+from CamerasData import CamerasData
+from IngestMetrics import percentiles
+from Frame import Frame
+
+def usage():
+    print(__doc__)
+    exit(1)
+
+def write(cameras_data: CamerasData, camera: int, fps: int, seconds: float, latencies: list):
+    interval = 1 / fps if fps else 0
+    start = time.perf_counter()
+    position = 0
+    while time.perf_counter() - start < seconds:
+        position += 1
+        ''' Every 10th pair of frames arrives out of order, like over wifi '''
+        if position % 10 == 1:
+            order = [position + 1, position]
+        elif position % 10 == 2:
+            continue
+        else:
+            order = [position]
+        for p in order:
+            before = time.perf_counter()
+            cameras_data.add_frame(Frame(1, camera, p, 1000000 + p * 11 + camera, None))
+            latencies.append((time.perf_counter() - before) * 1000)
+        if interval:
+            time.sleep(max(0, start + position * interval - time.perf_counter()))
+
+def read(cameras_data: CamerasData, hz: int, seconds: float, latencies: list):
+    ''' One GUI tick, the calls sleipnir.py makes every timer round while shooting '''
+    interval = 1 / hz if hz else 0
+    start = time.perf_counter()
+    ticks = 0
+    while time.perf_counter() - start < seconds:
+        ticks += 1
+        before = time.perf_counter()
+        cameras_data.get_start_timestamp()
+        for cam in ('cam1', 'cam2'):
+            position = cameras_data.get_frame_count(cam)
+            if position:
+                cameras_data.get_timestamp(cam, position)
+        last = cameras_data.get_last_frame('cam1')
+        if last is not None:
+            cameras_data.get_position_at('cam2', last.get_timestamp())
+        latencies.append((time.perf_counter() - before) * 1000)
+        if interval:
+            time.sleep(max(0, start + ticks * interval - time.perf_counter()))
+
+def phase(name: str, db: DB, fps: int, hz: int, seconds: float):
+    cameras_data = CamerasData(db, 1, ['cam1', 'cam2'], live_frames=1)
+    write_latencies = [[], []]
+    read_latencies = []
+    threads = [threading.Thread(target=write, args=(cameras_data, camera, fps, seconds, write_latencies[camera - 1]))
+        for camera in (1, 2)]
+    threads.append(threading.Thread(target=read, args=(cameras_data, hz, seconds, read_latencies)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    frames = sum(len(latencies) for latencies in write_latencies)
+    print("%s: %.0f frames/s, %.0f ticks/s" % (name, frames / seconds, len(read_latencies) / seconds))
+    print("  add_frame ms %s" % percentiles(write_latencies[0] + write_latencies[1]))
+    print("  GUI tick ms  %s" % percentiles(read_latencies))
+
+seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+fps = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+hz = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+if len(sys.argv) > 4 or seconds <= 0:
+    usage()
+
+path = tempfile.mkdtemp()
+db = DB(path)
+try:
+    phase("paced", db, fps, hz, seconds)
+    phase("flat out", db, 0, 0, seconds)
+finally:
+    db.stop()
+    shutil.rmtree(path)
@@ -0,0 +1,73 @@
+'''
+Benchmark of the frame storage on a database with many frames
+
+Usage: python tools/benchmark_frame_db.py PATH [FRAMES] [FLIGHTS] [IMAGE_SIZE]
+
+PATH - empty directory for the database, it is filled with FLIGHTS flights of
+       FRAMES frames per camera (default 20 flights of 50000 frames per camera,
+       2 million frames) with images of IMAGE_SIZE bytes (default 2048)
+'''
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from database.DB import DB
+import database.frame_dao as frame_dao
+from Frame import Frame
+
+def usage():
+    print(__doc__)
+    exit(1)
+
+def timed(name: str, function, repeat: int = 1):
+    start = time.perf_counter()
+    for i in range(repeat):
+        function(i)
+    ms = (time.perf_counter() - start) * 1000
+    print("%-40s %10.3f ms total %10.3f ms each" % (name, ms, ms / repeat))
+
+if len(sys.argv) < 2:
+    usage()
+path = sys.argv[1]
+frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+flights = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+image_size = int(sys.argv[4]) if len(sys.argv) > 4 else 2048
+cameras = [1, 2]
+
+os.makedirs(path, exist_ok=True)
+db = DB(path)
+image = os.urandom(image_size)
+random.seed(1)
+
+if frame_dao.load_frame_count(db, flights, cameras[-1]) != frames:
+    ''' Store like ingest does, batches of 45 frames alternating between the cameras '''
+    start = time.perf_counter()
+    for flight in range(1, flights + 1):
+        for position in range(1, frames + 1, 45):
+            for camera in cameras:
+                frame_dao.store_many(db, [Frame(flight, camera, p, 1000000 + p * 11, image)
+                    for p in range(position, min(position + 45, frames + 1))])
+    seconds = time.perf_counter() - start
+    total = frames * flights * len(cameras)
+    print("Stored %d frames in %.1f s, %.0f frames/s" % (total, seconds, total / seconds))
+
+''' The first flight is the furthest away from the end of the table '''
+timed("load_frame_count first flight", lambda i: frame_dao.load_frame_count(db, 1, cameras[i % 2]), 100)
+timed("load_frame_count last flight", lambda i: frame_dao.load_frame_count(db, flights, cameras[i % 2]), 100)
+timed("load_timestamp random", lambda i: frame_dao.load_timestamp(
+    db, random.randint(1, flights), cameras[i % 2], random.randint(1, frames)), 10000)
+timed("load random", lambda i: frame_dao.load(
+    db, random.randint(1, flights), cameras[i % 2], random.randint(1, frames)), 2000)
+timed("load sequential", lambda i: frame_dao.load(db, 2, cameras[0], i + 1), min(frames, 10000))
+timed("load_flight_timestamps one camera", lambda i: frame_dao.load_flight_timestamps(db, 3 + i, cameras[0]), 5)
+timed("store_many 45 frames", lambda i: frame_dao.store_many(
+    db, [Frame(flights + 1, cameras[0], i * 45 + p, p, image) for p in range(1, 46)]), 200)
+timed("retire_flight", lambda i: frame_dao.retire_flight(db, flights + 1), 1)
+def reap(i):
+    while frame_dao.reap(db, 500) == 500: pass
+timed("reap retired flight", reap, 1)
+
+db.stop()
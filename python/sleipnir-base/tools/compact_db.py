@@ -0,0 +1,44 @@
+'''
+Compact the database so the pages of every flight are stored together
+
+Usage: python tools/compact_db.py PATH
+
+PATH - save_path of sleipnir, sleipnir must not be running. Needs free disk
+       space for a copy of sleipnir.db. Afterwards free pages of reaped
+       flights are reclaimed in the background when not shooting
+'''
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from database.DB import DB
+import database.Compactor as Compactor
+
+def usage():
+    print(__doc__)
+    exit(1)
+
+def report(db: DB):
+    stats = Compactor.space_stats(db)
+    print("Size %.1f MB, free %.1f MB (%.1f%%), incremental vacuum %s" % (
+        stats["size_bytes"] / 1024 / 1024,
+        stats["free_bytes"] / 1024 / 1024,
+        stats["fragmentation"] * 100,
+        "on" if stats["incremental"] else "off"))
+    for table in ['frame_meta', 'frame_image']:
+        scatter = Compactor.page_scatter(db, table)
+        if scatter is not None:
+            print("%-12s %.1f%% of the pages out of order" % (table, scatter * 100))
+
+if len(sys.argv) != 2 or not os.path.isfile(os.path.join(sys.argv[1], 'sleipnir.db')):
+    usage()
+
+db = DB(sys.argv[1])
+report(db)
+start = time.time()
+Compactor.compact(db)
+print("Compacted in %.1f s" % (time.time() - start))
+report(db)
+db.stop()
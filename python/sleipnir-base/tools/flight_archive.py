@@ -0,0 +1,76 @@
+'''
+Export a flight to a single file archive, import it again or show what is in it
+
+Usage: python tools/flight_archive.py export PATH FLIGHT FILE
+       python tools/flight_archive.py import PATH FILE [FLIGHT]
+       python tools/flight_archive.py info FILE
+
+PATH   - save_path of sleipnir
+FLIGHT - flight to export, or to import as instead of the flight in the archive.
+         Frames already stored for it are replaced
+
+Run from the directory of sleipnir.yml, export and import store images the way
+its storage settings say
+'''
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from database.DB import DB
+from Configuration import Configuration
+import database.flight_archive as flight_archive
+
+def usage():
+    print(__doc__)
+    exit(1)
+
+def open_db(path: str) -> DB:
+    ''' Storage settings as sleipnir.py reads them '''
+    try:
+        configuration = Configuration("sleipnir.yml")
+    except IOError as e:
+        print("Unable to open configuration file: " + str(e))
+        exit(1)
+    return DB(
+        path,
+        bool(configuration.get('storage.segments', False)),
+        int(configuration.get('storage.read_cache_mb', 16)),
+        int(configuration.get('storage.read_mmap_mb', 256)))
+
+def report(action: str, path: str, seconds: float):
+    size = os.path.getsize(path)
+    print("%s %.1f MB in %.1f s, %.0f MB/s" % (action, size / 1024 / 1024, seconds, size / 1024 / 1024 / max(seconds, 0.001)))
+
+if len(sys.argv) < 3:
+    usage()
+command = sys.argv[1]
+
+if command == 'export' and len(sys.argv) == 5:
+    db = open_db(sys.argv[2])
+    start = time.time()
+    frames = flight_archive.export_flight(db, int(sys.argv[3]), sys.argv[4])
+    report("Exported " + str(frames) + " frames,", sys.argv[4], time.time() - start)
+    db.stop()
+
+elif command == 'import' and len(sys.argv) in (4, 5):
+    db = open_db(sys.argv[2])
+    start = time.time()
+    flight = flight_archive.import_flight(db, sys.argv[3], int(sys.argv[4]) if len(sys.argv) == 5 else None)
+    report("Imported flight " + str(flight) + ",", sys.argv[3], time.time() - start)
+    db.stop()
+
+elif command == 'info' and len(sys.argv) == 3:
+    archive = flight_archive.FlightArchive(sys.argv[2])
+    print("Flight " + str(archive.get_flight()))
+    for camera in archive.get_cameras():
+        positions, timestamps = archive.get_timestamps(camera)
+        print("Camera %d: %d frames, last position %d, %.1f s" % (
+            camera, len(positions), archive.get_frame_count(camera),
+            (timestamps[-1] - timestamps[0]) / 1000 if len(timestamps) else 0))
+    print("Announcements: " + str(len(archive.get_announcements().get_announcements())))
+    archive.close()
+
+else:
+    usage()
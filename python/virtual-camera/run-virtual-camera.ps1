@@ -6,4 +6,4 @@ if (-Not (Test-Path -Path ..\venv)) {
 }
 
 ..\venv\Scripts\activate.ps1
-python .\src\virtual-camera.py $args[0]  $args[1]
\ No newline at end of file
+python .\src\virtual-camera.py @args
\ No newline at end of file
@@ -2,6 +2,7 @@ from logging import setLoggerClass
 import requests
 import time
 import sys
+import os
 import base64
 
 sys.path.insert(0, '../sleipnir-base/src')
@@ -9,31 +10,55 @@ sys.path.insert(0, '../sleipnir-base/src')
 from Configuration import Configuration
 from database.DB import DB
 import database.frame_dao as frame_dao
+from database.flight_archive import FlightArchive
 from Frame import Frame
+import frame_bundle
+from cameras import DEFAULT_CAMERAS, camera_number
 
 def usage():
     print ('Usage:')
-    print ('fake-camera N')
-    print ('N - flight')
+    print ('fake-camera N [JUMP] [BUNDLE] [MODE]')
+    print ('N - flight, or a flight archive file to replay without a database')
+    print ('JUMP - frames to skip at start of flight')
+    print ('BUNDLE - frames per upload, more than 1 uses the uploadframes action')
+    print ('MODE - http (default) or stream for the persistent websocket channel')
     exit(1)
 
 cfg = Configuration('../sleipnir-base/sleipnir.yml')
-db = DB(cfg.get_or_throw('save_path'))
 fps = 90
 
-try:
-    flight = int(sys.argv[1])
-except Exception as e:
-    usage()
+archive = None
+if len(sys.argv) > 1 and os.path.isfile(sys.argv[1]):
+    archive = FlightArchive(sys.argv[1])
+    flight = archive.get_flight()
+else:
+    try:
+        flight = int(sys.argv[1])
+    except Exception as e:
+        usage()
 
-if flight < 2 or flight > 20:
-    usage()
+    if flight < 2 or flight > 20:
+        usage()
+    db = DB(cfg.get_or_throw('save_path'))
 
 jump = 0
 if len(sys.argv) > 2:
     jump = int(sys.argv[2])
 
+bundle = 1
+if len(sys.argv) > 3:
+    bundle = int(sys.argv[3])
+if bundle < 1:
+    usage()
+
+mode = 'http'
+if len(sys.argv) > 4:
+    mode = sys.argv[4]
+if mode != 'http' and mode != 'stream':
+    usage()
+
 url = "http://127.0.0.1:8000/"
+stream_url = "ws://127.0.0.1:8000/stream"
 
 class Camera:
     STATE_IDLE = 0
@@ -43,6 +68,9 @@ class Camera:
         self.__state = Camera.STATE_IDLE
         self.__cam = cam
         self.__position = 0
+        self.__pending = []
+        self.__start = 0
+        self.__frames = None
 
     def set_state(self, state):
         self.__state = state
@@ -59,12 +87,101 @@ class Camera:
     def get_position(self):
         return self.__position
 
-cams = [
-    Camera('cam1'),
-    Camera('cam2'),
-]
+    def get_pending(self):
+        return self.__pending
+
+    def clear_pending(self):
+        self.__pending = []
+
+    def take_pending(self) -> list:
+        ''' The frames of the bundle so far, a new bundle is started '''
+        pending = self.__pending
+        self.__pending = []
+        return pending
+
+    def set_start(self, start):
+        self.__start = start
+
+    def get_start(self):
+        return self.__start
+
+    def rewind(self):
+        ''' Replay from the first frame after jump, frames are read fetch size at a time '''
+        self.__position = 1
+        if archive is not None:
+            self.__frames = archive.frames(camera_number(self.__cam), 1 + jump)
+        else:
+            self.__frames = frame_dao.load_range(db, flight, camera_number(self.__cam), 1 + jump, fetch_size=max(fps, bundle))
+
+    def next_frame(self) -> Frame:
+        ''' None at the end of the flight, once the frames still in a bundle are sent end_of_flight raises '''
+        self.__position += 1
+        return next(self.__frames, None)
+
+    def end_of_flight(self):
+        raise Exception("End of flight " + str(flight) + " on " + self.__cam + ", exiting!")
+
+cams = [Camera(cam) for cam in cfg.get('cameras', DEFAULT_CAMERAS)]
+
+def run_stream():
+    ''' One persistent websocket per camera, start and stop come down the same socket '''
+    import asyncio
+    import tornado.websocket
+
+    async def send_pending(conn, cam: Camera):
+        pending = cam.take_pending()
+        if pending:
+            await conn.write_message(frame_bundle.pack(pending), binary=True)
+
+    async def read_commands(conn, cam: Camera):
+        while True:
+            message = await conn.read_message()
+            if message is None:
+                raise Exception("Sleipnir base closed the stream, exiting!")
+            if message == 'START' and cam.get_state() == Camera.STATE_IDLE:
+                cam.set_start(time.time())
+                cam.rewind()
+                cam.set_state(Camera.STATE_UPLOADING)
+            if message == 'STOP':
+                cam.set_state(Camera.STATE_IDLE)
+                ''' The last frames before the stop are sent even if the bundle is not full '''
+                await send_pending(conn, cam)
+
+    async def stream_camera(cam: Camera):
+        conn = await tornado.websocket.websocket_connect(stream_url + "?cam=" + cam.get_cam())
+        commands = asyncio.ensure_future(read_commands(conn, cam))
+        while not commands.done():
+            ''' Rate limit to fps '''
+            if cam.get_state() != Camera.STATE_UPLOADING or cam.get_position() > (time.time() - cam.get_start()) * fps:
+                await asyncio.sleep(0.001)
+                continue
+
+            frame = cam.next_frame()
+            if frame is None:
+                await send_pending(conn, cam)
+                cam.end_of_flight()
+            cam.get_pending().append((frame.get_position() - jump, frame.get_timestamp(), frame.get_image()))
+            if len(cam.get_pending()) < bundle:
+                continue
+            await send_pending(conn, cam)
+        commands.result()
+
+    async def stream_cameras():
+        await asyncio.gather(*[stream_camera(cam) for cam in cams])
+
+    asyncio.run(stream_cameras())
+
+if mode == 'stream':
+    run_stream()
+    exit(0)
 
 session = requests.session()
+
+def post_pending(cam: Camera):
+    return session.post(url + "?action=uploadframes&cam=" + cam.get_cam(),
+        data=frame_bundle.pack(cam.take_pending()),
+        timeout=1)
+
 start = time.time()
 count  = 0
 while True:
@@ -74,9 +191,7 @@ while True:
         continue
     count += 1    
 
-    for cam_idx in range(2):
-        cam = cams[cam_idx]
-
+    for cam in cams:
         if cam.get_state() == Camera.STATE_IDLE:
             response = session.post(url + "?action=startcamera&cam=" + cam.get_cam(), timeout=1)
             if (response.status_code != 200):
@@ -85,16 +200,25 @@ while True:
                 start = time.time()
                 count  = 0
                 cam.set_state(Camera.STATE_UPLOADING)
-                cam.set_position(1)
+                cam.rewind()
 
         if (cam.get_state() == Camera.STATE_UPLOADING):
-            position = cam.get_position()
-            cam.set_position(position + 1)
-            frame = frame_dao.load(db, flight, 1 if cam.get_cam() == 'cam1' else 2, position + jump)
-            response = session.post(url + "?action=uploadframe&cam=" + cam.get_cam() + "&position=" + str(frame.get_position() - jump ) + "&timestamp=" + str(frame.get_timestamp()), 
-                data=frame.get_image(),
-                timeout=1)
+            frame = cam.next_frame()
+            if frame is None:
+                if cam.get_pending():
+                    post_pending(cam)
+                cam.end_of_flight()
+            if bundle == 1:
+                response = session.post(url + "?action=uploadframe&cam=" + cam.get_cam() + "&position=" + str(frame.get_position() - jump ) + "&timestamp=" + str(frame.get_timestamp()), 
+                    data=frame.get_image(),
+                    timeout=1)
+            else:
+                cam.get_pending().append((frame.get_position() - jump, frame.get_timestamp(), frame.get_image()))
+                if len(cam.get_pending()) < bundle:
+                    continue
+                response = post_pending(cam)
             if (response.status_code != 200):
                 raise Exception("Sleipnir base gave error: " + response.status_code + " exiting!")
             if (response.content == b'OK-STOP'):
                 cam.set_state(Camera.STATE_IDLE)
+                cam.clear_pending()